@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# let us import mapper from the directory above
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+import mapper
+from mapper import Tile
+
+from mock_tile_server import MockTileServer
+
+# corners of the UT campus, the area downloaded by default
+UT_VERTICES = [
+    (30.2919, -97.7433),
+    (30.2919, -97.7281),
+    (30.2799, -97.7281),
+    (30.2799, -97.7433),
+]
+
+def run_download(url_template, store_spec, num_threads, num_writers, zoom_levels,
+        vertices=UT_VERTICES):
+    """
+    Downloads an area from the server at url_template into a new store, and
+    returns a dict of how it went: tiles downloaded and failed, tiles/second,
+    median and 99th percentile download latency in milliseconds, CPU seconds,
+    and the process's peak RSS in kilobytes. Meant to be run in its own
+    process, so CPU and memory use are the download's alone.
+    """
+
+    Tile.URL_TEMPLATE = url_template
+
+    # time every download as the downloading threads see it
+    latencies = []
+    download = Tile.download
+
+    def timed_download(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return download(self, *args, **kwargs)
+        finally:
+            latencies.append(time.time() - start)
+
+    Tile.download = timed_download
+
+    tile_store = mapper.tile_store_from_spec(store_spec)
+    metrics = mapper.Metrics()
+    tiles = [Tile.from_mercator(lat, lng, 0) for lat, lng in vertices]
+
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+
+    mapper.download_area(Tile.TYPE_MAP, tiles, tile_store, zoom_levels,
+            num_threads=num_threads, num_writers=num_writers, metrics=metrics)
+
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    latencies.sort()
+    def percentile(p):
+        if len(latencies) == 0:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * p / 100.0))
+        return round(latencies[index] * 1000, 2)
+
+    downloaded = metrics.get_counter("mapper_tiles_downloaded_total")
+    return {
+        "tiles": downloaded,
+        "failed": metrics.get_counter("mapper_tiles_failed_total"),
+        "retries": metrics.get_counter("mapper_download_retries_total"),
+        "seconds": round(elapsed, 3),
+        "tiles_per_second": round(downloaded / elapsed, 1),
+        "p50_ms": percentile(50),
+        "p99_ms": percentile(99),
+        "cpu_seconds": round(usage.ru_utime - start_usage.ru_utime +
+            usage.ru_stime - start_usage.ru_stime, 3),
+        "peak_rss_kb": usage.ru_maxrss,
+    }
+
+def run_benchmarks(server, store_kinds, thread_counts, writer_counts,
+        zoom_levels, mongo_url=None):
+    """
+    Runs a download for every combination of store kind, thread count, and
+    writer count, each in a new process against the given running
+    MockTileServer. Returns a list of result dicts, as returned by
+    run_download() plus the combination that produced them.
+    """
+
+    results = []
+    for store_kind in store_kinds:
+        for num_threads in thread_counts:
+            for num_writers in writer_counts:
+                # give every run an empty store of its own
+                directory = None
+                if store_kind == "null":
+                    store_spec = "null:"
+                elif store_kind == "file":
+                    directory = tempfile.mkdtemp(prefix="mapper-benchmark-")
+                    store_spec = "file:" + directory
+                else:
+                    store_spec = (mongo_url.rstrip("/") + "/benchmark_" +
+                            str(os.getpid()) + "_" + str(len(results)))
+
+                config = {
+                    "url_template": server.url_template,
+                    "store_spec": store_spec,
+                    "num_threads": num_threads,
+                    "num_writers": num_writers,
+                    "zoom_levels": list(zoom_levels),
+                }
+
+                try:
+                    output = subprocess.check_output([sys.executable,
+                        os.path.abspath(__file__), "--run", json.dumps(config)])
+                finally:
+                    if directory is not None:
+                        shutil.rmtree(directory)
+                    if store_kind == "mongo":
+                        drop_mongo_collection(store_spec)
+
+                result = json.loads(output.splitlines()[-1])
+                result.update({
+                    "store": store_kind,
+                    "threads": num_threads,
+                    "writers": num_writers,
+                })
+                results.append(result)
+
+                print >> sys.stderr, format_result(result)
+
+    return results
+
+def drop_mongo_collection(store_spec):
+    tile_store = mapper.tile_store_from_spec(store_spec)
+    tile_store.collection.drop()
+    tile_store.blobs.drop()
+
+def get_run_key(result):
+    return (result["store"], result["threads"], result["writers"])
+
+def compare_results(results, baseline, threshold):
+    """
+    Compares the tiles/second of each result against the baseline result for
+    the same store, thread count, and writer count. Returns a list of (result,
+    baseline tiles/second, change) triples, change being the fractional
+    difference, and a list of the results that were slower than their
+    baselines by more than threshold.
+    """
+
+    baseline_runs = dict((get_run_key(r), r) for r in baseline["runs"])
+
+    comparisons = []
+    regressions = []
+    for result in results:
+        base = baseline_runs.get(get_run_key(result))
+        if base is None or base["tiles_per_second"] == 0:
+            continue
+
+        change = (result["tiles_per_second"] / base["tiles_per_second"]) - 1
+        comparisons.append((result, base["tiles_per_second"], change))
+
+        if change < -threshold:
+            regressions.append(result)
+
+    return comparisons, regressions
+
+def format_result(result):
+    return ("store=" + result["store"] + " threads=" +
+            str(result["threads"]) + " writers=" + str(result["writers"]) +
+            ": " + str(result["tiles"]) + " tiles, " +
+            str(result["tiles_per_second"]) + " tiles/s, p50 " +
+            str(result["p50_ms"]) + " ms, p99 " + str(result["p99_ms"]) +
+            " ms, " + str(result["cpu_seconds"]) + " cpu s, " +
+            str(result["peak_rss_kb"]) + " KB peak")
+
+if __name__ == "__main__":
+    import argparse
+
+    # a single run, in the process started for it by run_benchmarks()
+    if len(sys.argv) == 3 and sys.argv[1] == "--run":
+        config = json.loads(sys.argv[2])
+        print json.dumps(run_download(config["url_template"],
+                config["store_spec"], config["num_threads"],
+                config["num_writers"], config["zoom_levels"]))
+        sys.exit(0)
+
+    def int_list(value):
+        return [int(v) for v in value.split(",")]
+
+    parser = argparse.ArgumentParser(description="Benchmark downloading " +
+            "the UT campus from a local mock tile server.")
+
+    parser.add_argument("-s", "--stores", default="null,file",
+            help="comma-separated store kinds to download into, from null, " +
+            "file, and mongo (default null,file)")
+    parser.add_argument("--mongo-url", default="mongo://127.0.0.1:27017/mapper",
+            help="server and database for mongo runs (default " +
+            "mongo://127.0.0.1:27017/mapper)")
+    parser.add_argument("-n", "--threads", type=int_list, default=[1, 4, 16],
+            help="comma-separated download thread counts (default 1,4,16)")
+    parser.add_argument("-w", "--writers", type=int_list, default=[0, 1],
+            help="comma-separated store writer thread counts, 0 storing " +
+            "from the download threads (default 0,1)")
+    parser.add_argument("-m", "--min-zoom", type=int, default=15,
+            help="minimum zoom to download (default 15)")
+    parser.add_argument("-z", "--max-zoom", type=int, default=17,
+            help="maximum zoom to download (default 17)")
+
+    parser.add_argument("--latency", type=float, default=0.02,
+            help="seconds the server waits before each response " +
+            "(default 0.02)")
+    parser.add_argument("--jitter", type=float, default=0.01,
+            help="up to this many more seconds to wait, at random " +
+            "(default 0.01)")
+    parser.add_argument("--bandwidth", type=int, default=None,
+            help="bytes per second to send each response at (default " +
+            "unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+            help="fraction of requests to fail (default 0)")
+    parser.add_argument("--throttle-rps", type=int, default=None,
+            help="requests per second each mirror answers before failing " +
+            "(default unlimited)")
+    parser.add_argument("--tile-size", type=int, default=20000,
+            help="bytes in each tile (default 20000)")
+
+    parser.add_argument("-o", "--output", type=os.path.abspath, default=None,
+            help="write the results to this file as JSON")
+    parser.add_argument("-b", "--baseline", type=os.path.abspath, default=None,
+            help="compare tiles/second against the results in this file, " +
+            "exiting with a status of 1 if any run regressed")
+    parser.add_argument("-t", "--threshold", type=float, default=0.1,
+            help="fraction slower than the baseline that counts as a " +
+            "regression (default 0.1)")
+
+    args = parser.parse_args()
+
+    store_kinds = args.stores.split(",")
+    for store_kind in store_kinds:
+        if store_kind not in ("null", "file", "mongo"):
+            parser.error("argument -s/--stores: invalid store kind: " +
+                    repr(store_kind))
+
+    server_config = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "bandwidth": args.bandwidth,
+        "error_rate": args.error_rate,
+        "throttle_rps": args.throttle_rps,
+        "tile_size": args.tile_size,
+    }
+
+    server = MockTileServer(**server_config)
+    server.start()
+    try:
+        results = run_benchmarks(server, store_kinds, args.threads,
+                args.writers, xrange(args.min_zoom, args.max_zoom + 1),
+                args.mongo_url)
+    finally:
+        server.stop()
+
+    report = {
+        "server": server_config,
+        "zoom_levels": [args.min_zoom, args.max_zoom],
+        "runs": results,
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True,
+                    separators=(",", ": "))
+
+    status = 0
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+        comparisons, regressions = compare_results(results, baseline,
+                args.threshold)
+
+        for result, base_rate, change in comparisons:
+            print ("store=" + result["store"] + " threads=" +
+                    str(result["threads"]) + " writers=" +
+                    str(result["writers"]) + ": " +
+                    str(result["tiles_per_second"]) + " vs " + str(base_rate) +
+                    " tiles/s (" + ("%+.1f" % (change * 100)) + "%)" +
+                    (" REGRESSED" if result in regressions else ""))
+
+        if len(regressions) > 0:
+            status = 1
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+    sys.exit(status)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+# let us import mapper from the directory above
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from mapper import Polygon, Tile
+
+from download import UT_VERTICES
+
+# where the committed results live
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "hot_paths_baseline.json")
+
+# roughly central Austin, about 20 by 15 km
+CITY_VERTICES = [
+    (30.3500, -97.8000),
+    (30.3600, -97.7400),
+    (30.3300, -97.6700),
+    (30.2700, -97.6600),
+    (30.2200, -97.7000),
+    (30.2100, -97.7600),
+    (30.2500, -97.8200),
+    (30.3100, -97.8300),
+]
+
+def to_points(vertices, zoom):
+    """
+    Converts (latitude, longitude) pairs to (x, y) tile coordinates at a zoom.
+    """
+
+    points = []
+    for latitude, longitude in vertices:
+        tile = Tile.from_mercator(latitude, longitude, zoom)
+        points.append((tile.x, tile.y))
+    return points
+
+def get_coastline(num_vertices, radius, seed=1):
+    """
+    Returns the vertices of a ragged, star-shaped polygon, like an island's
+    coastline, centered on (2 * radius, 2 * radius). Rounding to whole tiles
+    can repeat a vertex or move it behind the one before it, so vertices whose
+    angle around the center doesn't strictly increase are dropped. That keeps
+    the polygon star-shaped, so its edges never cross.
+    """
+
+    rng = random.Random(seed)
+    center = 2 * radius
+
+    points = []
+    offset = 0.0
+    last_angle = None
+    for i in xrange(num_vertices):
+        angle = 2 * math.pi * i / num_vertices
+        offset = max(-0.3, min(0.3, offset + rng.uniform(-0.05, 0.05)))
+        r = radius * (1 + offset)
+        point = (int(center + r * math.cos(angle)),
+                int(center + r * math.sin(angle)))
+
+        # the angle of the rounded point, kept within a half turn of the
+        # unrounded one so the angles still run from 0 to 2 * pi
+        rounded_angle = math.atan2(point[1] - center, point[0] - center)
+        rounded_angle += 2 * math.pi * round((angle - rounded_angle) /
+                (2 * math.pi))
+
+        if last_angle is None or rounded_angle > last_angle:
+            points.append(point)
+            last_angle = rounded_angle
+    return points
+
+def get_cases():
+    """
+    Returns a dict of benchmark names to (setup, checked) pairs. Each setup
+    function builds the case's inputs and returns a function that does one
+    operation and returns its result. If checked is True, the result is a list
+    of points whose checksum must match the baseline's, so faster
+    implementations are held to the same output.
+    """
+
+    cases = {}
+
+    def add_area_case(name, get_points):
+        def setup():
+            points = get_points()
+            return lambda: Polygon.get_area(points)
+        cases[name] = (setup, True)
+
+    add_area_case("area_ut_z18", lambda: to_points(UT_VERTICES, 18))
+    for zoom in xrange(16, 20):
+        add_area_case("area_city_z" + str(zoom),
+                lambda zoom=zoom: to_points(CITY_VERTICES, zoom))
+
+    # a long, thin diagonal strip, like a road or a river
+    add_area_case("area_skinny",
+            lambda: [(0, 0), (4000, 1000), (4002, 1004), (2, 4)])
+
+    add_area_case("area_coastline", lambda: get_coastline(1000, 150))
+
+    cases["line_long"] = (
+            lambda: lambda: Polygon.get_line((0, 0), (10000, 3777)), True)
+
+    def setup_bounds():
+        points = get_coastline(10000, 5000)
+        return lambda: Polygon.get_bounds(*points)
+    cases["bounds_10000"] = (setup_bounds, False)
+
+    def setup_from_mercator():
+        coords = [(30.2 + i * 1e-5, -97.7 - i * 1e-5) for i in xrange(10000)]
+        return lambda: [Tile.from_mercator(lat, lng, 18) for lat, lng in coords]
+    cases["tile_from_mercator_10000"] = (setup_from_mercator, False)
+
+    cases["tile_from_google_10000"] = (
+            lambda: lambda: [Tile.from_google(59900 + i % 100,
+                107900 + i / 100, 18) for i in xrange(10000)],
+            False)
+
+    def setup_hash():
+        tiles = [Tile.from_google(59900 + i % 100, 107900 + i / 100, 18)
+                for i in xrange(10000)]
+        return lambda: set(tiles)
+    cases["tile_hash_10000"] = (setup_hash, False)
+
+    return cases
+
+def get_checksum(points):
+    """
+    Returns the number of points and a hash of them in sorted order, which
+    changes if any point is added, removed, or repeated.
+    """
+
+    digest = hashlib.sha1()
+    for x, y in sorted(points):
+        digest.update(str(x) + "," + str(y) + ";")
+    return len(points), digest.hexdigest()
+
+def run_case(name, min_time=0.5, repeats=3):
+    """
+    Times one benchmark case, and returns a dict of its best operations per
+    second over several repeats, how many kilobytes its first operation grew
+    the process's peak RSS by, and the result's checksum if checked.
+    Meant to be run in its own process, so peak memory is the case's alone.
+    """
+
+    setup, checked = get_cases()[name]
+
+    function = setup()
+
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = function()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # repeat each timing until it's long enough to trust
+    best = None
+    for i in xrange(repeats):
+        iterations = 0
+        start = time.time()
+        while 1:
+            function()
+            iterations += 1
+            elapsed = time.time() - start
+            if elapsed >= min_time:
+                break
+
+        ops = iterations / elapsed
+        best = ops if best is None else max(best, ops)
+
+    case_result = {
+        "ops_per_second": round(best, 3),
+        "peak_rss_kb": peak_rss - start_rss,
+    }
+
+    if checked:
+        case_result["points"], case_result["checksum"] = get_checksum(result)
+
+    return case_result
+
+def compare_results(results, baseline, threshold):
+    """
+    Returns a list of (name, message) pairs for each way results fall short of
+    the baseline: a checksum that differs, or ops/second more than threshold
+    slower. Peak memory isn't compared here, see compare_memory().
+    """
+
+    failures = []
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+
+        if base.get("checksum") != result.get("checksum"):
+            failures.append((name, "output differs from baseline (" +
+                str(result.get("points")) + " points vs " +
+                str(base.get("points")) + ")"))
+
+        if result["ops_per_second"] < base["ops_per_second"] * (1 - threshold):
+            failures.append((name, "ops/second regressed: " +
+                str(result["ops_per_second"]) + " vs " +
+                str(base["ops_per_second"])))
+
+    return failures
+
+def compare_memory(results, baseline, threshold):
+    """
+    Returns a list of (name, message) pairs for each case whose peak memory
+    grew more than threshold over the baseline's, ignoring growth under a
+    megabyte. These are only reported, never failed on, as peak RSS depends on
+    the allocator and the machine as much as on the code.
+    """
+
+    notes = []
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+
+        allowed_rss = max(base["peak_rss_kb"] * (1 + threshold),
+                base["peak_rss_kb"] + 1024)
+        if result["peak_rss_kb"] > allowed_rss:
+            notes.append((name, "peak memory grew: " +
+                str(result["peak_rss_kb"]) + " KB vs " +
+                str(base["peak_rss_kb"]) + " KB"))
+
+    return notes
+
+if __name__ == "__main__":
+    import argparse
+
+    # a single case, in the process started for it below
+    if len(sys.argv) == 4 and sys.argv[1] == "--run":
+        print json.dumps(run_case(sys.argv[2], float(sys.argv[3])))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Benchmark the polygon " +
+            "and tile code that tile enumeration spends its time in.")
+
+    parser.add_argument("cases", nargs="*",
+            help="names of cases to run (default all)")
+    parser.add_argument("-t", "--threshold", type=float, default=0.25,
+            help="fraction slower than the baseline that counts as a " +
+            "regression, or larger that's reported (default 0.25)")
+    parser.add_argument("--min-time", type=float, default=0.5,
+            help="seconds to spend on each timing (default 0.5)")
+    parser.add_argument("-b", "--baseline", type=os.path.abspath,
+            default=BASELINE_FILE,
+            help="results to compare against (default " +
+            "benchmarks/hot_paths_baseline.json)")
+    parser.add_argument("-u", "--update-baseline", action="store_true",
+            default=False,
+            help="write the results to the baseline file instead of " +
+            "comparing against it")
+
+    args = parser.parse_args()
+
+    names = sorted(get_cases().keys())
+    for name in args.cases:
+        if name not in names:
+            parser.error("unknown case: " + repr(name) + " (choose from " +
+                    ", ".join(names) + ")")
+    if len(args.cases) > 0:
+        names = args.cases
+
+    results = {}
+    for name in names:
+        output = subprocess.check_output([sys.executable,
+            os.path.abspath(__file__), "--run", name, str(args.min_time)])
+        results[name] = json.loads(output.splitlines()[-1])
+
+        print (name + ": " + str(results[name]["ops_per_second"]) +
+                " ops/s, " + str(results[name]["peak_rss_kb"]) + " KB peak" +
+                ("" if "points" not in results[name] else
+                    ", " + str(results[name]["points"]) + " points"))
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True,
+                    separators=(",", ": "))
+            f.write("\n")
+
+        print "Updated " + args.baseline
+        sys.exit(0)
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+
+    for name, message in compare_memory(results, baseline, args.threshold):
+        print "NOTE " + name + ": " + message
+
+    failures = compare_results(results, baseline, args.threshold)
+    for name, message in failures:
+        print "FAIL " + name + ": " + message
+
+    sys.exit(1 if len(failures) > 0 else 0)
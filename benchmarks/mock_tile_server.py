@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+import BaseHTTPServer
+import hashlib
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+
+class MockTileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local HTTP server imitating the mt0-mt3 tile servers, for downloading
+    against without a network. Point Tile.URL_TEMPLATE at url_template to use
+    it. Each response waits latency seconds (plus up to jitter more), then
+    sends tile_size bytes no faster than bandwidth bytes per second, if given.
+    A fraction error_rate of requests fail with a 500, and each mirror answers
+    at most throttle_rps requests per second, if given, failing the rest with a
+    503 the way an overloaded server would.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # many downloading threads connect at once, and a full backlog stalls them
+    request_queue_size = 128
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, bandwidth=None,
+            error_rate=0.0, throttle_rps=None, tile_size=20000):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port),
+                MockTileHandler)
+
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.throttle_rps = throttle_rps
+        self.tile_size = tile_size
+
+        # (window start time, requests answered in it) for each mirror
+        self.windows = {}
+
+        # response counts by status code
+        self.statuses = {}
+        self.lock = threading.Lock()
+
+        self.thread = None
+
+    @property
+    def url_template(self):
+        return ("http://127.0.0.1:" + str(self.server_address[1]) +
+                "/vt?mirror=%d&v=%s&x=%s&y=%s&z=%s")
+
+    def start(self):
+        """
+        Serve requests from a background thread.
+        """
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def is_throttled(self, mirror):
+        """
+        Counts a request against a mirror's limit, returning whether it's over.
+        """
+
+        if self.throttle_rps is None:
+            return False
+
+        now = time.time()
+        with self.lock:
+            start, count = self.windows.get(mirror, (now, 0))
+            if now - start >= 1.0:
+                start, count = now, 0
+
+            self.windows[mirror] = (start, count + 1)
+            return count >= self.throttle_rps
+
+    def count_status(self, status):
+        with self.lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def get_tile_data(self, path):
+        """
+        Returns tile_size bytes of PNG-like data, different for every tile.
+        """
+
+        digest = hashlib.sha1(path).digest()
+        body = "\x89PNG\r\n\x1a\n" + digest * (self.tile_size / len(digest) + 1)
+        return body[:max(self.tile_size, 8)]
+
+class MockTileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep connections open like the real servers do
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        args = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        mirror = args.get("mirror", ["0"])[0]
+
+        time.sleep(server.latency + random.random() * server.jitter)
+
+        if server.is_throttled(mirror):
+            return self.send_status(503)
+
+        if random.random() < server.error_rate:
+            return self.send_status(500)
+
+        # tiles are identified by everything but the mirror
+        tile_data = server.get_tile_data(
+                "&".join(k + "=" + args[k][0] for k in sorted(args)
+                    if k != "mirror"))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(tile_data)))
+        self.end_headers()
+
+        # trickle the data out to simulate a slow link
+        if server.bandwidth is None:
+            self.wfile.write(tile_data)
+        else:
+            chunk_size = 4096
+            for i in xrange(0, len(tile_data), chunk_size):
+                chunk = tile_data[i:i + chunk_size]
+                self.wfile.write(chunk)
+                time.sleep(float(len(chunk)) / server.bandwidth)
+
+        server.count_status(200)
+
+    def send_status(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        self.server.count_status(status)
+
+    # don't write every request to stderr
+    def log_message(self, *args):
+        pass
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description="Serve fake map tiles locally for benchmarking.")
+
+    parser.add_argument("-p", "--port", type=int, default=9200,
+            help="port to listen on (default 9200)")
+    parser.add_argument("--latency", type=float, default=0.0,
+            help="seconds to wait before each response (default 0)")
+    parser.add_argument("--jitter", type=float, default=0.0,
+            help="up to this many more seconds to wait, at random (default 0)")
+    parser.add_argument("--bandwidth", type=int, default=None,
+            help="bytes per second to send each response at (default " +
+            "unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+            help="fraction of requests to fail with a 500 (default 0)")
+    parser.add_argument("--throttle-rps", type=int, default=None,
+            help="requests per second each mirror answers before failing " +
+            "with a 503 (default unlimited)")
+    parser.add_argument("--tile-size", type=int, default=20000,
+            help="bytes in each tile (default 20000)")
+
+    args = parser.parse_args()
+
+    server = MockTileServer(args.port, args.latency, args.jitter,
+            args.bandwidth, args.error_rate, args.throttle_rps, args.tile_size)
+
+    print "Serving tiles at " + server.url_template
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
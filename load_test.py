@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import random
+import threading
+import time
+import urllib2
+
+def run_load_test(url, tile_type_v, zoom, bbox, num_clients, duration):
+    """
+    Requests random tiles within bbox, an inclusive (x_min, y_min, x_max,
+    y_max) tuple of tile coordinates at the given zoom, from the tile server at
+    url using num_clients concurrent clients for duration seconds. Each client
+    waits for its response before sending its next request. Returns a dict of
+    the request count, requests per second, status code counts, and latency
+    percentiles in milliseconds.
+    """
+
+    x_min, y_min, x_max, y_max = bbox
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    stop_time = time.time() + duration
+
+    def run_client():
+        # keep our own results, so clients don't contend for the lock
+        client_latencies = []
+        client_statuses = {}
+
+        while time.time() < stop_time:
+            tile_url = (url.rstrip("/") + "/" + tile_type_v +
+                    "?x=" + str(random.randint(x_min, x_max)) +
+                    "&y=" + str(random.randint(y_min, y_max)) +
+                    "&zoom=" + str(zoom))
+
+            start = time.time()
+            try:
+                response = urllib2.urlopen(tile_url)
+                response.read()
+                status = response.getcode()
+            except urllib2.HTTPError, e:
+                status = e.code
+            except Exception, e:
+                status = "error"
+
+            client_latencies.append(time.time() - start)
+            client_statuses[status] = client_statuses.get(status, 0) + 1
+
+        with lock:
+            latencies.extend(client_latencies)
+            for status, count in client_statuses.iteritems():
+                statuses[status] = statuses.get(status, 0) + count
+
+    start = time.time()
+
+    threads = []
+    for i in xrange(num_clients):
+        thread = threading.Thread(target=run_client)
+        thread.daemon = True
+        threads.append(thread)
+        thread.start()
+
+    [thread.join() for thread in threads]
+
+    elapsed = time.time() - start
+    latencies.sort()
+
+    def percentile(p):
+        if len(latencies) == 0:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * p / 100.0))
+        return round(latencies[index] * 1000, 2)
+
+    return {
+        "requests": len(latencies),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "statuses": statuses,
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+    }
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+            description="Measure the throughput of a running tile server.")
+
+    parser.add_argument("-u", "--url", default="http://127.0.0.1:9000",
+            help="base URL of the tile server (default " +
+            "http://127.0.0.1:9000)")
+    parser.add_argument("-t", "--tile-type", default="m",
+            help="the 'v' value of the tile type to request (default m)")
+    parser.add_argument("-z", "--zoom", type=int, default=18,
+            help="zoom level of the requested tiles (default 18)")
+    parser.add_argument("-b", "--bbox", type=int, nargs=4,
+            default=[59902, 107915, 59906, 107919],
+            metavar=("X_MIN", "Y_MIN", "X_MAX", "Y_MAX"),
+            help="inclusive range of tiles to request (default the UT " +
+            "campus at zoom 18)")
+    parser.add_argument("-c", "--clients", type=int, default=16,
+            help="number of concurrent clients (default 16)")
+    parser.add_argument("-d", "--duration", type=float, default=10,
+            help="seconds to run for (default 10)")
+
+    args = parser.parse_args()
+
+    if args.clients < 1:
+        parser.error("argument -c/--clients: invalid client count: " +
+                repr(args.clients) + " (must be >= 1)")
+
+    results = run_load_test(args.url, args.tile_type, args.zoom, args.bbox,
+            args.clients, args.duration)
+    results["clients"] = args.clients
+
+    print json.dumps(results, indent=2, sort_keys=True)
@@ -1,111 +1,525 @@
 #!/usr/bin/env python
 
-from collections import namedtuple, defaultdict
-from math import pi, atan, exp, sin, log
+from collections import namedtuple, defaultdict, deque
+from math import pi, atan, exp, sin, cos, log, ceil, floor
+import array
+import BaseHTTPServer
+import bisect
+import cProfile
+import errno
+import hashlib
+import heapq
+import json
+import mmap
 import os
 import itertools
+import multiprocessing
+import pstats
 import Queue as queue
 import random
+import re
+import struct
+import sys
+import tempfile
 import threading
 import time
 import urllib2
+import urlparse
+import zlib
 
 import pymongo
 import bson
 
+# scandir streams a directory's entries rather than listing them all at once.
+# it's built into newer Pythons and available as a package for older ones.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 def download_area(tile_type, vertices, tile_store, zoom_levels, num_threads=10,
-        logger=None, skip_to_tile=None):
+        logger=None, skip_to_tile=None, num_writers=1, metrics=None,
+        tracer=None, num_processes=0, simplify_tolerance=0,
+        coverage_cache=None):
     """
     Download tiles formed from the area described by the given tile vertices.
     vertices should be an in-order list of tiles describing the sequential
     vertices of a non-complex polygon, preferrably with accurate Mercator
     coordinates (these translate between zoom levels best). zoom_levels is a
     list of zoom levels to download. If skip_to_tile is non-None, all preceding
-    tiles not equal to the given tile will be skipped. See download() for an
-    explanation of the other parameters.
+    tiles not equal to the given tile will be skipped. If num_processes is more
+    than 0, the area is rasterized by a pool of that many processes. If
+    simplify_tolerance is more than 0, the polygon is simplified at each zoom
+    level by dropping vertices that lie within that many tiles of the outline
+    that remains. If coverage_cache is a CoverageCache, the area's tiles at
+    each zoom level are read from it if they're there, and stored in it if
+    not. See download_tiles() for an explanation of the other parameters.
     """
 
-    # check our thread count to make sure we'll get workers
-    if num_threads <= 0:
-        raise ValueError("num_threads must be greater than 0")
+    download_areas(tile_type, [[vertices]], tile_store, zoom_levels,
+            num_threads=num_threads, logger=logger, skip_to_tile=skip_to_tile,
+            num_writers=num_writers, metrics=metrics, tracer=tracer,
+            num_processes=num_processes,
+            simplify_tolerance=simplify_tolerance,
+            coverage_cache=coverage_cache)
+
+def download_areas(tile_type, polygons, tile_store, zoom_levels,
+        num_threads=10, logger=None, skip_to_tile=None, num_writers=1,
+        metrics=None, tracer=None, num_processes=0, simplify_tolerance=0,
+        coverage_cache=None):
+    """
+    Downloads the tiles in the union of several areas, so tiles where they
+    overlap or border each other are only downloaded once. polygons is a list of
+    polygons, each a list of rings of tile vertices: an outline like the
+    vertices download_area() takes, followed by any holes in it. See
+    download_area() for an explanation of the other parameters.
+    """
 
     # use a default logger if none was specified
     logger = __get_null_logger() if logger is None else logger
 
-    tile_queue = queue.Queue(num_threads * 10)
-    halt_event = threading.Event()
+    tiles = generate_areas_tiles(polygons, zoom_levels, skip_to_tile, logger,
+            num_processes, simplify_tolerance, coverage_cache)
+    download_tiles(tile_type, tiles, tile_store, num_threads=num_threads,
+            logger=logger, num_writers=num_writers, metrics=metrics,
+            tracer=tracer)
 
-    threads = []
-    for i in xrange(num_threads):
-        args = (tile_type, tile_queue, tile_store, 0.1, 10, halt_event, logger)
-        thread = threading.Thread(target=__download_tiles_from_queue, args=args)
-        thread.daemon = True
-        threads.append(thread)
-        thread.start()
+def generate_area_tiles(vertices, zoom_levels, skip_to_tile=None, logger=None,
+        num_processes=0, simplify_tolerance=0, coverage_cache=None):
+    """
+    Yields all the tiles in the area described by the given tile vertices at
+    each of the given zoom levels in turn. See download_area() for an
+    explanation of the parameters.
+    """
+
+    return generate_areas_tiles([[vertices]], zoom_levels, skip_to_tile,
+            logger, num_processes, simplify_tolerance, coverage_cache)
+
+def generate_areas_tiles(polygons, zoom_levels, skip_to_tile=None, logger=None,
+        num_processes=0, simplify_tolerance=0, coverage_cache=None):
+    """
+    Yields every tile in the union of the areas described by the given polygons
+    at each of the given zoom levels in turn, each tile once. See
+    download_areas() for an explanation of the parameters.
+    """
+
+    def generate_spans(zoom):
+        return __generate_zoom_spans(polygons, zoom, num_processes,
+                simplify_tolerance, logger, coverage_cache)
+
+    return __generate_zoom_tiles(zoom_levels, generate_spans, skip_to_tile,
+            logger)
+
+def download_areas_update(tile_type, polygons, old_polygons, tile_store,
+        zoom_levels, removed_file=None, delete_removed=False, num_threads=10,
+        logger=None, skip_to_tile=None, num_writers=1, metrics=None,
+        tracer=None, num_processes=0, simplify_tolerance=0,
+        coverage_cache=None):
+    """
+    Downloads the tiles a revision of some areas added, so only the tiles in
+    polygons that weren't already in old_polygons are downloaded. If
+    removed_file is given, the tiles in old_polygons that aren't in polygons
+    any more are written to it as a tile list, and if delete_removed is True,
+    they're deleted from the tile store. See download_areas() for an
+    explanation of the other parameters.
+    """
+
+    # use a default logger if none was specified
+    logger = __get_null_logger() if logger is None else logger
+
+    tiles = generate_areas_difference_tiles(polygons, old_polygons,
+            zoom_levels, skip_to_tile, logger, num_processes,
+            simplify_tolerance, coverage_cache)
+    download_tiles(tile_type, tiles, tile_store, num_threads=num_threads,
+            logger=logger, num_writers=num_writers, metrics=metrics,
+            tracer=tracer)
+
+    if removed_file is None and not delete_removed:
+        return
+
+    # the removed tiles are those the old areas add to the new ones
+    removed = ((tile_type, tile) for tile in generate_areas_difference_tiles(
+        old_polygons, polygons, zoom_levels, logger=logger,
+        num_processes=num_processes, simplify_tolerance=simplify_tolerance,
+        coverage_cache=coverage_cache))
+
+    # write the list first, so it's complete even if deleting fails
+    if removed_file is not None:
+        write_tile_list(removed_file, removed)
+        logger.info("Wrote removed tiles to %s", removed_file)
+        removed = parse_tile_list(removed_file)
+
+    if delete_removed:
+        num_deleted = 0
+        for removed_type, tile in removed:
+            if tile_store.delete(removed_type, tile):
+                num_deleted += 1
+        logger.info("Deleted %d removed tiles", num_deleted)
+
+def generate_areas_difference_tiles(polygons, old_polygons, zoom_levels,
+        skip_to_tile=None, logger=None, num_processes=0, simplify_tolerance=0,
+        coverage_cache=None):
+    """
+    Yields every tile in the union of the areas described by polygons that isn't
+    in the union of those described by old_polygons, at each of the given zoom
+    levels in turn. Only the old areas are held in memory, as spans, and the new
+    ones are streamed past them, so the number of tiles enumerated depends on
+    the area that changed. See download_areas() for an explanation of the
+    other parameters.
+    """
+
+    def generate_spans(zoom):
+        old = Coverage(zoom)
+        for span in __generate_zoom_spans(old_polygons, zoom, num_processes,
+                simplify_tolerance, logger, coverage_cache):
+            old.add_span(*span)
+
+        return old.generate_uncovered_spans(__generate_zoom_spans(polygons,
+            zoom, num_processes, simplify_tolerance, logger, coverage_cache))
+
+    return __generate_zoom_tiles(zoom_levels, generate_spans, skip_to_tile,
+            logger)
+
+def __generate_zoom_spans(polygons, zoom, num_processes=0,
+        simplify_tolerance=0, logger=None, coverage_cache=None):
+    """
+    Generates the spans of the union of the given polygons of tile vertices at
+    a zoom level. See download_areas() for an explanation of the parameters.
+    """
+
+    # skip the geometry entirely if we've done it before
+    if coverage_cache is not None:
+        key = CoverageCache.get_key(polygons, zoom, simplify_tolerance)
+        spans = coverage_cache.load(key)
+        if spans is not None:
+            if logger is not None:
+                logger.debug("Read zoom level %d from the coverage cache", zoom)
+            return spans
+
+    # translate every ring to the given zoom level
+    zoomed_polygons = [
+            [__get_zoom_points(ring, zoom, simplify_tolerance, logger)
+                for ring in polygon]
+            for polygon in polygons]
+
+    # get the area for the points
+    spans = generate_union_spans(zoomed_polygons, num_processes)
+
+    if coverage_cache is not None:
+        spans = coverage_cache.generate_stored(key, spans)
+
+    return spans
+
+def __generate_zoom_tiles(zoom_levels, generate_spans, skip_to_tile=None,
+        logger=None):
+    """
+    Yields the tiles in the (y, x_first, x_last) spans returned by calling
+    generate_spans with each of the given zoom levels in turn. See
+    download_area() for an explanation of the other parameters.
+    """
+
+    # use a default logger if none was specified
+    logger = __get_null_logger() if logger is None else logger
 
     # whether we should skip tiles
     should_skip = skip_to_tile is not None
 
     # log that we're skipping, so it doesn't look like we froze
     if should_skip:
-        logger.info("Skipping to " + str(skip_to_tile) + "...")
+        logger.info("Skipping to %s...", skip_to_tile)
 
     for zoom in zoom_levels:
         # skip entire zoom levels if necessary to find the first non-skip tile
         if should_skip and skip_to_tile.zoom != zoom:
-            logger.debug("Skipping zoom level " + str(zoom))
+            logger.debug("Skipping zoom level %d", zoom)
             continue
 
-        logger.info("Downloading zoom level " + str(zoom))
-
-        # translate vertices to the given zoom level, then to coordinate pairs
-        points = []
-        for v in vertices:
-            zoomed_v = Tile.from_mercator(v.latitude, v.longitude, zoom)
-            points.append((zoomed_v.x, zoomed_v.y))
-
-        # get the area for the points
-        area = Polygon.generate_area(points)
+        logger.info("Downloading zoom level %d", zoom)
 
-        # track tile download rate
-        rate_calculator = RateCalculator(1000, 15)
-        rate_calculator.start()
+        spans = generate_spans(zoom)
 
-        # convert points back into tiles and feed them to the queue
-        for tile in (Tile.from_google(p[0], p[1], zoom) for p in area):
+        # convert points back into tiles
+        for tile in (Tile.from_google(x, y, zoom)
+                for y, x_first, x_last in spans
+                for x in xrange(x_first, x_last + 1)):
             # skip to the specified tile if necessary
             if should_skip:
                 # disable skipping once we find the specified tile
                 if (tile.x == skip_to_tile.x and
                         tile.y == skip_to_tile.y and
                         tile.zoom == skip_to_tile.zoom):
-                    logger.info("Skipped to tile " + str(tile))
+                    logger.info("Skipped to tile %s", tile)
                     should_skip = False
-
-                    # reset to start time if we were skipping
-                    rate_calculator.reset()
-                    rate_calculator.start()
                 else:
                     # otherwise, skip tiles that don't match
-                    logger.debug("Skipping " + str(tile))
+                    logger.debug("Skipping %s", tile)
                     continue
 
-            while 1:
-                try:
-                    logger.debug("Adding " + str(tile) + " to queue")
-                    tile_queue.put(tile, True, 0.1)
-                    break
-                except queue.Full:
-                    logger.debug("Queue full, retrying 'put' for " + str(tile))
-                    continue
+            yield tile
+
+def __get_zoom_points(vertices, zoom, simplify_tolerance=0, logger=None):
+    """
+    Translates a list of tile vertices to a list of (x, y) points at the given
+    zoom level, simplifying them if simplify_tolerance is more than 0.
+    """
+
+    # translate vertices to the given zoom level, then to coordinate pairs
+    points = []
+    for v in vertices:
+        zoomed_v = Tile.from_mercator(v.latitude, v.longitude, zoom)
+        points.append((zoomed_v.x, zoomed_v.y))
+
+    # most vertices of a detailed outline don't matter at low zoom levels
+    if simplify_tolerance > 0:
+        simplified = Polygon.simplify(points, simplify_tolerance)
+        if logger is not None:
+            logger.debug("Simplified %d vertices to %d", len(points),
+                    len(simplified))
+        points = simplified
+
+    return points
+
+def generate_union_spans(polygons, num_processes=0):
+    """
+    Generates the (y, x_first, x_last) spans of the union of the rasterized
+    polygons, top to bottom and left to right, with no span overlapping or
+    touching another. Each polygon is a list of rings of (x, y) vertices, the
+    first being its outline and any others its holes. Tiles on the edge of a
+    hole are kept, since they're partly inside the area. A lone polygon without
+    holes is streamed straight from the rasterizer; otherwise the union is built
+    as a Coverage first, so memory use depends on the number of spans rather
+    than tiles. See generate_area_spans() for num_processes.
+    """
+
+    if len(polygons) == 1 and len(polygons[0]) == 1:
+        for span in generate_area_spans(polygons[0][0], num_processes):
+            yield span
+        return
+
+    # the zoom level is irrelevant, since we only want spans back out
+    union = Coverage(None)
+    for polygon in polygons:
+        if len(polygon) == 0:
+            continue
+
+        # bands can come back in any order, since the coverage sorts them
+        area = union if len(polygon) == 1 else Coverage(None)
+        for span in generate_area_spans(polygon[0], num_processes,
+                ordered=False):
+            area.add_span(*span)
+
+        # cut the holes out of this polygon alone, so they can't remove any of
+        # the other polygons' areas.
+        if area is not union:
+            for hole in polygon[1:]:
+                for span in generate_area_spans(hole, num_processes,
+                        ordered=False):
+                    area.remove_span(*span)
+
+            for hole in polygon[1:]:
+                for a, b in Polygon.generate_vertex_pairs(hole):
+                    for x, y in Polygon.generate_line(a, b):
+                        area.add(x, y)
+
+            union.update(area)
+
+    for span in union.generate_spans():
+        yield span
+
+def download_corridor(tile_type, lines, tile_store, zoom_levels, distance,
+        in_metres=False, num_threads=10, logger=None, skip_to_tile=None,
+        num_writers=1, metrics=None, tracer=None):
+    """
+    Downloads the tiles within some distance of a route, rather than those in an
+    area. lines is a list of polylines, each an in-order list of tile vertices,
+    and distance is how far from them tiles are downloaded, in tiles at each
+    zoom level or, if in_metres is True, in metres on the ground. See
+    download_area() for an explanation of the other parameters.
+    """
+
+    # use a default logger if none was specified
+    logger = __get_null_logger() if logger is None else logger
+
+    tiles = generate_corridor_tiles(lines, zoom_levels, distance, in_metres,
+            skip_to_tile, logger)
+    download_tiles(tile_type, tiles, tile_store, num_threads=num_threads,
+            logger=logger, num_writers=num_writers, metrics=metrics,
+            tracer=tracer)
+
+def generate_corridor_tiles(lines, zoom_levels, distance, in_metres=False,
+        skip_to_tile=None, logger=None):
+    """
+    Yields every tile within some distance of the given polylines at each of the
+    given zoom levels in turn, each tile once. See download_corridor() for an
+    explanation of the parameters.
+    """
+
+    def generate_spans(zoom):
+        segments = []
+        for line in lines:
+            points = __get_zoom_points(line, zoom)
+
+            # a lone vertex is a segment with no length, i.e. a disc of tiles
+            step = 1 if len(line) > 1 else 0
+            for i in xrange(len(line) - step):
+                radius = distance
+                if in_metres:
+                    # scale varies with latitude, so use the segment's middle
+                    v, w = line[i], line[i + step]
+                    latitude = (v.latitude + w.latitude) / 2.0
+                    radius = distance / get_metres_per_tile(latitude, zoom)
+                segments.append((points[i], points[i + step], radius))
+
+        return generate_corridor_spans(segments)
+
+    return __generate_zoom_tiles(zoom_levels, generate_spans, skip_to_tile,
+            logger)
+
+def generate_corridor_spans(segments):
+    """
+    Generates the (y, x_first, x_last) spans of the points within some distance
+    of any of a list of line segments, given as (a, b, radius) triples of (x, y)
+    endpoints and a distance in tiles, top to bottom and left to right. The
+    points on each segment's line are always included, however small its radius.
+    """
+
+    corridor = Coverage(None)
+    for a, b, radius in segments:
+        for span in Polygon.generate_capsule_spans(a, b, radius):
+            corridor.add_span(*span)
+
+        for x, y in Polygon.generate_line(a, b):
+            corridor.add(x, y)
+
+    return corridor.generate_spans()
+
+def get_metres_per_tile(latitude, zoom):
+    """
+    Returns the width on the ground of a tile at the given latitude and zoom.
+    """
+
+    return EARTH_CIRCUMFERENCE * cos(latitude * pi / 180) / (2 ** zoom)
+
+# the circumference of the earth at the equator, in metres
+EARTH_CIRCUMFERENCE = 40075016.686
+
+def generate_area_spans(vertices, num_processes=0, ordered=True):
+    """
+    Generates the (y, x_first, x_last) spans of the rasterized polygon described
+    by a list of (x, y) vertices, as Polygon.generate_spans() does. If
+    num_processes is more than 0, the polygon's rows are split into bands that
+    are rasterized by a pool of that many processes, which send back their
+    spans as flat arrays rather than pickled tuples. Bands are yielded top to
+    bottom if ordered is True, otherwise as soon as they're done.
+    """
+
+    if num_processes <= 0 or len(vertices) == 0:
+        for span in Polygon.generate_spans(vertices):
+            yield span
+        return
+
+    # several bands per process, so uneven bands still spread the work out
+    bounds = Polygon.get_bounds(*vertices)
+    top, bottom = bounds.top[1], bounds.bottom[1]
+    num_bands = num_processes * BANDS_PER_PROCESS
+    band_height = max(MIN_BAND_HEIGHT,
+            (bottom - top + num_bands) // num_bands)
+
+    bands = [(vertices, y, min(y + band_height - 1, bottom))
+            for y in xrange(top, bottom + 1, band_height)]
+
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        rasterize = pool.imap if ordered else pool.imap_unordered
+        for band_spans in rasterize(__rasterize_band, bands):
+            spans = array.array("l")
+            spans.fromstring(band_spans)
+            for i in xrange(0, len(spans), 3):
+                yield (spans[i], spans[i + 1], spans[i + 2])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# how many bands each process rasterizes, and the fewest rows worth sending one
+BANDS_PER_PROCESS = 4
+MIN_BAND_HEIGHT = 16
+
+def __rasterize_band(band):
+    """
+    Rasterizes the rows of a polygon in a band, given as a (vertices, y_first,
+    y_last) triple, and returns its spans as the bytes of a flat array.
+    """
+
+    vertices, y_first, y_last = band
+
+    spans = array.array("l")
+    for span in Polygon.generate_spans(vertices, y_first, y_last):
+        spans.extend(span)
+    return spans.tostring()
+
+def download_tiles(tile_type, tiles, tile_store, num_threads=10, logger=None,
+        num_writers=1, metrics=None, tracer=None):
+    """
+    Downloads the given tiles and stores them in the tile store. tiles may be
+    any iterable of tiles, and is consumed lazily as downloading threads become
+    free. num_threads is the number of downloading threads. num_writers is the
+    number of StoreWriter threads that store downloaded tiles; if 0, each
+    downloading thread stores its own tiles as soon as they're downloaded.
+    Progress is recorded in metrics, a Metrics registry, if given, and each
+    tile's stages are timed by tracer, a Tracer, if given.
+    """
+
+    # check our thread count to make sure we'll get workers
+    if num_threads <= 0:
+        raise ValueError("num_threads must be greater than 0")
+
+    # use a default logger if none was specified
+    logger = __get_null_logger() if logger is None else logger
+
+    metrics = Metrics() if metrics is None else metrics
+
+    tile_queue = queue.Queue(num_threads * 10)
+    halt_event = threading.Event()
+
+    # decouple storing tiles from downloading them
+    tile_writer = StoreWriter(num_writers, logger=logger, metrics=metrics,
+            tracer=tracer)
+
+    metrics.track_gauge("mapper_queue_depth", tile_queue.qsize,
+            stage="download")
+    metrics.track_gauge("mapper_queue_depth", tile_writer.depth, stage="store")
+
+    threads = []
+    for i in xrange(num_threads):
+        args = (tile_type, tile_queue, tile_store, tile_writer, 0.1, 10,
+                halt_event, logger, metrics, tracer)
+        thread = threading.Thread(target=__download_tiles_from_queue, args=args)
+        thread.daemon = True
+        threads.append(thread)
+        thread.start()
 
-            # count enqueuing the tile towards the download rate
-            rate_calculator.tock()
+    # log the download rate as tiles are completed
+    reporter = MetricsReporter(metrics, 1.0, logger=logger)
+    reporter.start()
 
-            ave_rate = rate_calculator.tick()
-            if ave_rate is not None:
-                logger.info("Download rate (tiles/second): " + str(ave_rate))
+    if tracer is not None:
+        tiles = tracer.trace_enumeration(tiles)
 
+    # feed the tiles to the queue, with the time they were queued if tracing
+    for tile in tiles:
+        item = (tile, None if tracer is None else time.time())
+        while 1:
+            try:
+                logger.debug("Adding %s to queue", tile)
+                tile_queue.put(item, True, 0.1)
+                break
+            except queue.Full:
+                logger.debug("Queue full, retrying 'put' for %s", tile)
+                continue
 
     logger.debug("Telling queue processing has stopped...")
     tile_queue.join()
@@ -118,15 +532,24 @@ def download_area(tile_type, vertices, tile_store, zoom_levels, num_threads=10,
     [thread.join() for thread in threads]
     logger.debug("Downloader threads joined")
 
-def __download_tiles_from_queue(tile_type, tile_queue, tile_store, timeout,
-        max_failures, halt_event, logger=None):
+    logger.debug("Flushing store writer...")
+    tile_writer.close()
+    logger.debug("Store writer flushed")
+
+    reporter.stop()
+
+def __download_tiles_from_queue(tile_type, tile_queue, tile_store, tile_writer,
+        timeout, max_failures, halt_event, logger=None, metrics=None,
+        tracer=None):
     """
-    Downloads all the tiles in a queue for some type and stores them in the tile
-    store. Will re-insert failed downloads into the queue for later processing,
-    but only up to max_failures times. timeout specifies the amount of time in
-    seconds downloading threads will wait for new tiles to enter the queue
-    before giving up and ending their download loops. halt_event is an event
-    object indicating whether we should stop downloading.
+    Downloads all the tiles in a queue for some type with download_tile(),
+    which retries each failed download up to max_failures times before giving
+    up on it, then hands it to tile_writer, a StoreWriter, for storage in the
+    tile store. timeout specifies the amount of time in seconds downloading
+    threads will wait for new tiles to enter the queue before checking
+    halt_event again. halt_event is an event object indicating whether we
+    should stop downloading. Downloads are recorded in metrics, a Metrics
+    registry, if given, and timed by tracer, a Tracer, if given.
     """
 
     # downloading won't work if our failure threshold is too low
@@ -134,6 +557,7 @@ def __download_tiles_from_queue(tile_type, tile_queue, tile_store, timeout,
 
     # use a default logger if none was specified
     logger = __get_null_logger() if logger is None else logger
+    metrics = Metrics() if metrics is None else metrics
 
     # get the current thread name for use in log messages
     tname = threading.current_thread().name
@@ -142,41 +566,13 @@ def __download_tiles_from_queue(tile_type, tile_queue, tile_store, timeout,
     while not halt_event.wait(0):
         try:
             # pull a tile from the queue
-            tile = tile_queue.get(True, timeout)
-
-            # retry the tile while it fails to download, up to a maximum
-            fail_count = 0
-            while fail_count < max_failures:
-                try:
-                    # download and store the tile data
-                    logger.debug(tname + " downloading " + str(tile) +
-                            " as " + str(tile_type) + "...")
-
-                    tile_data = tile.download(tile_type)
-                    logger.info("Downloaded " + str(len(tile_data)) + " bytes " +
-                            "for " + str(tile))
-
-                    tile_store.store(tile_type, tile, tile_data)
-
-                    # move on to the next tile if we downloaded successfully
-                    break
-
-                except Tile.TileDownloadError, e:
-                    logger.warning("Download of " + str(tile) +
-                            " failed with message '" + str(e.message) + "'")
+            tile, queued_at = tile_queue.get(True, timeout)
 
-                    # count this failure towards the max
-                    fail_count += 1
+            if tracer is not None:
+                tracer.record("queue", tile, time.time() - queued_at)
 
-            # log whether the download succeeded or failed
-            if fail_count >= max_failures:
-                logger.error("Download of " + str(tile) +
-                    " failed after " + str(max_failures) +
-                    " retry attempt" + str("" if max_failures == 1 else "s"))
-            elif fail_count > 0:
-                logger.info("Took " + str(retry_count) + " retry attempt" +
-                        ("" if retry_count == 1 else "s") + " to download " +
-                        str(tile))
+            download_tile(tile_type, tile, tile_store, tile_writer,
+                    max_failures, logger, metrics, tracer)
 
             # signal that we finished processing this tile
             tile_queue.task_done()
@@ -187,914 +583,5337 @@ def __download_tiles_from_queue(tile_type, tile_queue, tile_store, timeout,
 
     logger.debug(tname + " got halt signal, exiting")
 
+def download_tile(tile_type, tile, tile_store, tile_writer, max_failures=10,
+        logger=None, metrics=None, tracer=None):
+    """
+    Downloads a single tile, retrying up to max_failures times, and hands it to
+    the tile writer, a StoreWriter, for storage in the tile store. Returns
+    whether the tile was downloaded. See __download_tiles_from_queue() for an
+    explanation of the other parameters.
+    """
+
+    # use a default logger if none was specified
+    logger = __get_null_logger() if logger is None else logger
+    metrics = Metrics() if metrics is None else metrics
+
+    # get the current thread name for use in log messages
+    tname = threading.current_thread().name
+
+    # retry the tile while it fails to download, up to a maximum
+    fail_count = 0
+    while fail_count < max_failures:
+        # pick the mirror ourselves so we can time each one
+        mirror = random.randrange(Tile.NUM_MIRRORS)
+        host = "mt" + str(mirror)
+
+        try:
+            # download and store the tile data
+            logger.debug("%s downloading %s as %s...", tname, tile,
+                    tile_type)
+
+            timings = None if tracer is None else {}
+
+            start = time.time()
+            tile_data = tile.download(tile_type, mirror, timings)
+            metrics.observe("mapper_download_seconds",
+                    time.time() - start, mirror=host)
+
+            if tracer is not None:
+                tracer.record("connect", tile, timings["connect"])
+                tracer.record("transfer", tile, timings["transfer"])
+
+            logger.info("Downloaded %d bytes for %s", len(tile_data),
+                    tile)
+
+            metrics.increment("mapper_tiles_downloaded_total")
+            metrics.increment("mapper_bytes_downloaded_total",
+                    len(tile_data))
+
+            tile_writer.put(tile_store, tile_type, tile, tile_data)
+
+            # move on to the next tile if we downloaded successfully
+            break
+
+        except Tile.TileDownloadError, e:
+            logger.warning("Download of %s failed with message '%s'",
+                    tile, e.message)
+            metrics.increment("mapper_download_errors_total",
+                    mirror=host)
+
+            # count this failure towards the max
+            fail_count += 1
+            if fail_count < max_failures:
+                metrics.increment("mapper_download_retries_total")
+
+    # log whether the download succeeded or failed
+    if fail_count >= max_failures:
+        logger.error("Download of %s failed after %d retry attempt%s",
+                tile, max_failures, "" if max_failures == 1 else "s")
+        metrics.increment("mapper_tiles_failed_total")
+        return False
+
+    if fail_count > 0:
+        logger.info("Took %d retry attempt%s to download %s",
+                fail_count, "" if fail_count == 1 else "s", tile)
+
+    return True
+
 def parse_shape_file(shape_file):
     """
-    Parses a shape file and returns a list of coordinates as tiles.
+    Parses a shape file and returns a list of coordinates as tiles. See
+    generate_shape_coords() for the formats understood.
+    """
 
-    Files are expected to be in the format:
+    return [Tile.from_mercator(lat, lng, 0)
+            for lat, lng in generate_shape_coords(shape_file)]
+
+def generate_shape_coords(shape_file):
+    """
+    Yields the (latitude, longitude) vertices of the polygon in a shape file.
+    Files are either GeoJSON, in which case the outer ring of the first polygon
+    found is used, or in the format written by the area selector, which is read
+    a line at a time:
       (<latitude_float0>, <longitude_float0>)\n
       (<latitude_float1>, <longitude_float1>)\n
       ...
       (<latitude_floatN>, <longitude_floatN>)\n
     """
 
-    coords = []
     with open(shape_file, "r") as sf:
-        for line in sf:
-            # strip whitespace and parens, split by comma
-            lat, lng = line.strip().strip("()").split(",")
+        # GeoJSON files are objects, which no line of the other format starts
+        # with. the json module can't stream, so these are read all at once.
+        first_line = sf.readline()
+        if first_line.lstrip().startswith("{"):
+            sf.seek(0)
+            polygons = get_geojson_polygons(json.load(sf))
+            if len(polygons) == 0:
+                raise ValueError("No polygons found in " + repr(shape_file))
+
+            for lat, lng in polygons[0][0]:
+                yield (lat, lng)
+            return
 
-            # strip remaining whitespace, cast to float, make tuple
-            coords.append(Tile.from_mercator(float(lat), float(lng), 0))
+        for line in itertools.chain([first_line], sf):
+            # skip blank lines, like the one a file might end with
+            line = line.strip()
+            if len(line) == 0:
+                continue
 
-    return coords
+            # strip parens, split by comma, and cast to float
+            lat, lng = line.strip("()").split(",")
+            yield (float(lat), float(lng))
 
-def __get_null_logger():
+def parse_shape_polygons(shape_file):
     """
-    Creates a logging.Logger-like object with debug(), info(), warning(),
-    error(), and critical() methods that soak up all log messages passed to
-    them. Returns the logger object.
+    Parses a shape file and returns every polygon in it as a list of rings of
+    tiles, the first ring being the polygon's outline and any others its holes.
+    Only GeoJSON files may have more than one polygon or any holes, and files in
+    the area selector's format are read as parse_shape_file() reads them.
     """
 
-    class NullLogger: pass
-    null_logger = NullLogger()
-
-    do_nothing = lambda *args, **kwargs: None
+    geojson = __read_geojson(shape_file)
+    if geojson is None:
+        return [[parse_shape_file(shape_file)]]
 
-    null_logger.debug = do_nothing
-    null_logger.info = do_nothing
-    null_logger.warning = do_nothing
-    null_logger.error = do_nothing
-    null_logger.critical = do_nothing
+    polygons = get_geojson_polygons(geojson)
+    if len(polygons) == 0:
+        raise ValueError("No polygons found in " + repr(shape_file))
 
-    return null_logger
+    return [[[Tile.from_mercator(lat, lng, 0) for lat, lng in ring]
+                for ring in polygon]
+            for polygon in polygons]
 
-class Tile:
+def parse_shape_lines(shape_file):
     """
-    A tile representing both Mercator and Google Maps versions of the same info,
-    a point/tile on the globe. This is not meant to be mutable, and is only a
-    container for the values initially supplied. Changing values after
-    initialization will NOT update other values!
-
-    Conversion formulae gleaned from Jeremy R. Geerdes' post:
-      http://groups.google.com/group/google-maps-api/msg/7a0aba451045ed94
+    Parses a shape file describing a route and returns every polyline in it as a
+    list of tiles. Only GeoJSON files may have more than one line, and the
+    vertices of files in the area selector's format are read as a single line.
     """
 
-    # raised when we couldn't download a tile
-    class TileDownloadError(Exception): pass
+    geojson = __read_geojson(shape_file)
+    if geojson is None:
+        return [parse_shape_file(shape_file)]
 
-    # a simple class for tile types with a descriptive name and a URL 'v' value
-    TileType = namedtuple("TileType", ["name", "v"])
+    lines = get_geojson_lines(geojson)
+    if len(lines) == 0:
+        raise ValueError("No lines found in " + repr(shape_file))
 
-    # possible kinds of tile for initialization
-    KIND_GOOGLE = "google"
-    KIND_MERCATOR = "mercator"
+    return [[Tile.from_mercator(lat, lng, 0) for lat, lng in line]
+            for line in lines]
 
-    # our various tile types
-    TYPE_BIKE = TileType("bike", "r")
-    TYPE_MAP = TileType("map", "m")
-    TYPE_OVERLAY = TileType("overlay", "h")
-    TYPE_SATELLITE = TileType("satellite", "y")
-    TYPE_SATELLITE_PLAIN = TileType("satellite_plain", "s")
-    TYPE_TERRAIN = TileType("terrain", "p")
-    TYPE_TERRAIN_PLAIN = TileType("terrain_plain", "t")
+def __read_geojson(shape_file):
+    """
+    Returns the parsed contents of a GeoJSON shape file, or None if the file is
+    in the area selector's format instead.
+    """
 
-    # the default size of square tiles
-    DEFAULT_TILE_SIZE = 256
+    with open(shape_file, "r") as sf:
+        if not sf.readline().lstrip().startswith("{"):
+            return None
 
-    # a URL template for downloading the tile from Google
-    URL_TEMPLATE = "http://mt%d.google.com/vt?v=%s&x=%s&y=%s&z=%s"
+        sf.seek(0)
+        return json.load(sf)
 
-    def __init__(self, kind, a, b, zoom, tile_size):
-        """
-        This should only really be called by the static constructor methods. a
-        and b take on either x/y or latitude/longitude depending on the kind of
-        tile this will be. The other kind's values are filled dynamically from
-        the given kind. If a Google tile is being created, the
-        latitude/longitude are set to the upper-left corner of the given tile's
-        x and y values.
-        """
+def get_geojson_polygons(geojson):
+    """
+    Returns the polygons in a parsed GeoJSON object, which may be a geometry, a
+    feature, or a feature collection. Each polygon is a list of rings, the
+    first being its outline and any others its holes, and each ring is a list
+    of (latitude, longitude) pairs without the closing repeat of the first.
+    """
 
-        # update internal values from the given information
-        if kind == Tile.KIND_MERCATOR:
-            self.init_from_mercator(a, b, zoom, tile_size)
-        elif kind == Tile.KIND_GOOGLE:
-            self.init_from_google(a, b, zoom, tile_size)
-        else:
-            raise ValueError("Unrecognized tile kind: " + kind)
+    def get_rings(coordinates):
+        rings = []
+        for ring in coordinates:
+            # GeoJSON puts longitude first, and repeats the first position last
+            ring = [(lat, lng) for lng, lat in (p[:2] for p in ring)]
+            if len(ring) > 1 and ring[0] == ring[-1]:
+                ring.pop()
+            rings.append(ring)
+        return rings
+
+    polygons = []
+    for geometry in generate_geojson_geometries(geojson):
+        if geometry["type"] == "Polygon":
+            polygons.append(get_rings(geometry["coordinates"]))
+        elif geometry["type"] == "MultiPolygon":
+            polygons.extend(get_rings(polygon)
+                    for polygon in geometry["coordinates"])
+
+    # points and lines have no area
+    return polygons
+
+def get_geojson_lines(geojson):
+    """
+    Returns the lines in a parsed GeoJSON object, as get_geojson_polygons()
+    does for polygons. Each line is a list of (latitude, longitude) pairs.
+    """
 
-    def init_from_mercator(self, latitude, longitude, zoom, tile_size):
-        """
-        Initializes this tile from a latitude, longitude, zoom, and tile size.
-        """
+    def get_line(coordinates):
+        return [(lat, lng) for lng, lat in (p[:2] for p in coordinates)]
 
-        # zoom must be positive
-        assert zoom >= 0
+    lines = []
+    for geometry in generate_geojson_geometries(geojson):
+        if geometry["type"] == "LineString":
+            lines.append(get_line(geometry["coordinates"]))
+        elif geometry["type"] == "MultiLineString":
+            lines.extend(get_line(line) for line in geometry["coordinates"])
 
-        # shared by both kinds of tile
-        self.zoom = zoom
+    return lines
 
-        # kept for reference, the size of this tile in pixels
-        self.tile_size = tile_size
+def generate_geojson_geometries(geojson):
+    """
+    Yields every geometry in a parsed GeoJSON object, looking inside features,
+    feature collections, and geometry collections.
+    """
 
-        self.latitude = latitude
-        self.longitude = longitude
+    kind = geojson.get("type")
+    if kind == "FeatureCollection":
+        children = geojson.get("features", [])
+    elif kind == "Feature":
+        children = [geojson["geometry"]] if geojson.get("geometry") else []
+    elif kind == "GeometryCollection":
+        children = geojson.get("geometries", [])
+    else:
+        children = None
+
+    if children is None:
+        if kind is not None:
+            yield geojson
+        return
+
+    for child in children:
+        for geometry in generate_geojson_geometries(child):
+            yield geometry
+
+def write_tile_list(tile_list_file, tiles_by_type):
+    """
+    Writes tiles to a compact tile list file, as read by parse_tile_list().
+    tiles_by_type is an iterable of (tile_type, tile) pairs. Tiles are sorted,
+    and runs of horizontally adjacent tiles are written as a single line in
+    the format:
+      <tile type v> <zoom> <y> <first x> <last x>\n
+    """
 
-        # calculate x and y coords from latitude and longitude
-        lat = latitude
-        lng = longitude
+    keys = sorted(set((t.v, tile.zoom, tile.y, tile.x)
+        for t, tile in tiles_by_type))
 
-        # absolute pixel coordinates
+    with open(tile_list_file, "w") as f:
+        f.write("# " + TILE_LIST_HEADER + "\n")
+
+        run = None
+        for v, zoom, y, x in keys:
+            # extend the current run if this tile continues it
+            if run is not None and run[:3] == [v, zoom, y] and run[4] == x - 1:
+                run[4] = x
+                continue
+
+            if run is not None:
+                f.write(" ".join(map(str, run)) + "\n")
+            run = [v, zoom, y, x, x]
+
+        if run is not None:
+            f.write(" ".join(map(str, run)) + "\n")
+
+def parse_tile_list(tile_list_file):
+    """
+    Yields (tile_type, tile) pairs from a tile list file written by
+    write_tile_list(), in the order they appear in the file.
+    """
+
+    with open(tile_list_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+
+            v, zoom, y, x_first, x_last = line.split()
+            tile_type = Tile.get_type(v)
+            for x in xrange(int(x_first), int(x_last) + 1):
+                yield tile_type, Tile.from_google(x, int(y), int(zoom))
+
+# the first line of a tile list file, after a comment marker
+TILE_LIST_HEADER = "mapper tile list: v zoom y first_x last_x"
+
+def write_manifest(manifest_file, tiles):
+    """
+    Writes tiles to a manifest file, as read by TileManifest, and returns how
+    many were written. Tiles must be given in the order generate_areas_tiles()
+    yields them, i.e. by zoom level, then y, then x, for increasing zoom levels.
+    """
+
+    return write_manifest_keys(manifest_file,
+            (TileManifest.get_key(tile) for tile in tiles))
+
+def write_manifest_keys(manifest_file, keys):
+    """
+    Writes a manifest file from an iterable of increasing tile keys, as
+    TileManifest.get_key() returns them, and returns how many were written.
+    Repeated keys are only written once.
+    """
+
+    count = 0
+    last_key = -1
+    chunk = []
+    with open(manifest_file, "wb") as f:
+        # the count isn't known until the end, so the header is written twice
+        f.write(TileManifest.HEADER.pack(TileManifest.MAGIC,
+            TileManifest.VERSION, 0, 0))
+
+        for key in keys:
+            if key <= last_key:
+                if key == last_key:
+                    continue
+                raise ValueError("Tiles aren't in manifest order: " +
+                        repr(TileManifest.get_tile(key)) + " follows " +
+                        repr(TileManifest.get_tile(last_key)))
+
+            chunk.append(key)
+            last_key = key
+
+            if len(chunk) == TileManifest.CHUNK_SIZE:
+                f.write(struct.pack("<%dQ" % len(chunk), *chunk))
+                count += len(chunk)
+                chunk = []
+
+        f.write(struct.pack("<%dQ" % len(chunk), *chunk))
+        count += len(chunk)
+
+        f.seek(0)
+        f.write(TileManifest.HEADER.pack(TileManifest.MAGIC,
+            TileManifest.VERSION, 0, count))
+
+    return count
+
+def generate_manifest_tiles(manifest_file, start=0, stop=None):
+    """
+    Yields the tiles in a manifest file from index start up to, but not
+    including, index stop, closing the file once they've been read.
+    """
+
+    manifest = TileManifest(manifest_file)
+    try:
+        for tile in manifest.generate_tiles(start, stop):
+            yield tile
+    finally:
+        manifest.close()
+
+def generate_keys_difference(keys, other_keys):
+    """
+    Yields the keys in one increasing iterable of keys that aren't in another,
+    in order, without holding either in memory.
+    """
+
+    other_keys = iter(other_keys)
+    other = next(other_keys, None)
+    for key in keys:
+        while other is not None and other < key:
+            other = next(other_keys, None)
+        if other != key:
+            yield key
+
+def generate_keys_intersection(keys, other_keys):
+    """
+    Yields the keys in one increasing iterable of keys that are also in another,
+    in order, without holding either in memory.
+    """
+
+    other_keys = iter(other_keys)
+    other = next(other_keys, None)
+    for key in keys:
+        while other is not None and other < key:
+            other = next(other_keys, None)
+        if other is None:
+            return
+        if other == key:
+            yield key
+
+def count_tile_requests(access_log):
+    """
+    Returns a dict mapping (tile type v, x, y, zoom) keys to how many times each
+    tile was requested in an access log. Any log with a line per request
+    containing the requested path and query, like those written by the tile
+    server's --access-log option, can be read.
+    """
+
+    counts = defaultdict(int)
+    with open(access_log, "r") as f:
+        for line in f:
+            match = ACCESS_LOG_PATTERN.search(line)
+            if match is None:
+                continue
+
+            args = urlparse.parse_qs(match.group(2))
+            try:
+                key = (match.group(1), int(args["x"][0]), int(args["y"][0]),
+                        int(args["zoom"][0]))
+                Tile.get_type(key[0])
+            except (KeyError, ValueError):
+                continue
+
+            counts[key] += 1
+
+    return dict(counts)
+
+# matches single tile requests in an access log line
+ACCESS_LOG_PATTERN = re.compile(r"GET /([a-z])\?(\S+)")
+
+# the first bytes of every PNG and JPEG image, and the last of every JPEG
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+JPEG_START = "\xff\xd8"
+JPEG_END = "\xff\xd9"
+
+def get_tile_data_problem(tile_data):
+    """
+    Checks downloaded tile data for damage and returns a short description of
+    the first problem found, or None if the data looks intact. PNG data (map
+    tiles) has its chunk structure and checksums verified, catching truncated
+    image data. JPEG data (satellite tiles) is only checked for its start and
+    end markers.
+    """
+
+    if tile_data is None:
+        return "missing"
+
+    if len(tile_data) == 0:
+        return "empty"
+
+    if tile_data.startswith(JPEG_START):
+        return None if tile_data.endswith(JPEG_END) else "truncated JPEG"
+
+    if not tile_data.startswith(PNG_SIGNATURE):
+        return "bad signature"
+
+    # walk the chunks: 4 bytes of length, 4 of type, the data, then 4 of CRC
+    offset = len(PNG_SIGNATURE)
+    saw_image_data = False
+    while offset + 12 <= len(tile_data):
+        length, chunk_type = struct.unpack(">I4s",
+                tile_data[offset:offset + 8])
+        end = offset + 12 + length
+
+        if end > len(tile_data):
+            return "truncated " + chunk_type
+
+        crc, = struct.unpack(">I", tile_data[end - 4:end])
+        if zlib.crc32(tile_data[offset + 4:end - 4]) & 0xffffffff != crc:
+            return "bad " + chunk_type + " checksum"
+
+        if chunk_type == "IDAT":
+            saw_image_data = True
+        elif chunk_type == "IEND":
+            return None if saw_image_data else "missing IDAT"
+
+        offset = end
+
+    return "truncated PNG"
+
+def verify_tiles(tile_type, tiles, tile_store, num_threads=4, batch_size=100,
+        logger=None):
+    """
+    Checks that the tile store holds intact data for every one of the given
+    tiles, looking them up batch_size at a time on num_threads threads.
+    Returns a sorted list of (tile, problem) pairs for the tiles that failed,
+    where problem is as returned by get_tile_data_problem().
+    """
+
+    if num_threads <= 0:
+        raise ValueError("num_threads must be greater than 0")
+
+    logger = __get_null_logger() if logger is None else logger
+
+    # batches of tiles waiting to be checked, with None telling threads to stop
+    batch_queue = queue.Queue(num_threads * 2)
+
+    problems = []
+    counts = {"tiles": 0}
+    lock = threading.Lock()
+
+    def check_batches():
+        while 1:
+            batch = batch_queue.get()
+            if batch is None:
+                return
+
+            try:
+                results = tile_store.get_many(tile_type, batch)
+            except Exception, e:
+                logger.error("Failed to read " + str(len(batch)) +
+                        " tiles: " + str(e))
+                results = [None] * len(batch)
+
+            found = [(tile, get_tile_data_problem(tile_data))
+                    for tile, tile_data in itertools.izip(batch, results)]
+
+            with lock:
+                problems.extend((t, p) for t, p in found if p is not None)
+                counts["tiles"] += len(batch)
+                logger.debug("Verified " + str(counts["tiles"]) + " tiles")
+
+    threads = []
+    for i in xrange(num_threads):
+        thread = threading.Thread(target=check_batches)
+        thread.daemon = True
+        threads.append(thread)
+        thread.start()
+
+    # hand out the tiles in batches as we enumerate them
+    batch = []
+    for tile in tiles:
+        batch.append(tile)
+        if len(batch) >= batch_size:
+            batch_queue.put(batch)
+            batch = []
+
+    if len(batch) > 0:
+        batch_queue.put(batch)
+
+    for thread in threads:
+        batch_queue.put(None)
+    [thread.join() for thread in threads]
+
+    logger.info("Verified " + str(counts["tiles"]) + " tiles, found " +
+            str(len(problems)) + " problems")
+
+    return sorted(problems, key=lambda p: (p[0].zoom, p[0].y, p[0].x))
+
+def generate_prefetched(iterable, depth):
+    """
+    Yields the items of an iterable in order, while a background thread pulls
+    up to depth items ahead of the caller. Useful when producing each item
+    blocks on I/O that can overlap with the caller's own work. Exceptions
+    raised by the iterable are re-raised to the caller.
+    """
+
+    item_queue = queue.Queue(max(1, depth))
+    stop_event = threading.Event()
+
+    # marks the end of the items, or wraps an exception from the iterable
+    done = object()
+    class Failure:
+        def __init__(self, e): self.e = e
+
+    def put(item):
+        # give up if the caller stopped listening
+        while not stop_event.is_set():
+            try:
+                item_queue.put(item, True, 0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fill_queue():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception, e:
+            put(Failure(e))
+            return
+        put(done)
+
+    thread = threading.Thread(target=fill_queue)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while 1:
+            item = item_queue.get()
+            if item is done:
+                return
+            if isinstance(item, Failure):
+                raise item.e
+            yield item
+    finally:
+        stop_event.set()
+
+def tile_store_from_spec(spec, **kwargs):
+    """
+    Creates a tile store from a string describing it. Specs take the forms:
+      null:
+      file:<directory>
+      mongo://<server>[:<port>][/<db>[/<collection>]]
+    Any keyword arguments are passed along to the tile store's constructor.
+    Raises ValueError for unrecognized specs.
+    """
+
+    if spec == "null" or spec.startswith("null:"):
+        return NullTileStore(**kwargs)
+
+    if spec.startswith("file:"):
+        directory = spec[len("file:"):]
+        if len(directory) == 0:
+            raise ValueError("File tile store needs a directory: " + repr(spec))
+        return FileTileStore(directory, **kwargs)
+
+    if spec.startswith("mongo://"):
+        parts = spec[len("mongo://"):].split("/")
+
+        # fill in defaults for any parts that weren't given
+        server, port = parts[0], 27017
+        if ":" in server:
+            server, port = server.rsplit(":", 1)
+            port = int(port)
+        if len(server) > 0:
+            kwargs["server"] = server
+        kwargs["port"] = port
+
+        if len(parts) > 1 and len(parts[1]) > 0:
+            kwargs["db"] = parts[1]
+        if len(parts) > 2 and len(parts[2]) > 0:
+            kwargs["collection"] = parts[2]
+
+        return MongoTileStore(**kwargs)
+
+    raise ValueError("Unrecognized tile store: " + repr(spec))
+
+def migrate_tiles(source, destination, tile_types=None, zoom_levels=None,
+        num_threads=4, batch_size=100, progress_file=None, logger=None,
+        shard_size=None):
+    """
+    Copies every tile in the source tile store to the destination tile store.
+    Work is split into layers (tile type and zoom level pairs), and layers
+    holding more than shard_size tiles (MIGRATION_SHARD_SIZE by default) are
+    split further into shards of about that many tiles by ranges of rows.
+    Shards are scanned in parallel by num_threads threads, so a single huge
+    layer is still shared between them. Each thread writes its tiles to the
+    destination batch_size at a time, so memory use is bounded by the number
+    of threads and the batch size rather than by the size of the store.
+    tile_types and zoom_levels optionally limit which layers are copied.
+
+    If progress_file is given, how each layer was split and the position
+    reached in each shard are appended to it after every batch. Running the
+    same migration with the same progress file splits layers the same way,
+    skips finished shards, and resumes the others where they left off.
+
+    If a thread fails to copy a shard, the others finish their current shards
+    and take no new ones, then the error is raised.
+    """
+
+    if num_threads <= 0:
+        raise ValueError("num_threads must be greater than 0")
+
+    if batch_size <= 0:
+        raise ValueError("batch_size must be greater than 0")
+
+    shard_size = MIGRATION_SHARD_SIZE if shard_size is None else shard_size
+    if shard_size <= 0:
+        raise ValueError("shard_size must be greater than 0")
+
+    logger = __get_null_logger() if logger is None else logger
+
+    # find the layers we should copy
+    layers = source.get_layers()
+    if tile_types is not None:
+        layers = [l for l in layers if l[0] in tile_types]
+    if zoom_levels is not None:
+        layers = [l for l in layers if l[1] in zoom_levels]
+
+    # load the progress of any previous run, one JSON object per line. shards
+    # are (layer, y_first, y_last) triples, the rows being None for a shard
+    # covering its whole layer.
+    shard_plans = {}
+    progress = {}
+    if progress_file is not None and os.path.exists(progress_file):
+        with open(progress_file, "r") as f:
+            for line in f:
+                # ignore a line cut short by an interruption
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+
+                layer = (Tile.get_type(entry["v"]), entry["zoom"])
+                if "shards" in entry:
+                    shard_plans[layer] = [tuple(rows)
+                            for rows in entry["shards"]]
+                    continue
+
+                # progress from before layers were split covers whole layers
+                y_first, y_last = entry.get("y_first"), entry.get("y_last")
+                if y_first is None:
+                    shard_plans.setdefault(layer, [(None, None)])
+
+                progress[(layer, y_first, y_last)] = (entry["done"] or
+                        tuple(entry["after"]))
+
+    progress_lock = threading.Lock()
+    progress_out = None
+    if progress_file is not None:
+        progress_out = open(progress_file, "a")
+
+    def write_progress_entry(entry):
+        if progress_out is None:
+            return
+
+        with progress_lock:
+            progress_out.write(json.dumps(entry) + "\n")
+            progress_out.flush()
+
+    def record_progress(shard, done, after):
+        (tile_type, zoom), y_first, y_last = shard
+        write_progress_entry({"v": tile_type.v, "zoom": zoom,
+                "y_first": y_first, "y_last": y_last, "done": done,
+                "after": after})
+
+    # split layers that haven't been split before, recording how
+    for layer in layers:
+        if layer not in shard_plans:
+            shard_plans[layer] = get_migration_shards(source, layer[0],
+                    layer[1], shard_size)
+            write_progress_entry({"v": layer[0].v, "zoom": layer[1],
+                    "shards": shard_plans[layer]})
+
+    # queue up all the shards that aren't finished yet
+    shard_queue = queue.Queue()
+    for layer in layers:
+        for y_first, y_last in shard_plans[layer]:
+            shard = (layer, y_first, y_last)
+            if progress.get(shard) is True:
+                logger.info("Skipping finished shard " + str(shard))
+            else:
+                shard_queue.put(shard)
+
+    counts = {"tiles": 0, "bytes": 0}
+
+    # exc_info of errors raised by copying threads, re-raised once they're done
+    errors = []
+
+    def copy_layers():
+        try:
+            copy_layers_from_queue()
+        except Exception, e:
+            logger.error(threading.current_thread().name +
+                    " failed to copy tiles: " + str(e))
+            with progress_lock:
+                errors.append(sys.exc_info())
+
+    def copy_layers_from_queue():
+        # stop taking new shards once any thread has failed
+        while len(errors) == 0:
+            try:
+                shard = shard_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            (tile_type, zoom), y_first, y_last = shard
+            after = progress.get(shard)
+
+            bbox = None
+            description = tile_type.name + " tiles at zoom " + str(zoom)
+            if y_first is not None:
+                bbox = (0, y_first, 2 ** zoom - 1, y_last)
+                description += (" in rows " + str(y_first) + "-" +
+                        str(y_last))
+
+            logger.info("Copying " + description + ("" if after is None else
+                    " starting after " + str(after)))
+
+            batch = []
+            for tile, tile_data in source.scan(tile_type, zoom, bbox=bbox,
+                    after=after):
+                batch.append((tile, tile_data))
+                if len(batch) >= batch_size:
+                    write_batch(shard, batch)
+                    batch = []
+
+            write_batch(shard, batch)
+            record_progress(shard, True, None)
+            logger.info("Finished " + description)
+
+    def write_batch(shard, batch):
+        if len(batch) == 0:
+            return
+
+        destination.store_many(shard[0][0], batch)
+
+        last_tile = batch[-1][0]
+        record_progress(shard, False, (last_tile.y, last_tile.x))
+
+        with progress_lock:
+            counts["tiles"] += len(batch)
+            counts["bytes"] += sum(len(d) for t, d in batch)
+            logger.debug("Copied " + str(counts["tiles"]) + " tiles (" +
+                    str(counts["bytes"]) + " bytes)")
+
+    threads = []
+    for i in xrange(num_threads):
+        thread = threading.Thread(target=copy_layers)
+        thread.daemon = True
+        threads.append(thread)
+        thread.start()
+
+    try:
+        # join with a timeout so we stay responsive to interrupts
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+    finally:
+        if progress_out is not None:
+            progress_out.close()
+
+    logger.info("Copied " + str(counts["tiles"]) + " tiles (" +
+            str(counts["bytes"]) + " bytes)")
+
+    if len(errors) > 0:
+        error_type, error, traceback = errors[0]
+        raise error_type, error, traceback
+
+def get_migration_shards(source, tile_type, zoom, shard_size):
+    """
+    Splits the rows of a layer in the source tile store into (y_first, y_last)
+    ranges holding about shard_size tiles each, assuming the tiles are spread
+    evenly over the rows they occupy. The first and last ranges reach the edges
+    of the map, so no tile is left out. A layer small enough to be copied in one
+    piece gets a single (None, None) range.
+    """
+
+    extent = source.get_layer_extent(tile_type, zoom)
+    if extent is None:
+        return [(None, None)]
+
+    num_tiles, y_min, y_max = extent
+    num_rows = y_max - y_min + 1
+    num_shards = min(num_rows, int(ceil(float(num_tiles) / shard_size)))
+    if num_shards <= 1:
+        return [(None, None)]
+
+    shards = [(y_min + num_rows * i // num_shards,
+            y_min + num_rows * (i + 1) // num_shards - 1)
+            for i in xrange(num_shards)]
+    shards[0] = (0, shards[0][1])
+    shards[-1] = (shards[-1][0], 2 ** zoom - 1)
+
+    return shards
+
+# the most tiles a migration copies from one layer in a single piece. bigger
+# layers are split by rows, so several threads can copy them at once.
+MIGRATION_SHARD_SIZE = 100000
+
+def run_profiled(profile_file, function, *args, **kwargs):
+    """
+    Calls a function under cProfile, along with any threads it starts, and
+    writes their combined stats to profile_file for reading with pstats.
+    Returns whatever the function returns.
+    """
+
+    profiles = []
+    lock = threading.Lock()
+
+    # give each new thread its own profiler, as cProfile only sees one thread
+    def profile_thread(frame, event, arg):
+        profile = cProfile.Profile()
+        with lock:
+            profiles.append(profile)
+        profile.enable()
+
+    main_profile = cProfile.Profile()
+    threading.setprofile(profile_thread)
+    main_profile.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        main_profile.disable()
+        threading.setprofile(None)
+
+        stats = pstats.Stats(main_profile)
+        with lock:
+            for profile in profiles:
+                stats.add(profile)
+        stats.dump_stats(profile_file)
+
+def __get_null_logger():
+    """
+    Creates a logging.Logger-like object with debug(), info(), warning(),
+    error(), and critical() methods that soak up all log messages passed to
+    them. Returns the logger object.
+    """
+
+    class NullLogger: pass
+    null_logger = NullLogger()
+
+    do_nothing = lambda *args, **kwargs: None
+
+    null_logger.debug = do_nothing
+    null_logger.info = do_nothing
+    null_logger.warning = do_nothing
+    null_logger.error = do_nothing
+    null_logger.critical = do_nothing
+
+    return null_logger
+
+# a shared logger for classes that weren't given one
+NULL_LOGGER = __get_null_logger()
+
+class Tile:
+    """
+    A tile representing both Mercator and Google Maps versions of the same info,
+    a point/tile on the globe. This is not meant to be mutable, and is only a
+    container for the values initially supplied. Changing values after
+    initialization will NOT update other values!
+
+    Conversion formulae gleaned from Jeremy R. Geerdes' post:
+      http://groups.google.com/group/google-maps-api/msg/7a0aba451045ed94
+    """
+
+    # raised when we couldn't download a tile
+    class TileDownloadError(Exception): pass
+
+    # a simple class for tile types with a descriptive name and a URL 'v' value
+    TileType = namedtuple("TileType", ["name", "v"])
+
+    # possible kinds of tile for initialization
+    KIND_GOOGLE = "google"
+    KIND_MERCATOR = "mercator"
+
+    # our various tile types
+    TYPE_BIKE = TileType("bike", "r")
+    TYPE_MAP = TileType("map", "m")
+    TYPE_OVERLAY = TileType("overlay", "h")
+    TYPE_SATELLITE = TileType("satellite", "y")
+    TYPE_SATELLITE_PLAIN = TileType("satellite_plain", "s")
+    TYPE_TERRAIN = TileType("terrain", "p")
+    TYPE_TERRAIN_PLAIN = TileType("terrain_plain", "t")
+
+    # all our tile types, for looking them up
+    TYPES = [TYPE_BIKE, TYPE_MAP, TYPE_OVERLAY, TYPE_SATELLITE,
+            TYPE_SATELLITE_PLAIN, TYPE_TERRAIN, TYPE_TERRAIN_PLAIN]
+
+    # the deepest zoom level tiles are available at
+    MAX_ZOOM = 21
+
+    # the default size of square tiles
+    DEFAULT_TILE_SIZE = 256
+
+    # a URL template for downloading the tile from Google
+    URL_TEMPLATE = "http://mt%d.google.com/vt?v=%s&x=%s&y=%s&z=%s"
+
+    # number of servers, mt0 on up, that we can download tiles from
+    NUM_MIRRORS = 4
+
+    def __init__(self, kind, a, b, zoom, tile_size):
+        """
+        This should only really be called by the static constructor methods. a
+        and b take on either x/y or latitude/longitude depending on the kind of
+        tile this will be. The other kind's values are filled dynamically from
+        the given kind. If a Google tile is being created, the
+        latitude/longitude are set to the upper-left corner of the given tile's
+        x and y values.
+        """
+
+        # update internal values from the given information
+        if kind == Tile.KIND_MERCATOR:
+            self.init_from_mercator(a, b, zoom, tile_size)
+        elif kind == Tile.KIND_GOOGLE:
+            self.init_from_google(a, b, zoom, tile_size)
+        else:
+            raise ValueError("Unrecognized tile kind: " + kind)
+
+    def init_from_mercator(self, latitude, longitude, zoom, tile_size):
+        """
+        Initializes this tile from a latitude, longitude, zoom, and tile size.
+        """
+
+        # zoom must be positive
+        assert zoom >= 0
+
+        # shared by both kinds of tile
+        self.zoom = zoom
+
+        # kept for reference, the size of this tile in pixels
+        self.tile_size = tile_size
+
+        self.latitude = latitude
+        self.longitude = longitude
+
+        # calculate x and y coords from latitude and longitude
+        lat = latitude
+        lng = longitude
+
+        # absolute pixel coordinates
         x_abs = ( round(tile_size * (2 ** (zoom - 1))) +
                   (lng * ((tile_size * (2 ** zoom)) / 360)) )
 
-        y_exp = sin( (lat * pi) / 180 )
-        y_exp = max(-0.9999, y_exp) # cap at -0.9999
-        y_exp = min(0.9999, y_exp) # cap at 0.9999
+        y_exp = sin( (lat * pi) / 180 )
+        y_exp = max(-0.9999, y_exp) # cap at -0.9999
+        y_exp = min(0.9999, y_exp) # cap at 0.9999
+
+        y_abs = ( round(tile_size * (2 ** (zoom - 1))) +
+              ( (0.5 * log((1 + y_exp) / (1 - y_exp))) *
+                ((-tile_size * (2 ** zoom)) / (2 * pi)) ) )
+
+        # tile coordinates (tile-level resolution)
+        self.x = int(x_abs / tile_size)
+        self.y = int(y_abs / tile_size)
+
+        # TODO: relative coordinates (pixel resolution, relative to tile)
+        #x_rel = x % tile_size
+        #y_rel = y % tile_size
+
+    def init_from_google(self, x, y, zoom, tile_size):
+        """
+        Initializes this tile from an x, y, zoom, and tile size.
+        """
+
+        # zoom must be positive
+        assert zoom >= 0
+
+        # shared by both kinds of tile
+        self.zoom = zoom
+
+        # kept for reference, the size of this tile in pixels
+        self.tile_size = tile_size
+
+        self.x = x
+        self.y = y
+
+        # latitude and longitude are worked out by __getattr__ when first used,
+        # since most tiles made from Google coordinates never need them
+
+    def __getattr__(self, name):
+        """
+        Fills in a Google tile's latitude and longitude the first time either
+        is asked for.
+        """
+
+        if name not in ("latitude", "longitude") or "x" not in self.__dict__:
+            raise AttributeError(name)
+
+        self.init_mercator_from_google()
+        return self.__dict__[name]
+
+    def init_mercator_from_google(self):
+        """
+        Sets the latitude and longitude of this tile's upper-left corner from
+        its x, y, zoom, and tile size.
+        """
+
+        x, y, zoom, tile_size = self.x, self.y, self.zoom, self.tile_size
+
+        # calculate latitude and longitude for upper-left corner of the tile
+        longitude = ( ( (x * tile_size) - (tile_size * (2 ** (zoom - 1))) ) /
+                      ( (tile_size * (2 ** zoom)) / 360.0 ) )
+
+        # normalize longitude
+        while longitude > 180:
+            longitude -= 360
+
+        while longitude < -180:
+            logitude += 360
+
+        lat_exp = ( ( (y * 256) - (256 * (2 ** (zoom - 1))) ) /
+                    ( (-256 * (2 ** zoom)) / (2 * pi) ) )
+        latitude = ( ( (2 * atan(exp(lat_exp))) - (pi / 2) ) / (pi / 180) )
+
+        # cap final values at their logical extremes
+        self.latitude = max(-90.0, latitude)
+        self.longitude = min(90.0, longitude)
+
+    @staticmethod
+    def get_type(v):
+        """
+        Returns the tile type with the given URL 'v' value. Raises ValueError
+        if there is no such tile type.
+        """
+
+        for tile_type in Tile.TYPES:
+            if tile_type.v == v:
+                return tile_type
+
+        raise ValueError("Unrecognized tile type: " + repr(v))
+
+    @staticmethod
+    def from_mercator(latitude, longitude, zoom, tile_size=None):
+        """
+        Creates a tile from Mercator coordinates and returns it.
+        """
+
+        tile_size = Tile.DEFAULT_TILE_SIZE if tile_size is None else tile_size
+        return Tile(Tile.KIND_MERCATOR, latitude, longitude, zoom, tile_size)
+
+    @staticmethod
+    def from_google(x, y, zoom, tile_size=None):
+        """
+        Creates a tile from Google coordinates and returns it.
+        """
+
+        tile_size = Tile.DEFAULT_TILE_SIZE if tile_size is None else tile_size
+        return Tile(Tile.KIND_GOOGLE, x, y, zoom, tile_size)
+
+    def download(self, tile_type, mirror=None, timings=None):
+        """
+        Downloads the image data for this tile and returns it as a binary
+        string, or returns None if no data could be downloaded. Raises
+        TileDownloadError when tile download fails. mirror is the number of the
+        server to download from, chosen at random if None. If timings is a
+        dict, the seconds spent connecting (up to receiving the response
+        headers) and transferring the data are stored in it under "connect" and
+        "transfer".
+        """
+
+        if mirror is None:
+            mirror = random.randrange(Tile.NUM_MIRRORS)
+
+        # create the request URL from the template
+        url = Tile.URL_TEMPLATE % (mirror, tile_type.v, self.x, self.y,
+                self.zoom)
+
+        # spoof the user agent so google doesn't ban us
+        agent = "Mozilla/5.0 (X11; U; Linux x86_64; en-US) "
+        agent += "AppleWebKit/532.5 (KHTML, like Gecko) "
+        agent += "Chrome/4.0.249.30 Safari/532.5"
+
+        # build the request to download this tile
+        request = urllib2.Request(url, headers={"User-Agent": agent})
+
+        try:
+            # download the tile and return its image data
+            if timings is None:
+                return urllib2.urlopen(request).read()
+
+            start = time.time()
+            response = urllib2.urlopen(request)
+            connected = time.time()
+            tile_data = response.read()
+
+            timings["connect"] = connected - start
+            timings["transfer"] = time.time() - connected
+            return tile_data
+
+        # pass exceptions along for the caller to handle
+        except Exception, e:
+            raise Tile.TileDownloadError(str(e))
+
+    def __hash__(self):
+        result = 17
+
+        # only what __eq__ compares, so equal tiles always hash the same
+        result += result * self.x * 13
+        result += result * self.y * 43
+        result += result * self.zoom * 19
+
+        return result * 29
+
+    def __eq__(self, other):
+        return (isinstance(other, Tile) and
+                other.x == self.x and
+                other.y == self.y and
+                other.zoom == self.zoom)
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        r = self.__class__.__name__ + "("
+        r += ", ".join(map(repr, [self.x, self.y, self.zoom]))
+
+        if self.tile_size != Tile.DEFAULT_TILE_SIZE:
+            r += ", tile_size=" + repr(self.tile_size)
+
+        r += ")"
+
+        return r
+
+class TileStore:
+    """
+    Interface for storing tiles. Provides a 'store' method that takes tile data
+    and stores it however the class chooses, and a 'delete' method that removes
+    a previously stored tile.
+    """
+
+    def store(self, tile_type, tile, tile_data):
+        """
+        Stores a single tile in the store however the class chooses. This method
+        should be thread-safe, as no attempts are made to call it synchronously.
+        """
+
+        raise NotImplemented(self.__class__.__name__ + " must implement this!")
+
+    def store_many(self, tile_type, tiles_and_data):
+        """
+        Stores a list of (tile, tile_data) pairs of the same tile type. Stores
+        that can write several tiles more cheaply than one at a time should
+        override this, as StoreWriter hands over its tiles in batches.
+        """
+
+        for tile, tile_data in tiles_and_data:
+            self.store(tile_type, tile, tile_data)
+
+    def delete(self, tile_type, tile):
+        """
+        Removes a single tile from the store, returning True if the tile existed
+        and False otherwise. Like store(), this method should be thread-safe.
+        """
+
+        raise NotImplementedError(self.__class__.__name__ +
+                " must implement this!")
+
+    def get(self, tile_type, tile):
+        """
+        Returns the stored data for a single tile, or None if the store doesn't
+        hold the tile.
+        """
+
+        raise NotImplementedError(self.__class__.__name__ +
+                " must implement this!")
+
+    def get_version(self, tile_type, tile):
+        """
+        Returns a string that changes whenever the given tile's stored data
+        changes, or None if the store doesn't hold the tile. This must be
+        cheaper than get(), as it's used to tell whether a copy of a tile held
+        elsewhere is still current without loading the tile's data.
+        """
+
+        raise NotImplementedError(self.__class__.__name__ +
+                " must implement this!")
+
+    def get_many(self, tile_type, tiles):
+        """
+        Returns a list holding the stored data for each of the given tiles, in
+        the same order, with None for tiles the store doesn't hold. Stores that
+        can look up several tiles more cheaply than one at a time should
+        override this.
+        """
+
+        return [self.get(tile_type, tile) for tile in tiles]
+
+    def get_many_with_versions(self, tile_type, tiles):
+        """
+        Like get_many(), but returns (tile_data, version) pairs, where version
+        is as returned by get_version(). Both are None for tiles the store
+        doesn't hold. Stores that can get both at once should override this.
+        """
+
+        return [(tile_data, None if tile_data is None else
+                    self.get_version(tile_type, tile))
+                for tile, tile_data in itertools.izip(tiles,
+                    self.get_many(tile_type, tiles))]
+
+    def contains_many(self, tile_type, tiles):
+        """
+        Returns a list of booleans indicating whether the store holds each of
+        the given tiles, in the same order. Stores that can check for tiles
+        without loading their data should override this.
+        """
+
+        return [d is not None for d in self.get_many(tile_type, tiles)]
+
+    def get_updated(self, since):
+        """
+        Yields (tile_type, tile, update_date) triples for every tile stored or
+        re-stored at or after the given Unix time in seconds, oldest first.
+        Lets readers of the store, like caches, find out what changed. Since
+        update dates may only be accurate to the second, tiles updated in the
+        same second as the given time are included.
+        """
+
+        raise NotImplementedError(self.__class__.__name__ +
+                " must implement this!")
+
+    def get_oldest(self, limit, before=None):
+        """
+        Yields (tile_type, tile, update_date) triples for up to limit of the
+        least recently stored tiles, oldest first, only including those stored
+        before the given Unix time if it's given. Stores must do this without
+        sorting all their tiles, as it's used to find stale tiles in big stores.
+        """
+
+        raise NotImplementedError(self.__class__.__name__ +
+                " must implement this!")
+
+    def get_layers(self):
+        """
+        Returns a sorted list of (tile_type, zoom) pairs for which the store
+        holds at least one tile.
+        """
+
+        raise NotImplementedError(self.__class__.__name__ +
+                " must implement this!")
+
+    def scan(self, tile_type, zoom, bbox=None, after=None):
+        """
+        Yields (tile, tile_data) pairs for every stored tile of the given type
+        and zoom level, ordered by y then x. If bbox is given as an inclusive
+        (x_min, y_min, x_max, y_max) tuple of tile coordinates, only tiles
+        within it are yielded. If after is a (y, x) pair, only tiles following
+        that position are yielded, so an interrupted scan can be picked up
+        where it left off.
+        """
+
+        raise NotImplementedError(self.__class__.__name__ +
+                " must implement this!")
+
+    def scan_tiles(self, tile_type, zoom, bbox=None, after=None):
+        """
+        Like scan(), but yields only the tiles, without their data. Stores that
+        can list tiles without loading them should override this.
+        """
+
+        for tile, tile_data in self.scan(tile_type, zoom, bbox, after):
+            yield tile
+
+    def get_layer_extent(self, tile_type, zoom):
+        """
+        Returns a (num_tiles, y_min, y_max) triple describing the stored tiles
+        of the given type and zoom level, or None if there are none. Stores that
+        can count tiles without listing every one should override this.
+        """
+
+        num_tiles, y_min, y_max = 0, None, None
+        for tile in self.scan_tiles(tile_type, zoom):
+            if y_min is None:
+                y_min = tile.y
+            y_max = tile.y
+            num_tiles += 1
+
+        return None if num_tiles == 0 else (num_tiles, y_min, y_max)
+
+    @staticmethod
+    def in_scan_range(tile, bbox, after):
+        """
+        Returns whether a tile falls within the bbox and after limits of a scan.
+        """
+
+        if bbox is not None:
+            x_min, y_min, x_max, y_max = bbox
+            if not (x_min <= tile.x <= x_max and y_min <= tile.y <= y_max):
+                return False
+
+        return after is None or (tile.y, tile.x) > tuple(after)
+
+class NullTileStore(TileStore):
+    """
+    Throws away all tiles given to it. Useful for performance testing.
+    """
+
+    def __init__(*args, **kwargs): pass
+    def store(*args, **kwargs): pass
+    def store_many(*args, **kwargs): pass
+    def delete(*args, **kwargs): return False
+    def get(*args, **kwargs): return None
+    def get_version(*args, **kwargs): return None
+    def get_many(self, tile_type, tiles): return [None] * len(tiles)
+    def get_layers(*args, **kwargs): return []
+    def scan(*args, **kwargs): return iter([])
+
+def hash_tile_data(tile_data):
+    """
+    Returns a hex digest identifying the given tile data by its content. Tile
+    stores that deduplicate identical tiles use this as the key of the single
+    copy of the data they keep.
+    """
+
+    return hashlib.sha1(tile_data).hexdigest()
+
+class FileTileStore(TileStore):
+    """
+    Stores tiles in a directory on the local file system.
+    """
+
+    # the sub-directory that holds deduplicated tile data
+    BLOB_DIRECTORY = "blobs"
+
+    # how many locks blobs are spread across by hash
+    BLOB_LOCK_COUNT = 64
+
+    # the largest scan bbox, in tiles, that we look for tile by tile
+    MAX_PROBED_AREA = 4096
+
+    # the most tiles a listing scan sorts in memory before spilling them to a
+    # temporary file to be merged with the others
+    SCAN_RUN_SIZE = 65536
+
+    # a tile's (y, x) position in a scan's temporary files
+    SCAN_RUN_ENTRY = struct.Struct("<qq")
+
+    # matches file names made by the default name generator
+    TILE_NAME_PATTERN = re.compile(r"^([a-z]+)_(\d+)-(\d+)-(\d+)$")
+
+    def __init__(self, directory=time.strftime("tiles_%Y%m%d_%H%M%S"),
+            name_generator=None, dedup=False):
+        """
+        Creates a tile store that writes files to a given directory. If the
+        directory doesn't exist, it creates it. A default time-based directory
+        name is used if none is provided. name_generator is a callable that takes
+        a tile and a tile type and returns a file name. If unspecified, a
+        default is used.
+
+        If dedup is True, identical tile data is only written to disk once, to a
+        file named by its hash in the blob directory. Each tile file is then a
+        hard link to its blob, so the file system's link count doubles as the
+        blob's reference count.
+        """
+
+        def default_name_generator(tile, tile_type):
+            return (tile_type.v + "_" +
+                    str(tile.x) + "-" +
+                    str(tile.y) + "-" +
+                    str(tile.zoom))
+
+        # store the method for generating file names
+        self.name_generator = name_generator
+        if name_generator is None:
+            self.name_generator = default_name_generator
+
+        self.directory = os.path.abspath(directory)
+        self.dedup = dedup
+
+        # guard linking and unlinking blobs, so a blob can't be removed while
+        # another thread is adding a reference to it. blobs are spread across
+        # the locks by hash, so writers of different data rarely contend.
+        self.blob_locks = [threading.Lock()
+                for i in xrange(FileTileStore.BLOB_LOCK_COUNT)]
+
+        # ensure the given directory exists
+        try:
+            os.mkdir(self.directory)
+        except OSError, e:
+            # ignore 'already exists' errors, but raise all others
+            if e.errno != 17:
+                raise e
+
+    def get_tile_path(self, tile_type, tile):
+        """
+        Returns the absolute path of the file for the given tile.
+        """
+
+        return os.path.join(self.directory, self.name_generator(tile, tile_type))
+
+    def parse_tile_name(self, name):
+        """
+        Returns the (tile_type, tile) for a file name made by the default name
+        generator, or None if the name wasn't made by it. Stores using a custom
+        name generator can't be scanned.
+        """
+
+        match = FileTileStore.TILE_NAME_PATTERN.match(name)
+        if match is None:
+            return None
+
+        v, x, y, zoom = match.groups()
+        try:
+            tile_type = Tile.get_type(v)
+        except ValueError:
+            return None
+
+        return tile_type, Tile.from_google(int(x), int(y), int(zoom))
+
+    def get_blob_path(self, blob_hash):
+        """
+        Returns the absolute path of the blob file for the given data hash. Blobs
+        are fanned out into sub-directories by the first two characters of their
+        hash to keep directory sizes manageable.
+        """
+
+        return os.path.join(self.directory, FileTileStore.BLOB_DIRECTORY,
+                blob_hash[:2], blob_hash)
+
+    def store(self, tile_type, tile, tile_data):
+        """
+        Writes files to the given directory. In dedup mode, each tile file is
+        a hard link to the blob holding its data, so tiles with the same data
+        share a modification time, and storing any of them updates it.
+        """
+
+        # build a file name containing descriptive data
+        path = self.get_tile_path(tile_type, tile)
+
+        # write the file into our directory, overwriting existing files
+        if not self.dedup:
+            with open(path, "wb") as f:
+                f.write(tile_data)
+            return
+
+        blob_path = self.get_blob_path(hash_tile_data(tile_data))
+
+        # nothing to write if the tile is already linked to this very blob,
+        # but the store still dates the tile
+        if self.__is_linked(path, blob_path) and self.__touch(path):
+            return
+
+        # find the blob the tile is linked to now, outside of any lock
+        old_blob_path = self.__get_linked_blob_path(path)
+
+        # write the blob only if we've never seen this data before. this is
+        # done outside the lock since it's the only part that touches the disk
+        # in earnest, and is harmless if another thread races us to it.
+        if not os.path.exists(blob_path):
+            self.__write_blob(blob_path, tile_data)
+
+        with self.__get_blob_lock(blob_path):
+            # the blob may have lost its last reference since we checked
+            if not os.path.exists(blob_path):
+                self.__write_blob(blob_path, tile_data)
+
+            # replace the tile file with a new link to the blob in one step
+            temp_path = FileTileStore.get_temp_path(path)
+            os.link(blob_path, temp_path)
+            os.rename(temp_path, path)
+
+            # the blob keeps the date it was written, not this tile's
+            self.__touch(path)
+
+        # release the blob the tile pointed at before, if it differed
+        if old_blob_path is not None and old_blob_path != blob_path:
+            self.__remove_unreferenced_blob(old_blob_path)
+
+    def delete(self, tile_type, tile):
+        """
+        Removes the tile's file. In dedup mode, the tile's blob is removed too
+        once no other tile refers to it.
+        """
+
+        path = self.get_tile_path(tile_type, tile)
+        blob_path = self.__get_linked_blob_path(path)
+
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise e
+            return False
+
+        if blob_path is not None:
+            self.__remove_unreferenced_blob(blob_path)
+
+        return True
+
+    def generate_names(self):
+        """
+        Yields the names of the files in the store's directory, streaming them
+        from the directory if scandir is available.
+        """
+
+        if scandir is None:
+            names = os.listdir(self.directory)
+        else:
+            names = (entry.name for entry in scandir(self.directory))
+
+        for name in names:
+            yield name
+
+    def get_layers(self):
+        """
+        Finds the layers present in one pass over the store's directory.
+        """
+
+        layers = set()
+        for name in self.generate_names():
+            match = FileTileStore.TILE_NAME_PATTERN.match(name)
+            if match is not None:
+                layers.add((match.group(1), int(match.group(4))))
+
+        result = []
+        for v, zoom in layers:
+            try:
+                result.append((Tile.get_type(v), zoom))
+            except ValueError:
+                pass
+
+        return sorted(result)
+
+    def get(self, tile_type, tile):
+        """
+        Reads the tile's file, if it exists.
+        """
+
+        try:
+            with open(self.get_tile_path(tile_type, tile), "rb") as f:
+                return f.read()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise e
+            return None
+
+    def get_version(self, tile_type, tile):
+        """
+        Uses the tile file's modification time and size as its version.
+        """
+
+        try:
+            st = os.stat(self.get_tile_path(tile_type, tile))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise e
+            return None
+
+        return "%x-%x" % (int(st.st_mtime * 1000000), st.st_size)
+
+    def get_updated(self, since):
+        """
+        Uses tile files' modification times as their update dates, sorting the
+        ones at or after the given time after one pass over the store's
+        directory.
+        """
+
+        for update_date, groups in sorted(self.__generate_dated_tiles(
+                lambda update_date: update_date >= since)):
+            tile = self.__parse_tile_groups(groups)
+            if tile is not None:
+                yield tile + (update_date,)
+
+    def get_oldest(self, limit, before=None):
+        """
+        Uses tile files' modification times as their update dates, keeping only
+        the oldest limit of them while passing over the store's directory once.
+        """
+
+        for update_date, groups in heapq.nsmallest(limit,
+                self.__generate_dated_tiles(lambda update_date:
+                        before is None or update_date < before)):
+            tile = self.__parse_tile_groups(groups)
+            if tile is not None:
+                yield tile + (update_date,)
+
+    def __generate_dated_tiles(self, is_wanted):
+        for name in self.generate_names():
+            parsed = FileTileStore.TILE_NAME_PATTERN.match(name)
+            if parsed is None:
+                continue
+
+            try:
+                update_date = os.stat(
+                        os.path.join(self.directory, name)).st_mtime
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise e
+                continue
+
+            if is_wanted(update_date):
+                yield update_date, parsed.groups()
+
+    @staticmethod
+    def __parse_tile_groups(groups):
+        v, x, y, zoom = groups
+        try:
+            tile_type = Tile.get_type(v)
+        except ValueError:
+            return None
+
+        return tile_type, Tile.from_google(int(x), int(y), int(zoom))
+
+    def contains_many(self, tile_type, tiles):
+        """
+        Checks for each tile's file without reading it.
+        """
+
+        return [os.path.exists(self.get_tile_path(tile_type, tile))
+                for tile in tiles]
+
+    def scan_tiles(self, tile_type, zoom, bbox=None, after=None):
+        """
+        Finds the matching tiles in one pass over the store's directory. They're
+        sorted in runs of at most SCAN_RUN_SIZE tiles, all but the last of which
+        are spilled to temporary files, then merged, so memory use doesn't grow
+        with the size of the store.
+        """
+
+        runs = []
+        try:
+            positions = []
+            for name in self.generate_names():
+                match = FileTileStore.TILE_NAME_PATTERN.match(name)
+                if (match is None or match.group(1) != tile_type.v or
+                        int(match.group(4)) != zoom):
+                    continue
+
+                x, y = int(match.group(2)), int(match.group(3))
+                if bbox is not None:
+                    x_min, y_min, x_max, y_max = bbox
+                    if not (x_min <= x <= x_max and y_min <= y <= y_max):
+                        continue
+                if after is not None and (y, x) <= tuple(after):
+                    continue
+
+                positions.append((y, x))
+                if len(positions) >= FileTileStore.SCAN_RUN_SIZE:
+                    runs.append(self.__write_run(positions))
+                    positions = []
+
+            positions.sort()
+            merged = heapq.merge(positions,
+                    *[self.__generate_run(run) for run in runs])
+            for y, x in merged:
+                yield Tile.from_google(x, y, zoom)
+        finally:
+            for run in runs:
+                run.close()
+
+    def get_layer_extent(self, tile_type, zoom):
+        """
+        Counts the layer's tiles in one pass over the store's directory, without
+        sorting them.
+        """
+
+        num_tiles, y_min, y_max = 0, None, None
+        for name in self.generate_names():
+            match = FileTileStore.TILE_NAME_PATTERN.match(name)
+            if (match is None or match.group(1) != tile_type.v or
+                    int(match.group(4)) != zoom):
+                continue
+
+            y = int(match.group(3))
+            y_min = y if y_min is None else min(y_min, y)
+            y_max = y if y_max is None else max(y_max, y)
+            num_tiles += 1
+
+        return None if num_tiles == 0 else (num_tiles, y_min, y_max)
+
+    def scan(self, tile_type, zoom, bbox=None, after=None, prefetch=64):
+        """
+        Finds the matching tiles, then reads their files in order. Files are
+        read ahead of the caller by a background thread, up to prefetch tiles at
+        a time, so the caller's processing overlaps with the disk. Small bboxes
+        are checked for tile by tile rather than by listing the whole directory.
+        """
+
+        # probing for each possible file beats listing a huge directory
+        tiles = None
+        if bbox is not None:
+            x_min, y_min, x_max, y_max = bbox
+            area = (x_max - x_min + 1) * (y_max - y_min + 1)
+            if area <= FileTileStore.MAX_PROBED_AREA:
+                candidates = (Tile.from_google(x, y, zoom)
+                        for y in xrange(y_min, y_max + 1)
+                        for x in xrange(x_min, x_max + 1))
+                tiles = [t for t in candidates
+                        if TileStore.in_scan_range(t, None, after) and
+                            os.path.exists(self.get_tile_path(tile_type, t))]
+
+        # otherwise, find the tiles from a listing
+        if tiles is None:
+            tiles = self.scan_tiles(tile_type, zoom, bbox, after)
+
+        # read tiles ahead of the caller, skipping any deleted since listing
+        results = ((t, self.get(tile_type, t)) for t in tiles)
+        for tile, tile_data in generate_prefetched(results, prefetch):
+            if tile_data is not None:
+                yield tile, tile_data
+
+    def __write_run(self, positions):
+        """
+        Sorts the given (y, x) positions and writes them to a temporary file,
+        returning the file ready to be read back.
+        """
+
+        positions.sort()
+
+        run = tempfile.TemporaryFile()
+        entry = FileTileStore.SCAN_RUN_ENTRY
+        run.write("".join(entry.pack(y, x) for y, x in positions))
+        run.seek(0)
+
+        return run
+
+    def __generate_run(self, run):
+        """
+        Yields the (y, x) positions written to a temporary file by __write_run.
+        """
+
+        entry = FileTileStore.SCAN_RUN_ENTRY
+        while 1:
+            data = run.read(entry.size * 4096)
+            if len(data) == 0:
+                break
+
+            for i in xrange(0, len(data), entry.size):
+                yield entry.unpack_from(data, i)
+
+    def __write_blob(self, blob_path, tile_data):
+        """
+        Writes tile data to the given blob path, writing to a temporary file
+        first so no other thread ever sees a partially written blob.
+        """
+
+        try:
+            os.makedirs(os.path.dirname(blob_path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise e
+
+        temp_path = FileTileStore.get_temp_path(blob_path)
+        with open(temp_path, "wb") as f:
+            f.write(tile_data)
+        os.rename(temp_path, blob_path)
+
+    @staticmethod
+    def get_temp_path(path):
+        """
+        Returns a path next to the given one to write to before renaming it into
+        place. The name is unique to this process and thread, so writers in
+        other processes sharing the store never clobber each other's files.
+        """
+
+        return "%s.%d.%d" % (path, os.getpid(), threading.current_thread().ident)
+
+    def __get_blob_lock(self, blob_path):
+        """
+        Returns the lock guarding the blob at the given path.
+        """
+
+        blob_hash = os.path.basename(blob_path)
+        return self.blob_locks[int(blob_hash[:8], 16) %
+                FileTileStore.BLOB_LOCK_COUNT]
+
+    @staticmethod
+    def __touch(path):
+        """
+        Sets the modification time of the file at the given path to now,
+        returning False if the file doesn't exist.
+        """
+
+        try:
+            os.utime(path, None)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise e
+            return False
+
+        return True
+
+    def __is_linked(self, path, blob_path):
+        """
+        Returns whether the tile file at the given path is a link to the given
+        blob, by comparing the files' inodes rather than their contents.
+        """
+
+        try:
+            tile_stat = os.stat(path)
+            blob_stat = os.stat(blob_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise e
+            return False
+
+        return (tile_stat.st_ino == blob_stat.st_ino and
+                tile_stat.st_dev == blob_stat.st_dev)
+
+    def __get_linked_blob_path(self, path):
+        """
+        Returns the path of the blob the tile file at the given path is linked
+        to, or None if we're not deduplicating or the tile file doesn't exist.
+        """
+
+        if not self.dedup:
+            return None
+
+        try:
+            with open(path, "rb") as f:
+                return self.get_blob_path(hash_tile_data(f.read()))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise e
+            return None
+
+    def __remove_unreferenced_blob(self, blob_path):
+        """
+        Removes the given blob if no tile files link to it anymore, i.e. if the
+        blob file itself holds its only link.
+        """
+
+        with self.__get_blob_lock(blob_path):
+            try:
+                if os.stat(blob_path).st_nlink <= 1:
+                    os.remove(blob_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise e
+
+class MongoTileStore(TileStore):
+    """
+    Stores tiles on a MongoDB server.
+    """
+
+    # the fields needed to get a tile and its data from a tile document
+    TILE_DATA_FIELDS = {"x": True, "y": True, "zoom": True,
+            "image_data": True, "blob_hash": True, "update_date": True}
+
+    def __init__(self, server="127.0.0.1", port=27017, db="mapper",
+            collection="tiles", dedup=False, blob_collection=None,
+            pool_size=None):
+        """
+        Connects to the given MongoDB server and collection. pool_size is the
+        most connections kept open to the server for use by concurrent
+        threads, defaulting to the driver's own limit. If dedup is True,
+        tile documents don't hold their image data directly. Instead, each
+        distinct image is stored once in blob_collection (by default the tile
+        collection's name with '_blobs' appended) keyed by its hash, along with
+        a count of the tiles referring to it. Tile documents then hold the hash
+        in 'blob_hash'.
+        """
+
+        connection_args = {}
+        if pool_size is not None:
+            connection_args["max_pool_size"] = pool_size
+
+        self.connection = pymongo.Connection(server, port, **connection_args)
+        self.db = self.connection[db]
+        self.collection = self.db[collection]
+
+        self.dedup = dedup
+        if blob_collection is None:
+            blob_collection = collection + "_blobs"
+        self.blobs = self.db[blob_collection]
+
+        # make sure the database has our index, building it if necessary.
+        # without this, we'd have to look up every tile to see if already
+        # existed, which becomes unusably slow with lots of tiles (100000+).
+        index = [
+            ("x", pymongo.ASCENDING),
+            ("y", pymongo.ASCENDING),
+            ("zoom", pymongo.ASCENDING),
+            ("tile_type.name", pymongo.ASCENDING),
+            ("tile_type.v", pymongo.ASCENDING)
+        ]
+        self.collection.ensure_index(index, unique=True, drop_dups=True)
+
+        # lets us scan a layer's tiles in order without sorting them
+        scan_index = [
+            ("tile_type.v", pymongo.ASCENDING),
+            ("zoom", pymongo.ASCENDING),
+            ("y", pymongo.ASCENDING),
+            ("x", pymongo.ASCENDING)
+        ]
+        self.collection.ensure_index(scan_index)
+
+        # lets us find recently updated tiles without looking at all of them
+        self.collection.ensure_index([("update_date", pymongo.ASCENDING)])
+
+    @staticmethod
+    def get_tile_query(tile_type, tile):
+        """
+        Returns a query document matching exactly the given tile.
+        """
+
+        return {
+            "x": int(tile.x),
+            "y": int(tile.y),
+            "zoom": int(tile.zoom),
+            "tile_type.name": tile_type.name,
+            "tile_type.v": tile_type.v,
+        }
+
+    @staticmethod
+    def get_tile_doc(tile_type, tile):
+        """
+        Returns a new tile document for the given tile, without its image data.
+        """
+
+        return {
+            # coordinates
+            "x": int(tile.x),
+            "y": int(tile.y),
+            "zoom": int(tile.zoom),
+
+            # tile type (we're expecting a collections.namedtuple)
+            "tile_type": tile_type._asdict(),
+
+            # update date, for eventually re-downloading 'old' tiles
+            "update_date": int(time.time())
+        }
+
+    @staticmethod
+    def get_tile_update(tile_data):
+        """
+        Returns an update document that sets a tile's image data and moves its
+        update date to now. Upserted with a tile's query, this adds the tile or
+        overwrites the old one.
+        """
+
+        return {"$set": {
+            "image_data": bson.binary.Binary(tile_data),
+            "update_date": int(time.time()),
+        }}
+
+    def store(self, tile_type, tile, tile_data):
+        """
+        Store the tile in the database with a Unix update time in seconds. If
+        the tile already exists, its data and update time are overwritten. This
+        assumes that an index with unique keys has been added on x, y, zoom,
+        tile_type.name, and tile_type.v.
+        """
+
+        if not self.dedup:
+            # add our tile to the collection, overwriting old data if it exists
+            self.collection.update(
+                    MongoTileStore.get_tile_query(tile_type, tile),
+                    MongoTileStore.get_tile_update(tile_data), upsert=True)
+            return
+
+        tile_doc = MongoTileStore.get_tile_doc(tile_type, tile)
+
+        # add the blob if it's new, and count this tile's reference to it
+        blob_hash = hash_tile_data(tile_data)
+        self.blobs.update({"_id": blob_hash}, {
+                "$inc": {"refcount": 1},
+                "$setOnInsert": {"data": bson.binary.Binary(tile_data)}
+            }, upsert=True)
+
+        # point the tile at the blob, then release whatever it pointed at before
+        tile_doc["blob_hash"] = blob_hash
+        old_doc = self.collection.find_and_modify(
+                MongoTileStore.get_tile_query(tile_type, tile), tile_doc,
+                upsert=True, fields={"blob_hash": True})
+
+        if old_doc is not None and "blob_hash" in old_doc:
+            self.__release_blob(old_doc["blob_hash"])
+
+    def store_many(self, tile_type, tiles_and_data):
+        """
+        Stores many tiles with a single unordered bulk of upserts, overwriting
+        any that already exist as store() does. Deduplicated tiles need their
+        blob references maintained individually, so they're stored one at a
+        time.
+        """
+
+        if self.dedup:
+            return TileStore.store_many(self, tile_type, tiles_and_data)
+
+        if len(tiles_and_data) == 0:
+            return
+
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for tile, tile_data in tiles_and_data:
+            bulk.find(MongoTileStore.get_tile_query(tile_type, tile)).upsert(
+                    ).update_one(MongoTileStore.get_tile_update(tile_data))
+        bulk.execute()
+
+    def delete(self, tile_type, tile):
+        """
+        Removes the tile's document, along with its blob if dedup is enabled and
+        no other tile refers to it.
+        """
+
+        old_doc = self.collection.find_and_modify(
+                MongoTileStore.get_tile_query(tile_type, tile), remove=True,
+                fields={"blob_hash": True})
+
+        if old_doc is None:
+            return False
+
+        if "blob_hash" in old_doc:
+            self.__release_blob(old_doc["blob_hash"])
+
+        return True
+
+    def get_layers(self):
+        """
+        Finds the layers present using distinct queries on the tile type and
+        zoom level.
+        """
+
+        layers = []
+        for v in self.collection.distinct("tile_type.v"):
+            zooms = self.collection.find({"tile_type.v": v}).distinct("zoom")
+            layers.extend((Tile.get_type(v), zoom) for zoom in zooms)
+
+        return sorted(layers)
+
+    # the largest number of tiles we ask for in a single query
+    MAX_QUERY_TILES = 500
+
+    def get(self, tile_type, tile):
+        """
+        Looks up a single tile's document and its data.
+        """
+
+        # fetch only the data, leaving the rest of the document on the server
+        tile_doc = self.collection.find_one(
+                MongoTileStore.get_tile_query(tile_type, tile),
+                fields={"_id": False, "image_data": True, "blob_hash": True})
+
+        if tile_doc is None:
+            return None
+
+        if "blob_hash" in tile_doc:
+            blob = self.blobs.find_one({"_id": tile_doc["blob_hash"]},
+                    fields={"data": True})
+            return None if blob is None else str(blob["data"])
+
+        return str(tile_doc["image_data"])
+
+    def get_version(self, tile_type, tile):
+        """
+        Uses the hash of a deduplicated tile's data as its version, and the
+        update date of any other tile.
+        """
+
+        tile_doc = self.collection.find_one(
+                MongoTileStore.get_tile_query(tile_type, tile),
+                fields={"blob_hash": True, "update_date": True})
+
+        if tile_doc is None:
+            return None
+
+        return MongoTileStore.get_tile_doc_version(tile_doc)
+
+    @staticmethod
+    def get_tile_doc_version(tile_doc):
+        """
+        Returns the version of the tile described by a tile document.
+        """
+
+        if "blob_hash" in tile_doc:
+            return str(tile_doc["blob_hash"])
+
+        return str(tile_doc["update_date"])
+
+    def get_many(self, tile_type, tiles):
+        """
+        Looks up tiles in batches, with one query per batch for the tile
+        documents and another for any deduplicated blobs they refer to.
+        """
+
+        return [tile_data for tile_data, version in
+                self.get_many_with_versions(tile_type, tiles)]
+
+    def get_many_with_versions(self, tile_type, tiles):
+        """
+        Looks up tiles the same way as get_many(), taking their versions from
+        the same documents.
+        """
+
+        found = {}
+        for tile_docs in self.__find_many(tile_type, tiles,
+                MongoTileStore.TILE_DATA_FIELDS):
+            for tile, tile_data, version in self.__resolve_tile_docs(
+                    tile_docs):
+                found[(tile.x, tile.y, tile.zoom)] = (tile_data, version)
+
+        return [found.get((t.x, t.y, t.zoom), (None, None)) for t in tiles]
+
+    def contains_many(self, tile_type, tiles):
+        """
+        Looks up tiles in batches without fetching their image data.
+        """
+
+        fields = {"x": True, "y": True, "zoom": True}
+
+        found = set()
+        for tile_docs in self.__find_many(tile_type, tiles, fields):
+            found.update((d["x"], d["y"], d["zoom"]) for d in tile_docs)
+
+        return [(t.x, t.y, t.zoom) in found for t in tiles]
+
+    def __find_many(self, tile_type, tiles, fields):
+        """
+        Yields lists of the tile documents found for the given tiles, making one
+        query per MAX_QUERY_TILES tiles.
+        """
+
+        for i in xrange(0, len(tiles), MongoTileStore.MAX_QUERY_TILES):
+            chunk = tiles[i:i + MongoTileStore.MAX_QUERY_TILES]
+            query = {
+                "tile_type.name": tile_type.name,
+                "tile_type.v": tile_type.v,
+                "$or": [{"x": int(t.x), "y": int(t.y), "zoom": int(t.zoom)}
+                    for t in chunk]
+            }
+
+            yield list(self.collection.find(query, fields=fields))
+
+    def scan(self, tile_type, zoom, bbox=None, after=None, batch_size=100):
+        """
+        Walks the scan index for the given layer, fetching tiles batch_size at a
+        time. Deduplicated tiles have their blobs fetched with a single query
+        per batch.
+        """
+
+        cursor = self.__find_scan_range(tile_type, zoom, bbox, after,
+                MongoTileStore.TILE_DATA_FIELDS)
+        cursor.batch_size(batch_size)
+
+        batch = []
+        for tile_doc in cursor:
+            batch.append(tile_doc)
+            if len(batch) >= batch_size:
+                for tile, tile_data, version in self.__resolve_tile_docs(batch):
+                    yield tile, tile_data
+                batch = []
+
+        for tile, tile_data, version in self.__resolve_tile_docs(batch):
+            yield tile, tile_data
+
+    def get_updated(self, since):
+        """
+        Walks the update date index for tiles updated at or after the given
+        time.
+        """
+
+        fields = {"x": True, "y": True, "zoom": True, "tile_type": True,
+                "update_date": True}
+        cursor = self.collection.find({"update_date": {"$gte": since}},
+                fields=fields)
+        cursor.sort("update_date", pymongo.ASCENDING)
+
+        for tile_doc in cursor:
+            tile_type = Tile.TileType(**tile_doc["tile_type"])
+            tile = Tile.from_google(tile_doc["x"], tile_doc["y"],
+                    tile_doc["zoom"])
+            yield tile_type, tile, tile_doc["update_date"]
+
+    def get_oldest(self, limit, before=None):
+        """
+        Walks the update date index from its oldest end.
+        """
+
+        query = {}
+        if before is not None:
+            query["update_date"] = {"$lt": before}
+
+        fields = {"x": True, "y": True, "zoom": True, "tile_type": True,
+                "update_date": True}
+        cursor = self.collection.find(query, fields=fields)
+        cursor.sort("update_date", pymongo.ASCENDING)
+        cursor.limit(limit)
+
+        for tile_doc in cursor:
+            tile_type = Tile.TileType(**tile_doc["tile_type"])
+            tile = Tile.from_google(tile_doc["x"], tile_doc["y"],
+                    tile_doc["zoom"])
+            yield tile_type, tile, tile_doc["update_date"]
+
+    def scan_tiles(self, tile_type, zoom, bbox=None, after=None):
+        """
+        Walks the scan index without fetching any image data.
+        """
+
+        fields = {"_id": False, "x": True, "y": True}
+        for tile_doc in self.__find_scan_range(tile_type, zoom, bbox, after,
+                fields):
+            yield Tile.from_google(tile_doc["x"], tile_doc["y"], zoom)
+
+    def get_layer_extent(self, tile_type, zoom):
+        """
+        Counts the layer's tiles and finds its first and last rows from either
+        end of the scan index.
+        """
+
+        query = {"tile_type.v": tile_type.v, "zoom": int(zoom)}
+        fields = {"_id": False, "y": True}
+
+        num_tiles = self.collection.find(query, fields=fields).count()
+        if num_tiles == 0:
+            return None
+
+        first = self.collection.find(query, fields=fields).sort(
+                "y", pymongo.ASCENDING).limit(1)[0]
+        last = self.collection.find(query, fields=fields).sort(
+                "y", pymongo.DESCENDING).limit(1)[0]
+
+        return num_tiles, first["y"], last["y"]
+
+    def __find_scan_range(self, tile_type, zoom, bbox, after, fields):
+        """
+        Returns a cursor over the tile documents in a scan's range, in order.
+        """
+
+        query = {"tile_type.v": tile_type.v, "zoom": int(zoom)}
+
+        if bbox is not None:
+            x_min, y_min, x_max, y_max = bbox
+            query["x"] = {"$gte": int(x_min), "$lte": int(x_max)}
+            query["y"] = {"$gte": int(y_min), "$lte": int(y_max)}
+
+        if after is not None:
+            y, x = after
+            query["$or"] = [
+                {"y": {"$gt": int(y)}},
+                {"y": int(y), "x": {"$gt": int(x)}}
+            ]
+
+        cursor = self.collection.find(query, fields=fields)
+        cursor.sort([("y", pymongo.ASCENDING), ("x", pymongo.ASCENDING)])
+        return cursor
+
+    def __resolve_tile_docs(self, tile_docs):
+        """
+        Returns (tile, tile_data, version) triples for a list of tile documents,
+        looking up the data for deduplicated tiles with a single query.
+        """
+
+        blob_hashes = [d["blob_hash"] for d in tile_docs if "blob_hash" in d]
+
+        blobs = {}
+        if len(blob_hashes) > 0:
+            for blob in self.blobs.find({"_id": {"$in": blob_hashes}}):
+                blobs[blob["_id"]] = blob["data"]
+
+        results = []
+        for tile_doc in tile_docs:
+            tile_data = tile_doc.get("image_data")
+            if "blob_hash" in tile_doc:
+                tile_data = blobs.get(tile_doc["blob_hash"])
+
+            # skip tiles whose blob went missing
+            if tile_data is not None:
+                tile = Tile.from_google(tile_doc["x"], tile_doc["y"],
+                        tile_doc["zoom"])
+                results.append((tile, str(tile_data),
+                        MongoTileStore.get_tile_doc_version(tile_doc)))
+
+        return results
+
+    def __release_blob(self, blob_hash):
+        """
+        Drops one reference to the given blob, removing it when none remain.
+        """
+
+        blob = self.blobs.find_and_modify({"_id": blob_hash},
+                {"$inc": {"refcount": -1}}, new=True, fields={"refcount": True})
+
+        # only remove the blob if nothing re-referenced it in the meantime
+        if blob is not None and blob["refcount"] <= 0:
+            self.blobs.remove({"_id": blob_hash, "refcount": {"$lte": 0}})
+
+class Recrawler:
+    """
+    Keeps the tiles in a store fresh by downloading the stalest of them again,
+    a few at a time, within a budget of requests per hour. Candidates are read
+    from the oldest end of the store's update date index, so the store is never
+    sorted or read in full. Each is scored by its age, a weight for its zoom
+    level, and optionally how often the tile server was asked for it, and the
+    highest scoring are downloaded through download_tiles(). Tiles that are
+    still stale after being downloaded failed to download, and are passed over
+    for a while so they can't take the whole budget round after round.
+    """
+
+    # tiles updated more recently than this many seconds ago are left alone
+    DEFAULT_MIN_AGE = 24 * 60 * 60
+
+    # how long, in seconds, a tile that failed to download is passed over
+    DEFAULT_RETRY_DELAY = 6 * 60 * 60
+
+    # how many candidates are scored for each tile downloaded
+    DEFAULT_WINDOW_FACTOR = 10
+
+    def __init__(self, tile_store, requests_per_hour, zoom_weights=None,
+            access_counts=None, access_weight=1.0, min_age=DEFAULT_MIN_AGE,
+            window_factor=DEFAULT_WINDOW_FACTOR,
+            retry_delay=DEFAULT_RETRY_DELAY):
+        """
+        zoom_weights maps zoom levels to how much more urgently their tiles
+        should be refreshed than others, defaulting to 1. access_counts maps
+        (tile type v, x, y, zoom) keys to how often each tile was requested, as
+        count_tile_requests() returns them, and access_weight is how much those
+        counts count for.
+        """
+
+        if requests_per_hour <= 0:
+            raise ValueError("requests_per_hour must be greater than 0")
+
+        self.tile_store = tile_store
+        self.requests_per_hour = requests_per_hour
+        self.zoom_weights = {} if zoom_weights is None else zoom_weights
+        self.access_counts = {} if access_counts is None else access_counts
+        self.access_weight = access_weight
+        self.min_age = min_age
+        self.window_factor = window_factor
+        self.retry_delay = retry_delay
+
+        # maps (tile type v, x, y, zoom) keys of tiles we've tried to download
+        # to when we last tried, forgotten once the retry delay is up
+        self.attempts = {}
+
+    def get_priority(self, tile_type, tile, update_date, now):
+        """
+        Returns how urgently a tile last updated at the given time should be
+        downloaded again. Popular tiles count for more, but with diminishing
+        returns, so a few very popular tiles can't starve all the others.
+        """
+
+        priority = max(now - update_date, 0) * self.zoom_weights.get(tile.zoom,
+                1.0)
+
+        count = self.access_counts.get((tile_type.v, tile.x, tile.y, tile.zoom))
+        if count is not None:
+            priority *= 1 + self.access_weight * log(1 + count)
+
+        return priority
+
+    def choose(self, num_tiles, now=None):
+        """
+        Returns a list of up to num_tiles (tile_type, tile) pairs that should be
+        downloaded again, most urgent first.
+        """
+
+        now = time.time() if now is None else now
+
+        for key, attempt_date in self.attempts.items():
+            if attempt_date + self.retry_delay <= now:
+                del self.attempts[key]
+
+        # read past the tiles we'll pass over, so they can't fill the window
+        candidates = self.tile_store.get_oldest(
+                num_tiles * self.window_factor + len(self.attempts),
+                before=now - self.min_age)
+        candidates = (c for c in candidates if not self.__is_failing(*c))
+        chosen = heapq.nlargest(num_tiles, candidates,
+                key=lambda c: self.get_priority(c[0], c[1], c[2], now))
+
+        return [(tile_type, tile) for tile_type, tile, update_date in chosen]
+
+    def __is_failing(self, tile_type, tile, update_date):
+        attempt_date = self.attempts.get(
+                (tile_type.v, tile.x, tile.y, tile.zoom))
+        return attempt_date is not None and update_date < attempt_date
+
+    def mark_attempted(self, chosen, now=None):
+        """
+        Records that the given (tile_type, tile) pairs are being downloaded
+        again, so any that are still stale afterwards are passed over by
+        choose() until the retry delay is up.
+        """
+
+        now = time.time() if now is None else now
+
+        for tile_type, tile in chosen:
+            self.attempts[(tile_type.v, tile.x, tile.y, tile.zoom)] = now
+
+    def run(self, interval=60, num_rounds=None, num_threads=10, num_writers=1,
+            logger=None, metrics=None):
+        """
+        Downloads tiles again in rounds every interval seconds, forever or for
+        num_rounds rounds. Each round downloads as many tiles as the budget has
+        allowed for since the last, carrying fractions of a tile over, but never
+        more than one interval's worth, so a slow round doesn't cause a burst.
+        """
+
+        # use a default logger if none was specified
+        logger = NULL_LOGGER if logger is None else logger
+
+        metrics = Metrics() if metrics is None else metrics
+
+        budget = 0.0
+        last_round = time.time() - interval
+        num_done = 0
+        while num_rounds is None or num_done < num_rounds:
+            round_start = time.time()
+            elapsed = min(round_start - last_round, interval)
+            budget += self.requests_per_hour * elapsed / 3600.0
+            last_round = round_start
+
+            num_tiles = int(budget)
+            chosen = self.choose(num_tiles, round_start) if num_tiles > 0 else []
+            budget -= len(chosen)
+
+            # an up-to-date store shouldn't bank budget for a burst later
+            if len(chosen) < num_tiles:
+                budget = min(budget, 1.0)
+
+            logger.info("Recrawling %d stale tiles", len(chosen))
+            metrics.increment("mapper_recrawl_tiles_total", len(chosen))
+            self.mark_attempted(chosen, round_start)
+
+            chosen.sort(key=lambda c: c[0].v)
+            for tile_type, group in itertools.groupby(chosen,
+                    lambda c: c[0]):
+                download_tiles(tile_type, (tile for t, tile in group),
+                        self.tile_store, num_threads=num_threads,
+                        logger=logger, num_writers=num_writers,
+                        metrics=metrics)
+
+            num_done += 1
+            if num_rounds is None or num_done < num_rounds:
+                time.sleep(max(0, round_start + interval - time.time()))
+
+class DownloadJob:
+    """
+    Tiles of one type to download into a tile store, run alongside other jobs
+    by a JobRunner. weight is the job's share of the runner's download threads
+    relative to the other jobs it's competing with, and priority decides which
+    jobs compete at all when the runner schedules by priority.
+    """
+
+    def __init__(self, name, tile_type, tiles, tile_store, weight=1.0,
+            priority=0):
+        if weight <= 0:
+            raise ValueError("weight must be greater than 0")
+
+        self.name = name
+        self.tile_type = tile_type
+        self.tiles = tiles
+        self.tile_store = tile_store
+        self.weight = weight
+        self.priority = priority
+
+        # progress, updated by the runner
+        self.num_downloaded = 0
+        self.num_failed = 0
+        self.num_active = 0
+        self.exhausted = False
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.finished = threading.Event()
+
+        # tiles waiting to be downloaded, filled by the runner
+        self.ready = None
+
+        # how much service the job has had, scaled by its weight
+        self.pass_value = 0.0
+
+    @staticmethod
+    def from_spec(spec, tile_stores=None):
+        """
+        Creates a job from a dict describing it, like those in the jobs files
+        read by 'mapper.py jobs'. Keys are:
+          name: the job's name, for progress reports (required)
+          tile_store: a store spec, as tile_store_from_spec() takes (required)
+          shape_files: a list of shape files whose areas are downloaded
+          vertices: a list of [latitude, longitude] pairs of an area's outline,
+            like the area selector exports, instead of shape files
+          manifest: a manifest file to download instead of any areas
+          corridor: download the tiles within this distance of the shape files
+            as routes, in tiles, or in metres as a string ending in "m"
+          tile_type, min_zoom, max_zoom, simplify: as the download command's
+            options, with the same defaults
+          weight, priority: as DownloadJob takes them
+        Jobs with the same tile_store spec share one store, and so its
+        connections, through the tile_stores dict if it's given. Raises
+        ValueError for invalid specs, and IOError for shape or manifest files
+        that can't be read.
+        """
+
+        if not isinstance(spec, dict):
+            raise ValueError("Job spec isn't an object: " + repr(spec))
+
+        tile_stores = {} if tile_stores is None else tile_stores
+
+        def get(key, default=None, required=False):
+            if required and key not in spec:
+                raise ValueError("Job spec is missing " + repr(key) + ": " +
+                        repr(spec))
+            return spec.get(key, default)
+
+        name = get("name", required=True)
+
+        store_spec = get("tile_store", required=True)
+        if store_spec not in tile_stores:
+            tile_stores[store_spec] = tile_store_from_spec(store_spec)
+
+        tile_types = dict((t.name, t) for t in Tile.TYPES)
+        tile_type = tile_types.get(get("tile_type", "map"))
+        if tile_type is None:
+            raise ValueError("Unknown tile type in job " + repr(name) + ": " +
+                    repr(get("tile_type")))
+
+        min_zoom, max_zoom = int(get("min_zoom", 0)), int(get("max_zoom", 0))
+        if not (0 <= min_zoom <= max_zoom <= Tile.MAX_ZOOM):
+            raise ValueError("Invalid zoom range in job " + repr(name) + ": " +
+                    str(min_zoom) + "-" + str(max_zoom))
+        zoom_levels = xrange(min_zoom, max_zoom + 1)
+
+        sources = [k for k in ("shape_files", "vertices", "manifest")
+                if k in spec]
+        if len(sources) != 1:
+            raise ValueError("Job " + repr(name) + " needs exactly one of " +
+                    "shape_files, vertices, and manifest")
+
+        if "manifest" in spec:
+            # check the manifest now, since its tiles aren't read until later
+            TileManifest(get("manifest")).close()
+            tiles = generate_manifest_tiles(get("manifest"))
+        elif "corridor" in spec:
+            distance = str(get("corridor"))
+            in_metres = distance.endswith("m")
+            distance = float(distance[:-1] if in_metres else distance)
+
+            lines = []
+            if "vertices" in spec:
+                lines.append([Tile.from_mercator(lat, lng, 0)
+                        for lat, lng in get("vertices")])
+            else:
+                for shape_file in get("shape_files"):
+                    lines.extend(parse_shape_lines(shape_file))
+            tiles = generate_corridor_tiles(lines, zoom_levels, distance,
+                    in_metres)
+        else:
+            polygons = []
+            if "vertices" in spec:
+                polygons.append([[Tile.from_mercator(lat, lng, 0)
+                        for lat, lng in get("vertices")]])
+            else:
+                for shape_file in get("shape_files"):
+                    polygons.extend(parse_shape_polygons(shape_file))
+            tiles = generate_areas_tiles(polygons, zoom_levels,
+                    simplify_tolerance=float(get("simplify", 0)))
+
+        return DownloadJob(name, tile_type, tiles, tile_stores[store_spec],
+                weight=float(get("weight", 1.0)),
+                priority=int(get("priority", 0)))
+
+    def is_done(self):
+        """
+        Returns whether every one of the job's tiles has been downloaded or has
+        failed.
+        """
+
+        return (self.exhausted and self.ready is not None and
+                self.ready.empty() and self.num_active == 0)
+
+    def get_progress(self):
+        """
+        Returns a dict describing how far along the job is.
+        """
+
+        end = time.time() if self.finished_at is None else self.finished_at
+        elapsed = 0 if self.started_at is None else end - self.started_at
+        return {
+            "name": self.name,
+            "downloaded": self.num_downloaded,
+            "failed": self.num_failed,
+            "active": self.num_active,
+            "done": self.finished.is_set(),
+            "error": None if self.error is None else str(self.error),
+            "seconds": elapsed,
+            "tiles_per_second": self.num_downloaded / max(elapsed, 0.001),
+        }
+
+class JobRunner:
+    """
+    Runs many download jobs at once in one process. They share one pool of
+    download threads and one StoreWriter, so together they make no more
+    requests at once than a single download would. Free threads are given to
+    jobs by stride scheduling. Each job gets a share of the downloads
+    proportional to its weight. A job submitted later starts level with the
+    others rather than catching up on service it never asked for. With the
+    "priority" policy, only the jobs with the highest priority among those
+    with tiles ready are considered. Jobs may be submitted while others run.
+    """
+
+    POLICIES = ["fair", "priority"]
+
+    # how many of each job's tiles are worked out ahead of their download
+    READY_SIZE = 100
+
+    def __init__(self, num_threads=10, num_writers=1, policy="fair",
+            max_failures=10, report_interval=None, logger=None, metrics=None):
+        """
+        Starts the download threads. If report_interval is given, each running
+        job's progress is logged that often, in seconds.
+        """
+
+        if num_threads <= 0:
+            raise ValueError("num_threads must be greater than 0")
+        if policy not in JobRunner.POLICIES:
+            raise ValueError("Unknown scheduling policy: " + repr(policy))
+
+        self.policy = policy
+        self.max_failures = max_failures
+        self.logger = NULL_LOGGER if logger is None else logger
+        self.metrics = Metrics() if metrics is None else metrics
+
+        self.jobs = []
+        self.closed = False
+        self.condition = threading.Condition()
+
+        # the pass value of the last job served, where new jobs start
+        self.virtual_time = 0.0
+
+        self.tile_writer = StoreWriter(num_writers, logger=self.logger,
+                metrics=self.metrics)
+
+        self.threads = []
+        for i in xrange(num_threads):
+            thread = threading.Thread(target=self.__download_tiles)
+            thread.daemon = True
+            self.threads.append(thread)
+            thread.start()
+
+        self.report_event = threading.Event()
+        if report_interval is not None:
+            thread = threading.Thread(target=self.__report_periodically,
+                    args=(report_interval,))
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, job):
+        """
+        Starts running a job, and returns it.
+        """
+
+        job.ready = queue.Queue(JobRunner.READY_SIZE)
+
+        with self.condition:
+            if self.closed:
+                raise ValueError("Can't submit jobs to a closed runner")
+
+            job.pass_value = self.virtual_time
+            job.started_at = time.time()
+            self.jobs.append(job)
+
+        # work out the job's tiles away from the download threads
+        thread = threading.Thread(target=self.__fill_ready, args=(job,))
+        thread.daemon = True
+        thread.start()
+
+        self.logger.info("Started job %s", job.name)
+        return job
+
+    def wait(self):
+        """
+        Blocks until every job submitted so far is done.
+        """
+
+        with self.condition:
+            jobs = list(self.jobs)
+
+        for job in jobs:
+            while not job.finished.wait(0.1):
+                continue
+
+    def close(self):
+        """
+        Waits for every job to finish, then stops the download threads and
+        flushes the store writer.
+        """
+
+        self.wait()
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        [thread.join() for thread in self.threads]
+        self.tile_writer.close()
+        self.report_event.set()
+
+    def get_progress(self):
+        """
+        Returns a list of dicts describing how far along each job is, in the
+        order they were submitted.
+        """
+
+        with self.condition:
+            return [job.get_progress() for job in self.jobs]
+
+    def __fill_ready(self, job):
+        """
+        Puts a job's tiles in its ready queue, then marks it exhausted.
+        """
+
+        try:
+            for tile in job.tiles:
+                job.ready.put(tile)
+        except Exception, e:
+            job.error = e
+            self.logger.error("Job %s failed: %s", job.name, e)
+        finally:
+            with self.condition:
+                job.exhausted = True
+                self.condition.notify_all()
+
+    def __next_tile(self):
+        """
+        Returns the next (job, tile) pair to download, waiting until one is
+        ready, or None once the runner is closed.
+        """
+
+        with self.condition:
+            while 1:
+                ready = []
+                for job in self.jobs:
+                    if not job.ready.empty():
+                        ready.append(job)
+                    else:
+                        self.__finish_if_done(job)
+
+                if self.policy == "priority" and len(ready) > 0:
+                    top = max(job.priority for job in ready)
+                    ready = [job for job in ready if job.priority == top]
+
+                if len(ready) > 0:
+                    job = min(ready, key=lambda j: j.pass_value)
+                    self.virtual_time = job.pass_value
+                    job.pass_value += 1.0 / job.weight
+                    job.num_active += 1
+
+                    # only this thread takes from ready queues, under the lock
+                    return job, job.ready.get_nowait()
+
+                if self.closed:
+                    return None
+
+                # tiles may be put in ready queues without notifying us
+                self.condition.wait(0.1)
+
+    def __finish_if_done(self, job):
+        """
+        Marks a job finished and logs how it went, if it's done and hasn't been
+        already. Must hold the condition.
+        """
+
+        if job.finished.is_set() or not job.is_done():
+            return
+
+        job.finished_at = time.time()
+        job.finished.set()
+
+        progress = job.get_progress()
+        self.logger.info("Finished job %s: %d tiles downloaded, %d failed, " +
+                "in %.1f seconds", job.name, progress["downloaded"],
+                progress["failed"], progress["seconds"])
+
+    def __download_tiles(self):
+        """
+        Downloads tiles from the jobs until the runner is closed.
+        """
+
+        while 1:
+            item = self.__next_tile()
+            if item is None:
+                return
+
+            job, tile = item
+            downloaded = download_tile(job.tile_type, tile, job.tile_store,
+                    self.tile_writer, self.max_failures, self.logger,
+                    self.metrics)
+
+            self.metrics.increment("mapper_job_tiles_total", job=job.name,
+                    result="downloaded" if downloaded else "failed")
+
+            with self.condition:
+                job.num_active -= 1
+                if downloaded:
+                    job.num_downloaded += 1
+                else:
+                    job.num_failed += 1
+
+                self.__finish_if_done(job)
+
+    def __report_periodically(self, interval):
+        """
+        Logs every running job's progress each interval seconds until closed.
+        """
+
+        while not self.report_event.wait(interval):
+            for progress in self.get_progress():
+                if progress["done"]:
+                    continue
+                self.logger.info("Job %s: %d tiles downloaded, %d failed, " +
+                        "%.1f tiles/second", progress["name"],
+                        progress["downloaded"], progress["failed"],
+                        progress["tiles_per_second"])
+
+class StoreWriter:
+    """
+    A bounded buffer of downloaded tiles waiting to be stored, drained by its own
+    writer threads. This keeps slow stores from stalling downloads until the
+    buffer fills, at which point put() blocks to apply backpressure. Tiles are
+    handed to their stores in batches grouped by store and tile type, so
+    stores only see calls from the writer threads rather than from every
+    downloading thread.
+    """
+
+    # default number of tiles that may wait to be stored
+    DEFAULT_BUFFER_SIZE = 1000
+
+    # default maximum number of tiles handed to a store at once
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, num_threads=1, buffer_size=None, batch_size=None,
+            logger=None, metrics=None, tracer=None):
+        """
+        Starts num_threads writer threads. If num_threads is 0, no threads are
+        started and put() stores each tile immediately in the calling thread.
+        Stored tiles and store latency are recorded in metrics, a Metrics
+        registry, if given, and timed per tile by tracer, a Tracer, if given.
+        """
+
+        if num_threads < 0:
+            raise ValueError("num_threads must be at least 0")
+
+        self.buffer_size = (StoreWriter.DEFAULT_BUFFER_SIZE
+                if buffer_size is None else buffer_size)
+        self.batch_size = (StoreWriter.DEFAULT_BATCH_SIZE
+                if batch_size is None else batch_size)
+        self.logger = NULL_LOGGER if logger is None else logger
+        self.metrics = Metrics() if metrics is None else metrics
+        self.tracer = tracer
+
+        self.tile_queue = queue.Queue(self.buffer_size)
+
+        # (tile_store, tile_type, tile) for tiles that couldn't be stored
+        self.failed_lock = threading.Lock()
+        self.failed_tiles = []
+
+        self.threads = []
+        for i in xrange(num_threads):
+            thread = threading.Thread(target=self.__write_tiles_from_queue)
+            thread.daemon = True
+            self.threads.append(thread)
+            thread.start()
+
+    def put(self, tile_store, tile_type, tile, tile_data):
+        """
+        Queues a tile to be stored in the given store, blocking while the buffer
+        is full.
+        """
+
+        if len(self.threads) == 0:
+            start = time.time()
+            tile_store.store(tile_type, tile, tile_data)
+            elapsed = time.time() - start
+
+            self.metrics.observe("mapper_store_seconds", elapsed)
+            self.metrics.increment("mapper_tiles_stored_total")
+            if self.tracer is not None:
+                self.tracer.record("store", tile, elapsed)
+        else:
+            queued_at = None if self.tracer is None else time.time()
+            self.tile_queue.put(
+                    (tile_store, tile_type, tile, tile_data, queued_at))
+
+    def depth(self):
+        """
+        Returns the approximate number of tiles waiting to be stored.
+        """
+
+        return self.tile_queue.qsize()
+
+    def close(self):
+        """
+        Waits for all queued tiles to be stored, then stops the writer threads.
+        No tiles may be put after the writer is closed. Returns a list of
+        (tile_store, tile_type, tile) for the tiles that couldn't be stored,
+        which is empty if every tile was stored.
+        """
+
+        # a None item tells a writer thread to exit
+        for thread in self.threads:
+            self.tile_queue.put(None)
+
+        [thread.join() for thread in self.threads]
+        self.threads = []
+
+        with self.failed_lock:
+            failed_tiles = self.failed_tiles
+            self.failed_tiles = []
+
+        if len(failed_tiles) > 0:
+            self.logger.error("Failed to store " + str(len(failed_tiles)) +
+                    " tiles")
+
+        return failed_tiles
+
+    def __write_tiles_from_queue(self):
+        """
+        Pulls tiles from the queue and stores them until told to stop.
+        """
+
+        tname = threading.current_thread().name
+
+        done = False
+        while not done:
+            # wait for a tile, then grab whatever else is ready to form a batch
+            batch = [self.tile_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.tile_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # group tiles by store and type, keeping their order within groups
+            groups = defaultdict(list)
+            dequeued_at = time.time()
+            for item in batch:
+                if item is None:
+                    done = True
+                    continue
+
+                tile_store, tile_type, tile, tile_data, queued_at = item
+                groups[(tile_store, tile_type)].append((tile, tile_data))
+
+                if self.tracer is not None:
+                    self.tracer.record("store_queue", tile,
+                            dequeued_at - queued_at)
+
+            for (tile_store, tile_type), tiles_and_data in groups.iteritems():
+                try:
+                    start = time.time()
+                    tile_store.store_many(tile_type, tiles_and_data)
+                    elapsed = time.time() - start
+
+                    self.metrics.observe("mapper_store_seconds", elapsed)
+                    self.metrics.increment("mapper_tiles_stored_total",
+                            len(tiles_and_data))
+
+                    # each tile waited on the whole batch
+                    if self.tracer is not None:
+                        for tile, tile_data in tiles_and_data:
+                            self.tracer.record("store", tile, elapsed)
+                except Exception, e:
+                    # retry the tiles one at a time so one bad tile can't
+                    # take the rest of its batch down with it
+                    self.logger.warning(tname + " failed to store " +
+                            str(len(tiles_and_data)) + " tiles, retrying " +
+                            "them one at a time: " + str(e))
+                    self.__store_each(tile_store, tile_type, tiles_and_data)
+
+            # put back any exit signals beyond our own for the other threads
+            for i in xrange(batch.count(None) - 1):
+                self.tile_queue.put(None)
+
+        self.logger.debug(tname + " got halt signal, exiting")
+
+    def __store_each(self, tile_store, tile_type, tiles_and_data):
+        """
+        Stores tiles one at a time, recording those that still fail so close()
+        can report them.
+        """
+
+        tname = threading.current_thread().name
+
+        for tile, tile_data in tiles_and_data:
+            try:
+                start = time.time()
+                tile_store.store(tile_type, tile, tile_data)
+                elapsed = time.time() - start
+
+                self.metrics.observe("mapper_store_seconds", elapsed)
+                self.metrics.increment("mapper_tiles_stored_total")
+                if self.tracer is not None:
+                    self.tracer.record("store", tile, elapsed)
+            except Exception, e:
+                self.logger.error(tname + " failed to store " + str(tile) +
+                        ": " + str(e))
+                self.metrics.increment("mapper_store_errors_total")
+
+                with self.failed_lock:
+                    self.failed_tiles.append((tile_store, tile_type, tile))
+
+class Metrics:
+    """
+    A thread-safe registry of counters, gauges, and histograms describing a
+    running job. Each metric is identified by a name and optional labels, given
+    as keyword arguments, and may be exported as a JSON-ready dict or in the
+    Prometheus text format.
+    """
+
+    # default histogram bucket upper bounds, in seconds
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # metric values by (name, labels), labels being a sorted tuple of pairs
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def get_key(name, labels):
+        return (name, tuple(sorted(labels.iteritems())))
+
+    def increment(self, name, amount=1, **labels):
+        """
+        Adds an amount to a counter, creating it if necessary.
+        """
+
+        key = Metrics.get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def get_counter(self, name, **labels):
+        """
+        Returns the current value of a counter, 0 if it doesn't exist.
+        """
+
+        with self.lock:
+            return self.counters.get(Metrics.get_key(name, labels), 0)
+
+    def track_gauge(self, name, get_value, **labels):
+        """
+        Registers a function returning a gauge's current value, called whenever
+        the metrics are exported. Replaces any function already registered for
+        the gauge.
+        """
+
+        with self.lock:
+            self.gauges[Metrics.get_key(name, labels)] = get_value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Counts a value towards a histogram, creating it with the given bucket
+        upper bounds if necessary.
+        """
+
+        key = Metrics.get_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {
+                    "buckets": buckets,
+                    "counts": [0] * (len(buckets) + 1),
+                    "sum": 0.0,
+                }
+                self.histograms[key] = histogram
+
+            histogram["counts"][bisect.bisect_left(buckets, value)] += 1
+            histogram["sum"] += value
+
+    def snapshot(self):
+        """
+        Returns the current value of every metric as a dict of counters, gauges,
+        and histograms, each a list of dicts with the metric's name, labels,
+        and value(s). Histogram bucket counts are cumulative, keyed by their
+        upper bounds as strings, the last being "+Inf".
+        """
+
+        with self.lock:
+            counters = self.counters.items()
+            gauges = self.gauges.items()
+            histograms = [(key, dict(h, counts=list(h["counts"])))
+                    for key, h in self.histograms.iteritems()]
+
+        result = {"counters": [], "gauges": [], "histograms": []}
+
+        for (name, labels), value in sorted(counters):
+            result["counters"].append(
+                    {"name": name, "labels": dict(labels), "value": value})
+
+        for (name, labels), get_value in sorted(gauges):
+            result["gauges"].append(
+                    {"name": name, "labels": dict(labels), "value": get_value()})
+
+        for (name, labels), histogram in sorted(histograms):
+            bounds = [repr(b) for b in histogram["buckets"]] + ["+Inf"]
+            counts = []
+            total = 0
+            for count in histogram["counts"]:
+                total += count
+                counts.append(total)
+
+            result["histograms"].append({
+                "name": name,
+                "labels": dict(labels),
+                "buckets": dict(zip(bounds, counts)),
+                "count": total,
+                "sum": histogram["sum"],
+            })
+
+        return result
+
+    def format_prometheus(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+
+        def format_labels(labels):
+            if len(labels) == 0:
+                return ""
+            return "{" + ",".join(k + "=" + json.dumps(str(v))
+                    for k, v in sorted(labels.iteritems())) + "}"
+
+        lines = []
+        snapshot = self.snapshot()
+
+        for kind in ("counter", "gauge"):
+            typed = set()
+            for metric in snapshot[kind + "s"]:
+                if metric["name"] not in typed:
+                    lines.append("# TYPE " + metric["name"] + " " + kind)
+                    typed.add(metric["name"])
+
+                lines.append(metric["name"] + format_labels(metric["labels"]) +
+                        " " + repr(metric["value"]))
+
+        typed = set()
+        for metric in snapshot["histograms"]:
+            name = metric["name"]
+            if name not in typed:
+                lines.append("# TYPE " + name + " histogram")
+                typed.add(name)
+
+            buckets = sorted(metric["buckets"].iteritems(),
+                    key=lambda b: float(b[0]))
+            for bound, count in buckets:
+                labels = dict(metric["labels"], le=bound)
+                lines.append(name + "_bucket" + format_labels(labels) + " " +
+                        str(count))
+
+            labels = format_labels(metric["labels"])
+            lines.append(name + "_sum" + labels + " " + repr(metric["sum"]))
+            lines.append(name + "_count" + labels + " " + str(metric["count"]))
+
+        return "\n".join(lines) + "\n"
+
+class MetricsReporter:
+    """
+    Periodically reports on a Metrics registry from a background thread,
+    logging the recent download rate and queue depths, and optionally appending
+    the full snapshot as a line of JSON to a file. Rates are averaged over the
+    last window_size reports and count completed downloads.
+    """
+
+    def __init__(self, metrics, interval, logger=None, json_file=None,
+            window_size=15):
+        if interval <= 0:
+            raise ValueError("Interval must be greater than 0")
+
+        if window_size < 1:
+            raise ValueError("Window size must be at least 1")
+
+        self.metrics = metrics
+        self.interval = interval
+        self.logger = NULL_LOGGER if logger is None else logger
+        self.json_file = json_file
+
+        # (time, tiles, bytes) samples, first item is oldest
+        self.window = deque(maxlen=window_size + 1)
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start reporting.
+        """
+
+        self.stop_event.clear()
+        self.window.clear()
+        self.sample()
+
+        self.thread = threading.Thread(target=self.__report_periodically)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop reporting, making one last report first.
+        """
+
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def sample(self):
+        self.window.append((time.time(),
+                self.metrics.get_counter("mapper_tiles_downloaded_total"),
+                self.metrics.get_counter("mapper_bytes_downloaded_total")))
+
+    def get_rates(self):
+        """
+        Returns the average (tiles/second, bytes/second) download rates over the
+        current window.
+        """
+
+        first_time, first_tiles, first_bytes = self.window[0]
+        last_time, last_tiles, last_bytes = self.window[-1]
+
+        elapsed = last_time - first_time
+        if elapsed <= 0:
+            return 0.0, 0.0
+
+        return ((last_tiles - first_tiles) / elapsed,
+                (last_bytes - first_bytes) / elapsed)
+
+    def report(self):
+        """
+        Logs the current rates and queue depths, and writes the current
+        snapshot to the JSON file if there is one.
+        """
+
+        self.sample()
+        tile_rate, byte_rate = self.get_rates()
+        snapshot = self.metrics.snapshot()
+
+        self.logger.info("Download rate (tiles/second): " +
+                str(round(tile_rate, 1)) + ", (bytes/second): " +
+                str(int(byte_rate)))
+
+        for gauge in snapshot["gauges"]:
+            if gauge["name"] == "mapper_queue_depth":
+                self.logger.info(gauge["labels"]["stage"].capitalize() +
+                        " queue depth: " + str(gauge["value"]))
+
+        if self.json_file is not None:
+            snapshot["time"] = self.window[-1][0]
+            snapshot["tiles_per_second"] = tile_rate
+            snapshot["bytes_per_second"] = byte_rate
+            with open(self.json_file, "a") as f:
+                f.write(json.dumps(snapshot, sort_keys=True) + "\n")
+
+    def __report_periodically(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+        self.report()
+
+class Tracer:
+    """
+    Times each stage of a tile's life as it's downloaded and stored: enumerate
+    (generating it from its area), queue (waiting for a download thread),
+    connect and transfer (the HTTP request), store_queue (waiting for a
+    writer), and store. Timings are counted towards a per-stage histogram in a
+    Metrics registry, and written as lines of JSON to trace_file if given. The
+    download code holds None rather than a disabled tracer, so tracing costs
+    nothing unless it's on.
+    """
+
+    STAGES = ("enumerate", "queue", "connect", "transfer", "store_queue",
+            "store")
+
+    def __init__(self, metrics, trace_file=None):
+        self.metrics = metrics
+
+        self.trace_out = None
+        if trace_file is not None:
+            self.trace_out = open(trace_file, "a")
+        self.lock = threading.Lock()
+
+    def record(self, stage, tile, seconds):
+        """
+        Records that a tile spent some seconds in a stage.
+        """
+
+        self.metrics.observe("mapper_stage_seconds", seconds, stage=stage)
+
+        if self.trace_out is not None:
+            line = json.dumps({
+                "stage": stage,
+                "tile": [tile.x, tile.y, tile.zoom],
+                "seconds": seconds,
+                "end": time.time(),
+            })
+            with self.lock:
+                self.trace_out.write(line + "\n")
+
+    def trace_enumeration(self, tiles):
+        """
+        Yields the tiles from an iterable, recording the time taken to produce
+        each one.
+        """
+
+        tiles = iter(tiles)
+        while 1:
+            start = time.time()
+            try:
+                tile = tiles.next()
+            except StopIteration:
+                return
+
+            self.record("enumerate", tile, time.time() - start)
+            yield tile
+
+    def summarize(self):
+        """
+        Returns a list of (stage, count, total seconds) triples, in the order
+        stages occur.
+        """
+
+        totals = {}
+        for histogram in self.metrics.snapshot()["histograms"]:
+            if histogram["name"] == "mapper_stage_seconds":
+                totals[histogram["labels"]["stage"]] = (histogram["count"],
+                        histogram["sum"])
+
+        return [(stage,) + totals[stage] for stage in Tracer.STAGES
+                if stage in totals]
+
+    def close(self):
+        if self.trace_out is not None:
+            self.trace_out.close()
+            self.trace_out = None
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """
+    Serves the metrics in the Prometheus text format over HTTP on the given
+    local port, from a background thread. Returns the server, whose shutdown()
+    method stops it.
+    """
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.format_prometheus()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # don't write every scrape to stderr
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+class Polygon:
+    """
+    A utility class for operations on lists of vertices.
+    """
+
+    # represents the bounding box of some points
+    Bounds = namedtuple("Bounds", ["top", "right", "bottom", "left"])
+
+    # the smallest tolerance simplify() will try before giving up
+    MIN_SIMPLIFY_TOLERANCE = 0.125
+
+    class Edge:
+        """
+        Represents an edge used in the sorted edge table and active edge table
+        calculations.
+        """
+
+        def __init__(self, y_max, x_min, rise, run, y_min=None):
+            self.y_max = y_max
+            self.x_min = x_min
+            self.rise = rise
+            self.run = run
+
+            # where the edge starts and its slope, so its x can be found for
+            # any row
+            self.y_min = y_min
+            self.x_top = x_min
+            self.slope = 0 if rise == 0 else 1.0 * run / rise
+
+        def get_x(self, y):
+            """
+            Returns the x value where the edge crosses the given row. It's
+            worked out from the top of the edge rather than accumulated row by
+            row, so an edge gets the same x however far down it's picked up.
+            """
+
+            return self.x_top + (y - self.y_min) * self.slope
+
+        def __str__(self):
+            return repr(self)
+
+        def __repr__(self):
+            s = self.__class__.__name__ + "("
+            s += ", ".join(map(repr, (self.y_max, self.x_min, self.rise,
+                self.run)))
+            s += ")"
+
+            return s
+
+    def __init__(self):
+        raise NotImplemented(self.__class__.__name__ + " can't be instantiated")
+
+    @staticmethod
+    def get_bounds(*vertices):
+        """
+        Returns a Bounds object containing data about the bounding box that
+        contains the given vertices. If multiple vertices are at the bounds, the
+        first is used. If one vertex satisfies multiple bounds, it will be used
+        multiple times.
+        """
+
+        # find the furthest vertices in the cardinal directions
+        top = None
+        right = None
+        bottom = None
+        left = None
+        for vertex in vertices:
+            # top
+            if top is None or vertex[1] < top[1]:
+                top = vertex
+
+            # right
+            if right is None or vertex[0] > right[0]:
+                right = vertex
+
+            # bottom
+            if bottom is None or vertex[1] > bottom[1]:
+                bottom = vertex
+
+            # left
+            if left is None or vertex[0] < left[0]:
+                left = vertex
+
+        return Polygon.Bounds(top=top, right=right, bottom=bottom, left=left)
+
+    @staticmethod
+    def generate_vertex_pairs(vertices, exclude_horizontal=False):
+        """
+        Generates paired vertices from a list of vertices, including from last
+        vertex to first vertex. If exclude_horizontal is True, horizontal edge
+        pairs are not yielded.
+
+        Examples:
+            [] -> []
+            [A] -> [(A, A)]
+            [A, B] -> [(A, B), (B, A)]
+            [A, B, C] -> [(A, B), (B, C), (C, A)]
+        """
+
+        # don't do any work if we're too short
+        if len(vertices) == 0:
+            return
+
+        # turn our vertices into a sequence of adjacent vertex pairs
+        last_point = None
+        for point in vertices:
+            if last_point is None:
+                last_point = point
+                continue
+
+            # only yield non-horizontal edges if we're exluding them
+            if exclude_horizontal:
+                if point[1] != last_point[1]:
+                    yield (last_point, point)
+            else:
+                yield (last_point, point)
+
+            last_point = point
+
+        # add the pair from last to first
+        if exclude_horizontal:
+            if last_point[1] != vertices[0][1]:
+                yield (last_point, vertices[0])
+        else:
+            yield (last_point, vertices[0])
+
+
+    @staticmethod
+    def generate_line(a, b):
+        """
+        Rasterizes the line between the given points, and yields them all
+        in-order, endpoints included, using Bresenham's line drawing algorithm.
+
+        Reference: http://en.wikipedia.org/wiki/Bresenham's_line_algorithm
+        """
+
+        # make some shorthand variables
+        x0, y0 = a
+        x1, y1 = b
+
+        # an optimized version of the algorithm (see #Simplification in wiki)
+        dx = abs(x1 - x0)
+        dy = abs(y1 - y0)
+
+        sx = 1 if x0 < x1 else -1
+        sy = 1 if y0 < y1 else -1
+
+        err = dx - dy
+
+        while 1:
+            # yield a rasterized point on the line
+            yield (x0, y0)
+
+            if x0 == x1 and y0 == y1:
+                return
+
+            e2 = 2 * err
+
+            if e2 > -dy:
+                err -= dy
+                x0 += sx
+
+            if e2 < dx:
+                err += dx
+                y0 += sy
+
+    @staticmethod
+    def simplify(vertices, tolerance):
+        """
+        Returns the vertices of a simpler polygon with the same outline to
+        within tolerance, using the Douglas-Peucker algorithm. Simplifying must
+        not make the polygon's edges cross, so when it would, the tolerance is
+        halved and we try again, eventually giving up and returning the
+        vertices unchanged.
+        """
+
+        # collapse adjacent duplicate vertices, including the first and last
+        points = []
+        for vertex in vertices:
+            if len(points) == 0 or vertex != points[-1]:
+                points.append(vertex)
+        while len(points) > 1 and points[0] == points[-1]:
+            points.pop()
+
+        if len(points) <= 3:
+            return points
+
+        # split the ring in two at the vertex furthest from the first, so each
+        # half has distinct endpoints.
+        first = points[0]
+        split = max(xrange(len(points)), key=lambda i:
+                (points[i][0] - first[0]) ** 2 + (points[i][1] - first[1]) ** 2)
+
+        while tolerance >= Polygon.MIN_SIMPLIFY_TOLERANCE:
+            keep = Polygon.__simplify_chain(points, 0, split, tolerance)
+            keep.update(Polygon.__simplify_chain(points + [first], split,
+                len(points), tolerance))
+
+            # nothing to drop, or at least three vertices to keep
+            if len(keep) - 1 >= len(points):
+                return points
+
+            simplified = [points[i] for i in sorted(keep) if i < len(points)]
+            if (len(simplified) >= 3 and
+                    not Polygon.has_crossing_edges(simplified)):
+                return simplified
+
+            tolerance /= 2.0
+
+        return points
+
+    @staticmethod
+    def __simplify_chain(points, start, end, tolerance):
+        """
+        Returns the set of indexes of the vertices from start to end, inclusive,
+        that the Douglas-Peucker algorithm keeps.
+        """
+
+        keep = set([start, end])
+
+        # a stack instead of recursion, since coastlines can be very long
+        stack = [(start, end)]
+        while len(stack) > 0:
+            first, last = stack.pop()
+            if last - first < 2:
+                continue
+
+            (ax, ay), (bx, by) = points[first], points[last]
+            dx, dy = bx - ax, by - ay
+            length = (dx * dx + dy * dy) ** 0.5
+
+            # find the vertex furthest from the line between the endpoints
+            furthest, furthest_distance = None, -1.0
+            for i in xrange(first + 1, last):
+                px, py = points[i]
+                if length == 0:
+                    distance = ((px - ax) ** 2 + (py - ay) ** 2) ** 0.5
+                else:
+                    distance = abs(dy * px - dx * py + bx * ay - by * ax) / length
+
+                if distance > furthest_distance:
+                    furthest, furthest_distance = i, distance
+
+            if furthest_distance > tolerance:
+                keep.add(furthest)
+                stack.append((first, furthest))
+                stack.append((furthest, last))
+
+        return keep
+
+    @staticmethod
+    def has_crossing_edges(vertices):
+        """
+        Returns whether any two non-adjacent edges of the polygon described by
+        a list of vertices touch or cross. Edges are bucketed in a grid so only
+        those near each other are compared.
+        """
+
+        edges = list(Polygon.generate_vertex_pairs(vertices))
+        if len(edges) < 4:
+            return False
+
+        bounds = Polygon.get_bounds(*vertices)
+        extent = max(bounds.right[0] - bounds.left[0],
+                bounds.bottom[1] - bounds.top[1], 1)
+        cell_size = max(1.0, extent / (len(edges) ** 0.5))
+
+        cells = defaultdict(list)
+        for i, (a, b) in enumerate(edges):
+            for cx in xrange(int(min(a[0], b[0]) // cell_size),
+                    int(max(a[0], b[0]) // cell_size) + 1):
+                for cy in xrange(int(min(a[1], b[1]) // cell_size),
+                        int(max(a[1], b[1]) // cell_size) + 1):
+                    cells[(cx, cy)].append(i)
+
+        def orientation(p, q, r):
+            value = (q[1] - p[1]) * (r[0] - q[0]) - (q[0] - p[0]) * (r[1] - q[1])
+            return 0 if value == 0 else (1 if value > 0 else -1)
+
+        def on_segment(p, q, r):
+            return (min(p[0], r[0]) <= q[0] <= max(p[0], r[0]) and
+                    min(p[1], r[1]) <= q[1] <= max(p[1], r[1]))
+
+        compared = set()
+        for indexes in cells.itervalues():
+            for n, i in enumerate(indexes):
+                for j in indexes[n + 1:]:
+                    # adjacent edges always share a vertex
+                    if abs(i - j) <= 1 or abs(i - j) == len(edges) - 1:
+                        continue
+                    if (i, j) in compared:
+                        continue
+                    compared.add((i, j))
+
+                    (p1, q1), (p2, q2) = edges[i], edges[j]
+                    o1 = orientation(p1, q1, p2)
+                    o2 = orientation(p1, q1, q2)
+                    o3 = orientation(p2, q2, p1)
+                    o4 = orientation(p2, q2, q1)
+
+                    if o1 != o2 and o3 != o4:
+                        return True
+                    if ((o1 == 0 and on_segment(p1, p2, q1)) or
+                            (o2 == 0 and on_segment(p1, q2, q1)) or
+                            (o3 == 0 and on_segment(p2, p1, q2)) or
+                            (o4 == 0 and on_segment(p2, q1, q2))):
+                        return True
+
+        return False
+
+    @staticmethod
+    def generate_capsule_spans(a, b, radius):
+        """
+        Generates the points within radius of the line segment from a to b, the
+        shape a disc of that radius sweeps out moving along it, as (y, x_first,
+        x_last) spans from top to bottom.
+        """
+
+        (ax, ay), (bx, by) = a, b
+        dx, dy = bx - ax, by - ay
+        length_squared = dx * dx + dy * dy
+        reach = radius * (length_squared ** 0.5)
+
+        for y in xrange(int(ceil(min(ay, by) - radius)),
+                int(floor(max(ay, by) + radius)) + 1):
+            # the shape is convex, so each row is the extent of its three parts
+            x_min, x_max = float("inf"), float("-inf")
+
+            # the discs around the ends
+            for cx, cy in (a, b):
+                h = radius * radius - (y - cy) ** 2
+                if h >= 0:
+                    x_min = min(x_min, cx - h ** 0.5)
+                    x_max = max(x_max, cx + h ** 0.5)
+
+            # the band between them, whose points are within radius of the line
+            # and project onto the segment somewhere between its ends.
+            if length_squared > 0:
+                lo, hi = float("-inf"), float("inf")
+
+                offset = dx * (y - ay)
+                if dy != 0:
+                    x0 = ax + (offset - reach) / float(dy)
+                    x1 = ax + (offset + reach) / float(dy)
+                    lo, hi = max(lo, min(x0, x1)), min(hi, max(x0, x1))
+                elif abs(offset) > reach:
+                    lo, hi = 0, -1
+
+                along = dy * (y - ay)
+                if dx != 0:
+                    x0 = ax - along / float(dx)
+                    x1 = ax + (length_squared - along) / float(dx)
+                    lo, hi = max(lo, min(x0, x1)), min(hi, max(x0, x1))
+                elif not (0 <= along <= length_squared):
+                    lo, hi = 0, -1
+
+                if lo <= hi:
+                    x_min, x_max = min(x_min, lo), max(x_max, hi)
+
+            if x_min <= x_max:
+                x_first, x_last = int(ceil(x_min)), int(floor(x_max))
+                if x_first <= x_last:
+                    yield (y, x_first, x_last)
+
+    @staticmethod
+    def get_line(a, b):
+        """
+        Same as generate_line(), but returns a list instead of a generator.
+        """
+
+        return [point for point in Polygon.generate_line(a, b)]
+
+    @staticmethod
+    def generate_area(vertices):
+        """
+        Generates all the points on the rasterized polygon described by a list
+        of vertices and yields them in arbitrary order. Polygons are assumed to
+        have non-overlappind edges. Runs of identical vertices are collapsed
+        into a single value.
+        """
+
+        for y, x_first, x_last in Polygon.generate_spans(vertices):
+            for x in xrange(x_first, x_last + 1):
+                yield (x, y)
+
+    @staticmethod
+    def generate_spans(vertices, y_first=None, y_last=None):
+        """
+        Generates the points of the rasterized polygon described by a list of
+        vertices as (y, x_first, x_last) spans of horizontally adjacent points,
+        top to bottom and left to right, covering exactly the points
+        generate_area() would. If y_first or y_last are given, only rows
+        between them, inclusive, are generated, so a polygon may be rasterized
+        in bands.
+        """
+
+        y_first = -sys.maxint if y_first is None else y_first
+        y_last = sys.maxint if y_last is None else y_last
+
+        # collapse adjacent duplicate vertices
+        collapse = lambda a, p: a + [p] if (len(a) == 0 or p != a[-1]) else a
+        vertices = reduce(collapse, vertices, [])
+
+        # remove identical start/end vertices as well
+        while len(vertices) > 1 and vertices[0] == vertices[-1]:
+            vertices.pop()
+
+        # don't bother with calculations for corner cases
+        if len(vertices) <= 1:
+            points = vertices
+        elif len(vertices) == 2:
+            points = Polygon.generate_line(*vertices)
+
+        if len(vertices) <= 2:
+            for x, y in points:
+                if y_first <= y <= y_last:
+                    yield (y, x, x)
+            return
+
+        # condense consecutive vertical edges to single edges
+        new_vertices = []
+        cur = []
+        for vertex in vertices:
+            if len(cur) > 0 and vertex[0] != cur[0][0]:
+                # sort by y coordinate if we had a run of vertical sections
+                if len(cur) > 2:
+                    cur.sort(key=lambda v: v[1])
+
+                # keep the longest section
+                new_vertices.append(cur[0])
+
+                if len(cur) > 1:
+                    new_vertices.append(cur[-1])
+
+                # reset the vertex buffer to what it must be for next round
+                cur = [vertex]
+
+            if len(cur) == 0 or vertex[0] == cur[0][0]:
+                cur.append(vertex)
+
+        # append the final vertices
+        if len(cur) > 0:
+            if len(cur) > 2:
+                cur.sort(key=lambda v: v[1])
+
+            new_vertices.append(cur[0])
+
+            if len(cur) > 1:
+                new_vertices.append(cur[-1])
+
+        vertices = new_vertices
+
+        # build the SET, bucketing each non-horizontal edge by its top y
+        sorted_edges = defaultdict(list)
+        for a, b in Polygon.generate_vertex_pairs(vertices, True):
+            top, bottom = (a, b) if a[1] < b[1] else (b, a)
+
+            # the slope parts of the edge, to use edge coherence
+            rise = b[1] - a[1]
+            run = b[0] - a[0]
+
+            sorted_edges[top[1]].append(
+                    Polygon.Edge(bottom[1], top[0], rise, run, top[1]))
+
+        # keep the entries sorted by y_max then x_min
+        for edges in sorted_edges.itervalues():
+            edges.sort(key=lambda e: (e.y_max, e.x_min))
+
+        # a polygon of only horizontal edges has no area
+        if len(sorted_edges) == 0:
+            return
+
+        # list of active edges, those intersecting with the current scanline
+        active_edges = []
+
+        # starting y value is the smallest value in the SET, i.e. the top of
+        # our polygon's bounds, or the top of the band if that's lower.
+        y = max(min(sorted_edges), y_first)
+
+        # start with the edges that cross the first row from above it, at the
+        # x values they'd have reached it with, rather than walking every row
+        # above the band to get there.
+        for edge_top in [t for t in sorted_edges if t < y]:
+            for edge in sorted_edges.pop(edge_top):
+                if edge.y_max >= y:
+                    edge.x_min = edge.get_x(y)
+                    active_edges.append(edge)
+
+        # continue while sorted edges or active edges have entries
+        while (len(sorted_edges) > 0 or len(active_edges) > 0) and y <= y_last:
+            # move y bucket into active edge list if the edges' y-min (the key
+            # into sorted edges) is the current y.
+            if y in sorted_edges:
+                active_edges.extend(sorted_edges.pop(y))
+
+            # sort active edges by x coordinates
+            active_edges.sort(key=lambda e: e.x_min)
+
+            # fill between pairs of intersections (excluding the final new edge
+            # if we added an odd number), merging spans that share a point at
+            # 'v'-shaped intersections.
+            last_span = None
+            for a, b in itertools.izip(*[iter(active_edges)] * 2):
+                x_from = int(round(a.x_min))
+                x_to = int(round(b.x_min))
+
+                if last_span is not None and last_span[1] == x_from:
+                    last_span[1] = x_to
+                    continue
+
+                if last_span is not None:
+                    yield (y, last_span[0], last_span[1])
+                last_span = [x_from, x_to]
+
+            if last_span is not None:
+                yield (y, last_span[0], last_span[1])
+
+            # deactivate edges who's y-max is the current y
+            active_edges = [e for e in active_edges if e.y_max != y]
+
+            # move to the next scanline
+            y += 1
+
+            # update x for non-vertical edges left in active edges
+            for edge in active_edges:
+                # update edge's x_min for next round if the edge isn't vertical
+                if edge.run != 0:
+                    edge.x_min = edge.x_top + (y - edge.y_min) * edge.slope
+
+    @staticmethod
+    def get_area(vertices):
+        """
+        Same as generate_area(), but returns a list instead of a generator.
+        """
+
+        return [point for point in Polygon.generate_area(vertices)]
+
+class Coverage:
+    """
+    A set of tiles at a single zoom level, kept as sorted, non-overlapping spans
+    of horizontally adjacent tiles in each row. Memory use depends on the number
+    of spans rather than the number of tiles, so even huge areas are cheap to
+    hold as long as they're mostly solid.
+    """
+
+    def __init__(self, zoom):
+        self.zoom = zoom
+
+        # maps y values to sorted lists of [x_first, x_last] spans
+        self.rows = {}
+
+    def add(self, x, y):
+        """
+        Adds a single tile.
+        """
+
+        self.add_span(y, x, x)
+
+    def add_span(self, y, x_first, x_last):
+        """
+        Adds the inclusive span of tiles from x_first to x_last in row y,
+        merging it with any spans it overlaps or touches.
+        """
+
+        row = self.rows.setdefault(y, [])
+
+        # extend the last span in place when adding in order, the common case
+        if len(row) > 0 and row[-1][0] <= x_first:
+            if x_first <= row[-1][1] + 1:
+                row[-1][1] = max(row[-1][1], x_last)
+                return
+            row.append([x_first, x_last])
+            return
 
-        y_abs = ( round(tile_size * (2 ** (zoom - 1))) +
-              ( (0.5 * log((1 + y_exp) / (1 - y_exp))) *
-                ((-tile_size * (2 ** zoom)) / (2 * pi)) ) )
+        # otherwise, replace all the spans we overlap or touch with one span
+        i = bisect.bisect_left(row, [x_first, x_first])
+        if i > 0 and row[i - 1][1] >= x_first - 1:
+            i -= 1
 
-        # tile coordinates (tile-level resolution)
-        self.x = int(x_abs / tile_size)
-        self.y = int(y_abs / tile_size)
+        j = i
+        while j < len(row) and row[j][0] <= x_last + 1:
+            x_first = min(x_first, row[j][0])
+            x_last = max(x_last, row[j][1])
+            j += 1
 
-        # TODO: relative coordinates (pixel resolution, relative to tile)
-        #x_rel = x % tile_size
-        #y_rel = y % tile_size
+        row[i:j] = [[x_first, x_last]]
 
-    def init_from_google(self, x, y, zoom, tile_size):
+    def remove_span(self, y, x_first, x_last):
         """
-        Initializes this tile from an x, y, zoom, and tile size.
+        Removes the inclusive span of tiles from x_first to x_last in row y,
+        splitting any span it falls inside of.
         """
 
-        # zoom must be positive
-        assert zoom >= 0
+        row = self.rows.get(y)
+        if row is None:
+            return
 
-        # shared by both kinds of tile
-        self.zoom = zoom
+        # find the first span ending at or after x_first
+        i = bisect.bisect_left(row, [x_first, x_first])
+        if i > 0 and row[i - 1][1] >= x_first:
+            i -= 1
 
-        # kept for reference, the size of this tile in pixels
-        self.tile_size = tile_size
+        # keep the parts of the spans we overlap that lie outside of ours
+        kept = []
+        j = i
+        while j < len(row) and row[j][0] <= x_last:
+            if row[j][0] < x_first:
+                kept.append([row[j][0], x_first - 1])
+            if row[j][1] > x_last:
+                kept.append([x_last + 1, row[j][1]])
+            j += 1
 
-        self.x = x
-        self.y = y
+        row[i:j] = kept
 
-        # calculate latitude and longitude for upper-left corner of the tile
-        longitude = ( ( (x * tile_size) - (tile_size * (2 ** (zoom - 1))) ) /
-                      ( (tile_size * (2 ** zoom)) / 360.0 ) )
+        if len(row) == 0:
+            del self.rows[y]
 
-        # normalize longitude
-        while longitude > 180:
-            longitude -= 360
+    def generate_uncovered_spans(self, spans):
+        """
+        Yields the parts of the given (y, x_first, x_last) spans that aren't
+        covered, in the order the spans are given.
+        """
 
-        while longitude < -180:
-            logitude += 360
+        for y, x_first, x_last in spans:
+            row = self.rows.get(y, [])
 
-        lat_exp = ( ( (y * 256) - (256 * (2 ** (zoom - 1))) ) /
-                    ( (-256 * (2 ** zoom)) / (2 * pi) ) )
-        latitude = ( ( (2 * atan(exp(lat_exp))) - (pi / 2) ) / (pi / 180) )
+            # start from the last span starting at or before x_first
+            i = max(0, bisect.bisect_right(row, [x_first, float("inf")]) - 1)
 
-        # cap final values at their logical extremes
-        self.latitude = max(-90.0, latitude)
-        self.longitude = min(90.0, longitude)
+            x = x_first
+            while x <= x_last:
+                # skip spans that end before the uncovered part we're in
+                while i < len(row) and row[i][1] < x:
+                    i += 1
 
-    @staticmethod
-    def from_mercator(latitude, longitude, zoom, tile_size=None):
+                if i == len(row) or row[i][0] > x_last:
+                    yield y, x, x_last
+                    break
+
+                if row[i][0] > x:
+                    yield y, x, row[i][0] - 1
+
+                x = row[i][1] + 1
+                i += 1
+
+    def update(self, other):
         """
-        Creates a tile from Mercator coordinates and returns it.
+        Adds every tile covered by another coverage.
         """
 
-        tile_size = Tile.DEFAULT_TILE_SIZE if tile_size is None else tile_size
-        return Tile(Tile.KIND_MERCATOR, latitude, longitude, zoom, tile_size)
+        for y, x_first, x_last in other.generate_spans():
+            self.add_span(y, x_first, x_last)
 
-    @staticmethod
-    def from_google(x, y, zoom, tile_size=None):
+    def contains(self, x, y):
         """
-        Creates a tile from Google coordinates and returns it.
+        Returns whether the given tile is covered.
         """
 
-        tile_size = Tile.DEFAULT_TILE_SIZE if tile_size is None else tile_size
-        return Tile(Tile.KIND_GOOGLE, x, y, zoom, tile_size)
+        row = self.rows.get(y)
+        if row is None:
+            return False
 
-    def download(self, tile_type):
+        # find the last span starting at or before x
+        i = bisect.bisect_right(row, [x, float("inf")]) - 1
+        return i >= 0 and row[i][1] >= x
+
+    def generate_spans(self, bbox=None):
         """
-        Downloads the image data for this tile and returns it as a binary
-        string, or returns None if no data could be downloaded. Raises
-        TileDownloadError when tile download fails.
+        Yields (y, x_first, x_last) spans in order of y then x. If bbox is given
+        as an inclusive (x_min, y_min, x_max, y_max) tuple, spans are clipped to
+        it.
         """
 
-        # create the request URL from the template
-        url = Tile.URL_TEMPLATE % (random.randint(0, 3),
-                tile_type.v, self.x, self.y, self.zoom)
+        for y in sorted(self.rows):
+            if bbox is not None and not (bbox[1] <= y <= bbox[3]):
+                continue
 
-        # spoof the user agent so google doesn't ban us
-        agent = "Mozilla/5.0 (X11; U; Linux x86_64; en-US) "
-        agent += "AppleWebKit/532.5 (KHTML, like Gecko) "
-        agent += "Chrome/4.0.249.30 Safari/532.5"
+            for x_first, x_last in self.rows[y]:
+                if bbox is not None:
+                    x_first = max(x_first, bbox[0])
+                    x_last = min(x_last, bbox[2])
+                    if x_first > x_last:
+                        continue
 
-        # build the request to download this tile
-        request = urllib2.Request(url, headers={"User-Agent": agent})
+                yield y, x_first, x_last
 
-        try:
-            # download the tile and return its image data
-            return urllib2.urlopen(request).read()
+    def generate_tiles(self):
+        """
+        Yields every covered tile, in order of y then x.
+        """
 
-        # pass exceptions along for the caller to handle
-        except Exception, e:
-            raise Tile.TileDownloadError(str(e))
+        for y, x_first, x_last in self.generate_spans():
+            for x in xrange(x_first, x_last + 1):
+                yield Tile.from_google(x, y, self.zoom)
 
-    def __hash__(self):
-        result = 17
+    def count(self):
+        """
+        Returns the number of covered tiles.
+        """
 
-        result += result * self.x * 13
-        result += result * self.y * 43
-        result += result * hash(self.latitude) * 41
-        result += result * hash(self.longitude) * 11
-        result += result * self.zoom * 19
+        return sum(x_last - x_first + 1
+                for y, x_first, x_last in self.generate_spans())
 
-        return result * 29
+    @staticmethod
+    def from_tiles(zoom, tiles):
+        """
+        Returns the coverage of the given tiles at the given zoom level.
+        """
+
+        coverage = Coverage(zoom)
+        for tile in tiles:
+            coverage.add(tile.x, tile.y)
+
+        return coverage
 
     def __eq__(self, other):
-        return (isinstance(other, Tile) and
-                other.x == self.x and
-                other.y == self.y and
-                other.zoom == self.zoom)
+        return (isinstance(other, Coverage) and
+                other.zoom == self.zoom and
+                list(other.generate_spans()) == list(self.generate_spans()))
 
-    def __str__(self):
-        return repr(self)
+    def __ne__(self, other):
+        return not self == other
 
     def __repr__(self):
-        r = self.__class__.__name__ + "("
-        r += ", ".join(map(repr, [self.x, self.y, self.zoom]))
+        return (self.__class__.__name__ + "(zoom=" + repr(self.zoom) +
+                ", tiles=" + repr(self.count()) + ")")
 
-        if self.tile_size != Tile.DEFAULT_TILE_SIZE:
-            r += ", tile_size=" + repr(self.tile_size)
+class CoverageCache:
+    """
+    Keeps the spans of rasterized areas in files in a directory, so planning,
+    verifying, or resuming downloads of the same areas can skip rasterizing
+    them again. Each file is named by a hash of its areas' vertices, zoom level,
+    simplification, and the rasterizer's version, and is read back through a
+    memory map. The least recently used files are removed once the directory
+    holds more than max_size bytes.
+    """
 
-        r += ")"
+    # bump whenever the rasterizer's output changes, so stale files are ignored
+    RASTERIZER_VERSION = 2
 
-        return r
+    # the first bytes of every file, followed by its spans as packed integers
+    MAGIC = "mapper spans\n"
+    SPAN = struct.Struct("<qqq")
 
-class TileStore:
-    """
-    Interface for storing tiles. Provides a single 'store' method that takes
-    tile data and stores it however the class chooses.
-    """
+    # the file name extension of complete files
+    EXTENSION = ".spans"
 
-    def store(self, tile_type, tile, tile_data):
+    DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+        # so threads sharing the cache don't evict files at the same time
+        self.lock = threading.Lock()
+
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise e
+
+    @staticmethod
+    def get_key(polygons, zoom, simplify_tolerance=0):
         """
-        Stores a single tile in the store however the class chooses. This method
-        should be thread-safe, as no attempts are made to call it synchronously.
+        Returns the key of the coverage of the given polygons of tile vertices,
+        as download_areas() takes them, at a zoom level.
         """
 
-        raise NotImplemented(self.__class__.__name__ + " must implement this!")
+        key = hashlib.sha1()
+        key.update(struct.pack("<IId", CoverageCache.RASTERIZER_VERSION, zoom,
+            simplify_tolerance))
 
-class NullTileStore(TileStore):
-    """
-    Throws away all tiles given to it. Useful for performance testing.
-    """
+        # ring lengths are included so moving a vertex between them counts
+        for polygon in polygons:
+            key.update(struct.pack("<I", len(polygon)))
+            for ring in polygon:
+                key.update(struct.pack("<I", len(ring)))
+                for v in ring:
+                    key.update(struct.pack("<dd", v.latitude, v.longitude))
 
-    def __init__(*args, **kwargs): pass
-    def store(*args, **kwargs): pass
+        return key.hexdigest()
 
-class FileTileStore(TileStore):
-    """
-    Stores tiles in a directory on the local file system.
-    """
+    def get_path(self, key):
+        """
+        Returns the path of the file for a key.
+        """
 
-    def __init__(self, directory=time.strftime("tiles_%Y%m%d_%H%M%S"),
-            name_generator=None):
+        return os.path.join(self.directory, key + CoverageCache.EXTENSION)
+
+    def load(self, key):
         """
-        Creates a tile store that writes files to a given directory. If the
-        directory doesn't exist, it creates it. A default time-based directory
-        name is used if none is provided. name_generator is a callable that takes
-        a tile and a tile type and returns a file name. If unspecified, a
-        default is used.
+        Returns a generator of the (y, x_first, x_last) spans stored for a key,
+        or None if there aren't any.
         """
 
-        def default_name_generator(tile, tile_type):
-            return (tile_type.v + "_" +
-                    str(tile.x) + "-" +
-                    str(tile.y) + "-" +
-                    str(tile.zoom))
+        path = self.get_path(key)
+        try:
+            f = open(path, "rb")
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise e
 
-        # store the method for generating file names
-        self.name_generator = name_generator
-        if name_generator is None:
-            self.name_generator = default_name_generator
+        # ignore files that aren't ours, or were cut short somehow
+        magic = f.read(len(CoverageCache.MAGIC))
+        size = os.fstat(f.fileno()).st_size - len(CoverageCache.MAGIC)
+        if magic != CoverageCache.MAGIC or size % CoverageCache.SPAN.size != 0:
+            f.close()
+            return None
 
-        self.directory = os.path.abspath(directory)
+        # mark the file as recently used
+        os.utime(path, None)
 
-        # ensure the given directory exists
-        try:
-            os.mkdir(self.directory)
-        except OSError, e:
-            # ignore 'already exists' errors, but raise all others
-            if e.errno != 17:
-                raise e
+        return self.__generate_file_spans(f)
 
-    def store(self, tile_type, tile, tile_data):
+    def generate_stored(self, key, spans):
         """
-        Writes files to the given directory.
+        Yields the given spans, storing them for a key as they go by. Nothing is
+        stored unless every span is consumed.
         """
 
-        # build a file name containing descriptive data
-        fname = self.name_generator(tile, tile_type)
+        path = self.get_path(key)
+        temp_path = path + "." + str(os.getpid()) + "." + \
+                threading.current_thread().name
+
+        complete = False
+        with open(temp_path, "wb") as f:
+            try:
+                f.write(CoverageCache.MAGIC)
+                for span in spans:
+                    f.write(CoverageCache.SPAN.pack(*span))
+                    yield span
+                complete = True
+            finally:
+                if not complete:
+                    os.remove(temp_path)
+
+        os.rename(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used files until the cache fits its maximum
+        size.
+        """
 
-        # write the file into our directory, overwriting existing files
-        with open(os.path.join(self.directory, fname), "w") as f:
-            f.write(tile_data)
+        with self.lock:
+            files = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(CoverageCache.EXTENSION):
+                    continue
 
-class MongoTileStore(TileStore):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError, e:
+                    # another process may have just evicted it
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise e
+                files.append((stat.st_mtime, stat.st_size, path))
+
+            total_size = sum(size for mtime, size, path in files)
+            for mtime, size, path in sorted(files):
+                if total_size <= self.max_size:
+                    break
+
+                try:
+                    os.remove(path)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise e
+                total_size -= size
+
+    def __generate_file_spans(self, f):
+        """
+        Yields the spans in an open file, reading them through a memory map.
+        """
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == len(CoverageCache.MAGIC):
+                return
+
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(len(CoverageCache.MAGIC), size,
+                        CoverageCache.SPAN.size):
+                    yield CoverageCache.SPAN.unpack_from(m, offset)
+            finally:
+                m.close()
+
+class TileManifest:
     """
-    Stores tiles on a MongoDB server.
+    A read-only, memory-mapped view of a manifest file, the compact form of a
+    job's tile list written by write_manifest(). After a small header, files
+    hold every tile as a packed 64-bit key, sorted in the order tiles are
+    downloaded in, so they can be sliced into parts by index, searched to
+    resume a download, and compared with each other without rasterizing any
+    areas again.
     """
 
-    def __init__(self, server="127.0.0.1", port=27017, db="mapper",
-            collection="tiles"):
-        self.connection = pymongo.Connection(server, port)
-        self.db = self.connection[db]
-        self.collection = self.db[collection]
+    # the header: magic bytes, format version, unused flags, and the tile count
+    MAGIC = "mapperMF"
+    VERSION = 1
+    HEADER = struct.Struct("<8sIIQ")
 
-        # make sure the database has our index, building it if necessary.
-        # without this, we'd have to look up every tile to see if already
-        # existed, which becomes unusably slow with lots of tiles (100000+).
-        index = [
-            ("x", pymongo.ASCENDING),
-            ("y", pymongo.ASCENDING),
-            ("zoom", pymongo.ASCENDING),
-            ("tile_type.name", pymongo.ASCENDING),
-            ("tile_type.v", pymongo.ASCENDING)
-        ]
-        self.collection.ensure_index(index, unique=True, drop_dups=True)
+    # keys pack the zoom level, y, and x, in that order of significance
+    KEY = struct.Struct("<Q")
+    COORDINATE_BITS = 21
+    COORDINATE_MASK = (1 << COORDINATE_BITS) - 1
 
-    def store(self, tile_type, tile, tile_data):
+    # how many keys are read or written at once
+    CHUNK_SIZE = 4096
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+
+        self.file = open(manifest_file, "rb")
+        try:
+            header = self.file.read(TileManifest.HEADER.size)
+            if len(header) < TileManifest.HEADER.size:
+                raise ValueError("Not a tile manifest: " + repr(manifest_file))
+
+            magic, version, flags, self.count = \
+                    TileManifest.HEADER.unpack(header)
+            if magic != TileManifest.MAGIC:
+                raise ValueError("Not a tile manifest: " + repr(manifest_file))
+            if version != TileManifest.VERSION:
+                raise ValueError("Unsupported tile manifest version " +
+                        str(version) + ": " + repr(manifest_file))
+
+            size = TileManifest.HEADER.size + self.count * TileManifest.KEY.size
+            if os.fstat(self.file.fileno()).st_size < size:
+                raise ValueError("Truncated tile manifest: " +
+                        repr(manifest_file))
+
+            # mmap can't map empty files
+            self.map = None
+            if self.count > 0:
+                self.map = mmap.mmap(self.file.fileno(), size,
+                        access=mmap.ACCESS_READ)
+        except:
+            self.file.close()
+            raise
+
+    @staticmethod
+    def get_key(tile):
         """
-        Store the tile in the database with a Unix update time in seconds. If a
-        tile with the same data already exists, update it accordingly. This
-        assumes that an index with unique keys has been added on x, y, zoom,
-        tile_type.name, and tile_type.v.
+        Returns the key of a tile. Keys sort by zoom level, then y, then x.
         """
 
-        tile = {
-            # coordinates
-            "x": int(tile.x),
-            "y": int(tile.y),
-            "zoom": int(tile.zoom),
+        bits = TileManifest.COORDINATE_BITS
+        return (tile.zoom << (2 * bits)) | (tile.y << bits) | tile.x
 
-            # tile type (we're expecting a collections.namedtuple)
-            "tile_type": tile_type._asdict(),
+    @staticmethod
+    def get_tile(key):
+        """
+        Returns the tile a key describes.
+        """
 
-            # image data as binary
-            "image_data": bson.binary.Binary(tile_data),
+        bits = TileManifest.COORDINATE_BITS
+        mask = TileManifest.COORDINATE_MASK
+        return Tile.from_google(key & mask, (key >> bits) & mask,
+                key >> (2 * bits))
 
-            # update date, for eventually re-downloading 'old' tiles
-            "update_date": int(time.time())
-        }
+    def __len__(self):
+        return self.count
 
-        # add our tile to the collection, overwriting old data if it exists
-        self.collection.insert(tile)
+    def get_key_at(self, i):
+        """
+        Returns the key at an index in the manifest.
+        """
 
-class RateCalculator:
-    """
-    Used to track and calculate rates.
-    """
+        if not (0 <= i < self.count):
+            raise IndexError("manifest index out of range: " + repr(i))
 
-    def __init__(self, tick_rate_ms, window_size):
-        if tick_rate_ms < 0:
-            raise ValueError("Tick rate must be at least 0")
+        return TileManifest.KEY.unpack_from(self.map,
+                TileManifest.HEADER.size + i * TileManifest.KEY.size)[0]
 
-        if window_size < 1:
-            raise ValueError("Window size must be at least 1")
+    def index(self, tile):
+        """
+        Returns the index of the first key not less than the given tile's, i.e.
+        where the tile is or would be, found by binary search.
+        """
+
+        key = TileManifest.get_key(tile)
+
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def contains(self, tile):
+        """
+        Returns whether the manifest has the given tile.
+        """
+
+        i = self.index(tile)
+        return i < self.count and self.get_key_at(i) == TileManifest.get_key(tile)
+
+    def get_part(self, part, num_parts):
+        """
+        Returns the (start, stop) indexes of a part of the manifest, as split
+        into num_parts parts as close to equal in size as possible.
+        """
+
+        if not (0 <= part < num_parts):
+            raise ValueError("Invalid part " + repr(part) + " of " +
+                    repr(num_parts))
 
-        # how long we should go between ticks
-        self.tick_rate_ms = tick_rate_ms
+        return (self.count * part // num_parts,
+                self.count * (part + 1) // num_parts)
 
-        # how many rates should be accumulated to calculate the running average
-        self.window_size = window_size
+    def generate_keys(self, start=0, stop=None):
+        """
+        Yields the keys from index start up to, but not including, index stop,
+        reading them from the memory map a chunk at a time.
+        """
+
+        stop = self.count if stop is None else min(stop, self.count)
+        for i in xrange(start, stop, TileManifest.CHUNK_SIZE):
+            n = min(TileManifest.CHUNK_SIZE, stop - i)
+            for key in struct.unpack_from("<%dQ" % n, self.map,
+                    TileManifest.HEADER.size + i * TileManifest.KEY.size):
+                yield key
+
+    def generate_tiles(self, start=0, stop=None):
+        """
+        Yields the tiles from index start up to, but not including, index stop.
+        """
+
+        for key in self.generate_keys(start, stop):
+            yield TileManifest.get_tile(key)
+
+    def close(self):
+        """
+        Unmaps and closes the manifest file.
+        """
+
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import logging
 
-        # rate list, first item is oldest rate
-        self.window = []
+    # constant values for zoom levels
+    MIN_ZOOM = 0
+    MAX_ZOOM = Tile.MAX_ZOOM
+
+    # various tile stores we're allowed to use
+    TILE_STORES = {
+        "null": NullTileStore,
+        "file": FileTileStore,
+        "mongo": MongoTileStore
+    }
 
-        # how many tocks we've accumulated since the last tick
-        self.tock_count = 0
+    # all the types of tiles available for download
+    TILE_TYPES = dict((t.name, t) for t in Tile.TYPES)
 
-        # time of the last tick
-        self.last_tick_time = None
+    # the levels of log verbosity we support
+    LOG_LEVELS = {
+        "silent": None,
+        "debug": logging.DEBUG,
+        "info": logging.INFO,
+        "warning": logging.WARNING,
+        "error": logging.ERROR,
+        "critical": logging.CRITICAL,
+    }
 
-    def start(self):
+    def add_log_arguments(parser):
         """
-        Start calculating the rate.
+        Adds the logging arguments shared by all commands to a parser.
         """
 
-        self.window = []
-        self.tock_count = 0
-        self.last_tick_time = time.time()
+        parser.add_argument("-l", "--log-level", choices=LOG_LEVELS,
+                default="info", help="set the log verbosity (default info)")
+        parser.add_argument("-f", "--log-file", type=os.path.abspath,
+                default=None,
+                help="if specified, logs to the given file rather than the " +
+                "screen")
 
-    def reset(self):
+    def add_simplify_argument(parser):
         """
-        Reset to initial state.
+        Adds the polygon simplification argument, which must match between
+        downloading an area and verifying it, to a parser.
         """
 
-        self.window = []
-        self.tock_count = 0
-        self.last_tick_time = None
+        parser.add_argument("--simplify", type=float, default=0,
+                metavar="TILES",
+                help="at each zoom level, drop shape vertices within this " +
+                "many tiles of the simplified outline, or 0 to use every " +
+                "vertex (default 0). simplifying can leave out tiles along " +
+                "the edge of the area")
 
-    def tock(self):
+    def add_coverage_cache_arguments(parser):
         """
-        Count an action towards the rate.
+        Adds the arguments for caching the tiles areas cover to a parser.
         """
 
-        if self.last_tick_time is None:
-            raise ValueError("Must start the calculator before tocking!")
-
-        self.tock_count += 1
-
-    def tick(self):
+        parser.add_argument("--coverage-cache", type=os.path.abspath,
+                default=None, metavar="DIRECTORY",
+                help="keep the tiles each area covers in this directory, so " +
+                "later runs on the same areas needn't work them out again")
+        parser.add_argument("--coverage-cache-size", type=int,
+                default=CoverageCache.DEFAULT_MAX_SIZE / (1024 * 1024),
+                metavar="MB",
+                help="most megabytes the coverage cache may use (default " +
+                str(CoverageCache.DEFAULT_MAX_SIZE / (1024 * 1024)) + ")")
+
+    def get_coverage_cache(parser, args):
         """
-        Return rate of tocks if we've reached the next tick time, otherwise
-        None.
+        Returns the coverage cache given in the arguments, or None.
         """
 
-        if self.last_tick_time is None:
-            raise ValueError("Must start the calculator before ticking!")
-
-        tt = time.time()
-        if tt >= self.last_tick_time + (1.0 * self.tick_rate_ms / 1000):
-            # calculate the current rate
-            rate = 0.0
-            if self.tock_count > 0:
-                rate = self.tock_count / (tt - self.last_tick_time)
-
-            # keep a running average of previous rates
-            while len(self.window) >= self.window_size:
-                self.window.pop(0)
-            self.window.append(rate)
+        if args.coverage_cache is None:
+            return None
 
-            window_sum = sum(self.window)
-            ave_rate = 0.0
-            if window_sum > 0:
-                ave_rate = 1.0 * window_sum / len(self.window)
-
-            # reset counters for next rate calculation
-            self.tock_count = 0
-            self.last_tick_time = tt
-
-            # return the rate if we had reached the tick time
-            return rate
-
-        # return None otherwise, to indicate the tick time hasn't come yet
-        return None
-
-class Polygon:
-    """
-    A utility class for operations on lists of vertices.
-    """
+        if args.coverage_cache_size < 0:
+            parser.error("argument --coverage-cache-size: invalid size: " +
+                    repr(args.coverage_cache_size) + " (must be >= 0)")
 
-    # represents the bounding box of some points
-    Bounds = namedtuple("Bounds", ["top", "right", "bottom", "left"])
+        return CoverageCache(args.coverage_cache,
+                args.coverage_cache_size * 1024 * 1024)
 
-    class Edge:
+    def add_corridor_argument(parser):
         """
-        Represents an edge used in the sorted edge table and active edge table
-        calculations.
+        Adds the corridor argument, which must match between downloading a
+        route and verifying it, to a parser.
         """
 
-        def __init__(self, y_max, x_min, rise, run):
-            self.y_max = y_max
-            self.x_min = x_min
-            self.rise = rise
-            self.run = run
-
-        def __str__(self):
-            return repr(self)
-
-        def __repr__(self):
-            s = self.__class__.__name__ + "("
-            s += ", ".join(map(repr, (self.y_max, self.x_min, self.rise,
-                self.run)))
-            s += ")"
-
-            return s
-
-    def __init__(self):
-        raise NotImplemented(self.__class__.__name__ + " can't be instantiated")
-
-    @staticmethod
-    def get_bounds(*vertices):
+        def distance(value):
+            in_metres = value.endswith("m")
+            try:
+                number = float(value[:-1] if in_metres else value)
+            except ValueError:
+                raise argparse.ArgumentTypeError("invalid distance: " +
+                        repr(value))
+            if number < 0:
+                raise argparse.ArgumentTypeError("invalid distance: " +
+                        repr(value) + " (must be >= 0)")
+            return (number, in_metres)
+
+        parser.add_argument("--corridor", type=distance, default=None,
+                metavar="DISTANCE",
+                help="read shape files as routes, and use the tiles within " +
+                "this many tiles of them, or metres with an 'm' suffix, " +
+                "instead of the tiles inside them")
+
+    def get_logger(args):
         """
-        Returns a Bounds object containing data about the bounding box that
-        contains the given vertices. If multiple vertices are at the bounds, the
-        first is used. If one vertex satisfies multiple bounds, it will be used
-        multiple times.
+        Sets up a logger depending on the specified verbosity and file name.
         """
 
-        # find the furthest vertices in the cardinal directions
-        top = None
-        right = None
-        bottom = None
-        left = None
-        for vertex in vertices:
-            # top
-            if top is None or vertex[1] < top[1]:
-                top = vertex
-
-            # right
-            if right is None or vertex[0] > right[0]:
-                right = vertex
-
-            # bottom
-            if bottom is None or vertex[1] > bottom[1]:
-                bottom = vertex
-
-            # left
-            if left is None or vertex[0] < left[0]:
-                left = vertex
+        logger = __get_null_logger()
+        if LOG_LEVELS[args.log_level] is not None:
+            logging.basicConfig(level=LOG_LEVELS[args.log_level],
+                    filename=args.log_file)
+            logger = logging
 
-        return Polygon.Bounds(top=top, right=right, bottom=bottom, left=left)
+        return logger
 
-    @staticmethod
-    def generate_vertex_pairs(vertices, exclude_horizontal=False):
+    def generate_shape_tiles(parser, args, zoom_levels, logger):
         """
-        Generates paired vertices from a list of vertices, including from last
-        vertex to first vertex. If exclude_horizontal is True, horizontal edge
-        pairs are not yielded.
-
-        Examples:
-            [] -> []
-            [A] -> [(A, A)]
-            [A, B] -> [(A, B), (B, A)]
-            [A, B, C] -> [(A, B), (B, C), (C, A)]
+        Yields the tiles of the shape files given on the command line, as
+        routes if --corridor was given and as areas otherwise.
         """
 
-        # don't do any work if we're too short
-        if len(vertices) == 0:
-            return
+        if args.corridor is not None:
+            lines = []
+            for shape_file in args.shape_files:
+                lines.extend(parse_shape_lines(shape_file))
+            return generate_corridor_tiles(lines, zoom_levels,
+                    args.corridor[0], args.corridor[1], logger=logger)
+
+        polygons = []
+        for shape_file in args.shape_files:
+            polygons.extend(parse_shape_polygons(shape_file))
+        return generate_areas_tiles(polygons, zoom_levels, logger=logger,
+                simplify_tolerance=args.simplify,
+                coverage_cache=get_coverage_cache(parser, args))
+
+    def check_zoom_args(parser, args):
+        """
+        Exits with an error if the zoom range in the arguments is invalid.
+        """
 
-        # turn our vertices into a sequence of adjacent vertex pairs
-        last_point = None
-        for point in vertices:
-            if last_point is None:
-                last_point = point
-                continue
+        # enforce zoom levels (custom to prevent ultra-verbose default output)
+        if args.min_zoom < MIN_ZOOM or args.min_zoom > MAX_ZOOM:
+            print parser.format_usage().strip()
+            print ("mapper.py: error: argument -m/--min-zoom: invalid zoom: " +
+                    repr(args.min_zoom) + " (must be between " + str(MIN_ZOOM) +
+                    "-" + str(MAX_ZOOM) + ")")
+            sys.exit(1)
+
+        if args.max_zoom < MIN_ZOOM or args.max_zoom > MAX_ZOOM:
+            print parser.format_usage().strip()
+            print ("mapper.py: error: argument -z/--max-zoom: invalid zoom: " +
+                    repr(args.max_zoom) + " (must be between " + str(MIN_ZOOM) +
+                    "-" + str(MAX_ZOOM) + ")")
+            sys.exit(2)
+
+        if args.max_zoom < args.min_zoom:
+            print parser.format_usage().strip()
+            print ("mapper.py: error: argument -z/--max-zoom: invalid zoom: " +
+                    repr(args.max_zoom) + " (must be larger than the min zoom)")
+            sys.exit(3)
+
+    def download_main(argv):
+        """
+        Downloads the area described by a shape file. This is the default
+        command.
+        """
 
-            # only yield non-horizontal edges if we're exluding them
-            if exclude_horizontal:
-                if point[1] != last_point[1]:
-                    yield (last_point, point)
+        parser = argparse.ArgumentParser(
+                description="Download an area of map tiles from Google maps.")
+
+        add_log_arguments(parser)
+
+        parser.add_argument("-m", "--min-zoom", type=int, default=0,
+                help="minimum zoom to download (" + str(MIN_ZOOM) + "-" +
+                str(MAX_ZOOM) + ")")
+        parser.add_argument("-z", "--max-zoom", type=int, default=0,
+                help="maximum zoom to download (" + str(MIN_ZOOM) + "-" +
+                str(MAX_ZOOM) + ")")
+
+        parser.add_argument("-t", "--tile-type", default="map",
+                choices=TILE_TYPES, help="type of tile to download (default map)")
+
+        parser.add_argument("-n", "--num-threads", type=int, default=10,
+                help="number of download threads to use (default 10)")
+
+        parser.add_argument("-w", "--num-writers", type=int, default=1,
+                help="number of threads storing downloaded tiles, or 0 to " +
+                "store them from the download threads (default 1)")
+
+        parser.add_argument("-p", "--num-processes", type=int, default=0,
+                help="number of processes working out which tiles are in " +
+                "the area, or 0 to do it in the main process (default 0)")
+
+        add_simplify_argument(parser)
+        add_corridor_argument(parser)
+        add_coverage_cache_arguments(parser)
+
+        parser.add_argument("shape_files", type=os.path.abspath, nargs="*",
+                metavar="shape_file",
+                help="shape files to download, where tiles covered by more " +
+                "than one are only downloaded once")
+        parser.add_argument("-r", "--replay-file", type=os.path.abspath,
+                default=None,
+                help="download the tiles in a tile list written by 'verify' " +
+                "instead of a shape file (ignores zoom and tile type options)")
+
+        parser.add_argument("--from-manifest", type=os.path.abspath,
+                default=None, metavar="MANIFEST",
+                help="download the tiles in a manifest written by " +
+                "'mapper.py manifest' instead of a shape file (ignores zoom " +
+                "options)")
+        parser.add_argument("--part", default=None, metavar="K/N",
+                help="with --from-manifest, only download the Kth of N " +
+                "equal parts of the manifest, counting from 1")
+
+        parser.add_argument("--old-shape-file", type=os.path.abspath,
+                action="append", default=None,
+                help="shape file of a previous revision of the area, whose " +
+                "tiles are already downloaded, so only the tiles the shape " +
+                "files add are downloaded (may be repeated)")
+        parser.add_argument("--removed-file", type=os.path.abspath,
+                default=None,
+                help="write the tiles in the old shape files that the shape " +
+                "files no longer cover to this file, as a tile list")
+        parser.add_argument("--delete-removed", action="store_true",
+                default=False,
+                help="delete the tiles in the old shape files that the shape " +
+                "files no longer cover from the tile store")
+
+        parser.add_argument("-s", "--tile-store", default="file",
+                choices=["null", "file", "mongo"],
+                help="where tiles are stored (default file)")
+
+        parser.add_argument("-d", "--dedup", action="store_true", default=False,
+                help="store identical tiles only once (file and mongo stores)")
+
+        parser.add_argument("-k", "--skip-to-tile", nargs=3, type=int,
+                default=None,
+                help="tile to skip to before downloading tiles (format " +
+                "'x y zoom'")
+
+        parser.add_argument("--metrics-file", type=os.path.abspath,
+                default=None,
+                help="periodically append download metrics to this file as " +
+                "lines of JSON")
+        parser.add_argument("--metrics-port", type=int, default=None,
+                help="serve download metrics in the Prometheus text format " +
+                "on this local port")
+        parser.add_argument("--metrics-interval", type=float, default=10,
+                help="seconds between lines written to --metrics-file " +
+                "(default 10)")
+
+        parser.add_argument("--trace", action="store_true", default=False,
+                help="time each stage of every tile's download, and log a " +
+                "summary when done")
+        parser.add_argument("--trace-file", type=os.path.abspath, default=None,
+                help="write every tile's stage timings to this file as " +
+                "lines of JSON (implies --trace)")
+        parser.add_argument("--profile", type=os.path.abspath, default=None,
+                help="run the download under cProfile and write the stats " +
+                "to this file, for reading with pstats")
+
+        # TODO: add specific options for various tiles stores
+
+        args = parser.parse_args(argv)
+
+        check_zoom_args(parser, args)
+
+        sources = [len(args.shape_files) > 0, args.replay_file is not None,
+                args.from_manifest is not None]
+        if sources.count(True) != 1:
+            parser.error("exactly one of shape files, -r/--replay-file, and " +
+                    "--from-manifest must be given")
+
+        if args.part is not None:
+            if args.from_manifest is None:
+                parser.error("--part needs --from-manifest")
+
+            try:
+                part, num_parts = [int(n) for n in args.part.split("/")]
+                if not (1 <= part <= num_parts):
+                    raise ValueError()
+            except ValueError:
+                parser.error("argument --part: invalid part: " +
+                        repr(args.part) + " (must be K/N, with 1 <= K <= N)")
+            args.part = (part - 1, num_parts)
+
+        # enforce thread count
+        if args.num_threads < 1:
+            print parser.format_usage().strip()
+            print ("mapper.py: error: argument -n/--num-threads: invalid " +
+                    "thread count: " + repr(args.num_threads) + " (must be >= 1)")
+            sys.exit(4)
+
+        if args.num_writers < 0:
+            print parser.format_usage().strip()
+            print ("mapper.py: error: argument -w/--num-writers: invalid " +
+                    "thread count: " + repr(args.num_writers) + " (must be >= 0)")
+            sys.exit(5)
+
+        if args.old_shape_file is None:
+            if args.removed_file is not None or args.delete_removed:
+                parser.error("--removed-file and --delete-removed need " +
+                        "--old-shape-file")
+        elif len(args.shape_files) == 0 or args.corridor is not None:
+            parser.error("--old-shape-file needs shape files, and can't be " +
+                    "used with --corridor")
+
+        if args.num_processes < 0:
+            parser.error("argument -p/--num-processes: invalid process " +
+                    "count: " + repr(args.num_processes) + " (must be >= 0)")
+
+        # turn tile type string into a tile type object
+        tile_type = TILE_TYPES[args.tile_type]
+
+        # get the zoom levels we'll download (arg ranges are inclusive)
+        zoom_levels = xrange(args.min_zoom, args.max_zoom + 1)
+
+        # create a tile store based on the specified string
+        tile_store = TILE_STORES[args.tile_store](dedup=args.dedup)
+
+        logger = get_logger(args)
+
+        # build the skip-to-tile
+        skip_to_tile = None
+        if args.skip_to_tile is not None:
+            skip_to_tile = Tile.from_google(args.skip_to_tile[0],
+                    args.skip_to_tile[1], args.skip_to_tile[2])
+
+        # one registry covers the whole run, however many downloads it takes
+        metrics = Metrics()
+
+        if args.metrics_port is not None:
+            serve_metrics(metrics, args.metrics_port)
+
+        reporter = None
+        if args.metrics_file is not None:
+            if args.metrics_interval <= 0:
+                parser.error("argument --metrics-interval: invalid interval: " +
+                        repr(args.metrics_interval) + " (must be > 0)")
+
+            reporter = MetricsReporter(metrics, args.metrics_interval,
+                    json_file=args.metrics_file)
+            reporter.start()
+
+        tracer = None
+        if args.trace or args.trace_file is not None:
+            tracer = Tracer(metrics, args.trace_file)
+
+        download_args = (args, tile_type, zoom_levels, tile_store,
+                skip_to_tile, logger, metrics, tracer,
+                get_coverage_cache(parser, args))
+        try:
+            if args.profile is not None:
+                run_profiled(args.profile, download_from_args, *download_args)
+                logger.info("Wrote profile to %s", args.profile)
             else:
-                yield (last_point, point)
-
-            last_point = point
-
-        # add the pair from last to first
-        if exclude_horizontal:
-            if last_point[1] != vertices[0][1]:
-                yield (last_point, vertices[0])
-        else:
-            yield (last_point, vertices[0])
-
-
-    @staticmethod
-    def generate_line(a, b):
+                download_from_args(*download_args)
+        finally:
+            if reporter is not None:
+                reporter.stop()
+
+            if tracer is not None:
+                for stage, count, total in tracer.summarize():
+                    logger.info("Stage %s: %d tiles, %.3f seconds total, " +
+                            "%.2f ms average", stage, count, total,
+                            1000.0 * total / max(count, 1))
+                tracer.close()
+
+    def download_from_args(args, tile_type, zoom_levels, tile_store,
+            skip_to_tile, logger, metrics, tracer, coverage_cache):
         """
-        Rasterizes the line between the given points, and yields them all
-        in-order, endpoints included, using Bresenham's line drawing algorithm.
-
-        Reference: http://en.wikipedia.org/wiki/Bresenham's_line_algorithm
+        Downloads the manifest, replay file, or shape files given on the
+        command line.
         """
 
-        # make some shorthand variables
-        x0, y0 = a
-        x1, y1 = b
-
-        # an optimized version of the algorithm (see #Simplification in wiki)
-        dx = abs(x1 - x0)
-        dy = abs(y1 - y0)
+        # download a part of the manifest, starting at the skip-to tile
+        if args.from_manifest is not None:
+            manifest = TileManifest(args.from_manifest)
+            try:
+                start, stop = 0, len(manifest)
+                if args.part is not None:
+                    start, stop = manifest.get_part(*args.part)
+                if skip_to_tile is not None:
+                    start = max(start, manifest.index(skip_to_tile))
+
+                logger.info("Downloading tiles %d to %d of %s", start, stop,
+                        args.from_manifest)
+                download_tiles(tile_type, manifest.generate_tiles(start, stop),
+                        tile_store, num_threads=args.num_threads,
+                        logger=logger, num_writers=args.num_writers,
+                        metrics=metrics, tracer=tracer)
+            finally:
+                manifest.close()
+            return
 
-        sx = 1 if x0 < x1 else -1
-        sy = 1 if y0 < y1 else -1
+        # download the tiles in the replay file, one tile type at a time
+        if args.replay_file is not None:
+            tile_list = parse_tile_list(args.replay_file)
+            for tile_type, group in itertools.groupby(tile_list,
+                    lambda p: p[0]):
+                logger.info("Downloading " + tile_type.name + " tiles from " +
+                        args.replay_file)
+                download_tiles(tile_type, (tile for t, tile in group),
+                        tile_store, num_threads=args.num_threads,
+                        logger=logger, num_writers=args.num_writers,
+                        metrics=metrics, tracer=tracer)
+            return
 
-        err = dx - dy
+        # download the routes from the shape files
+        if args.corridor is not None:
+            lines = []
+            for shape_file in args.shape_files:
+                lines.extend(parse_shape_lines(shape_file))
+            download_corridor(tile_type, lines, tile_store, zoom_levels,
+                    args.corridor[0], in_metres=args.corridor[1],
+                    num_threads=args.num_threads, logger=logger,
+                    skip_to_tile=skip_to_tile, num_writers=args.num_writers,
+                    metrics=metrics, tracer=tracer)
+            return
 
-        while 1:
-            # yield a rasterized point on the line
-            yield (x0, y0)
+        # download the areas from the shape files
+        polygons = []
+        for shape_file in args.shape_files:
+            polygons.extend(parse_shape_polygons(shape_file))
+
+        # download only what the areas add to their previous revision
+        if args.old_shape_file is not None:
+            old_polygons = []
+            for shape_file in args.old_shape_file:
+                old_polygons.extend(parse_shape_polygons(shape_file))
+            download_areas_update(tile_type, polygons, old_polygons,
+                    tile_store, zoom_levels, removed_file=args.removed_file,
+                    delete_removed=args.delete_removed,
+                    num_threads=args.num_threads, logger=logger,
+                    skip_to_tile=skip_to_tile, num_writers=args.num_writers,
+                    metrics=metrics, tracer=tracer,
+                    num_processes=args.num_processes,
+                    simplify_tolerance=args.simplify,
+                    coverage_cache=coverage_cache)
+            return
+        download_areas(tile_type, polygons, tile_store, zoom_levels,
+                num_threads=args.num_threads, logger=logger,
+                skip_to_tile=skip_to_tile, num_writers=args.num_writers,
+                metrics=metrics, tracer=tracer,
+                num_processes=args.num_processes,
+                simplify_tolerance=args.simplify,
+                coverage_cache=coverage_cache)
 
-            if x0 == x1 and y0 == y1:
-                return
+    def verify_main(argv):
+        """
+        Checks a tile store for missing or damaged tiles in the area described
+        by a shape file. Exits with a status of 1 if any problems were found.
+        """
 
-            e2 = 2 * err
+        parser = argparse.ArgumentParser(prog="mapper.py verify",
+                description="Check a tile store for missing or damaged tiles.")
 
-            if e2 > -dy:
-                err -= dy
-                x0 += sx
+        add_log_arguments(parser)
 
-            if e2 < dx:
-                err += dx
-                y0 += sy
+        parser.add_argument("-m", "--min-zoom", type=int, default=0,
+                help="minimum zoom to verify (" + str(MIN_ZOOM) + "-" +
+                str(MAX_ZOOM) + ")")
+        parser.add_argument("-z", "--max-zoom", type=int, default=0,
+                help="maximum zoom to verify (" + str(MIN_ZOOM) + "-" +
+                str(MAX_ZOOM) + ")")
 
-    @staticmethod
-    def get_line(a, b):
-        """
-        Same as generate_line(), but returns a list instead of a generator.
-        """
+        parser.add_argument("-t", "--tile-type", default="map",
+                choices=TILE_TYPES, help="type of tile to verify (default map)")
 
-        return [point for point in Polygon.generate_line(a, b)]
+        parser.add_argument("-n", "--num-threads", type=int, default=4,
+                help="number of threads reading the store (default 4)")
 
-    @staticmethod
-    def generate_area(vertices):
-        """
-        Generates all the points on the rasterized polygon described by a list
-        of vertices and yields them in arbitrary order. Polygons are assumed to
-        have non-overlappind edges. Runs of identical vertices are collapsed
-        into a single value.
-        """
+        parser.add_argument("-s", "--tile-store", required=True,
+                help="store to verify, as 'file:DIRECTORY' or " +
+                "'mongo://HOST:PORT/DB/COLLECTION'")
 
-        # collapse adjacent duplicate vertices
-        print "vertices before:", vertices
-        collapse = lambda a, p: a + [p] if (len(a) == 0 or p != a[-1]) else a
-        vertices = reduce(collapse, vertices, [])
-        print "vertices after:", vertices
+        parser.add_argument("-o", "--replay-file", type=os.path.abspath,
+                default=None,
+                help="write the failed tiles to this file, for downloading " +
+                "again with 'mapper.py -r'")
 
-        # remove identical start/end vertices as well
-        while len(vertices) > 1 and vertices[0] == vertices[-1]:
-            vertices.pop()
+        parser.add_argument("shape_files", type=os.path.abspath, nargs="+",
+                metavar="shape_file",
+                help="shape files the store should cover")
 
-        # don't bother with calculations for corner cases
-        if len(vertices) <= 1:
-            for v in vertices:
-                yield v
-            return
-        elif len(vertices) == 2:
-            for point in Polygon.generate_line(*vertices):
-                yield point
-            return
+        add_simplify_argument(parser)
+        add_corridor_argument(parser)
+        add_coverage_cache_arguments(parser)
 
-        # condense consecutive vertical edges to single edges
-        new_vertices = []
-        cur = []
-        for vertex in vertices:
-            if len(cur) > 0 and vertex[0] != cur[0][0]:
-                # sort by y coordinate if we had a run of vertical sections
-                if len(cur) > 2:
-                    cur.sort(key=lambda v: v[1])
+        args = parser.parse_args(argv)
 
-                # keep the longest section
-                new_vertices.append(cur[0])
+        check_zoom_args(parser, args)
 
-                if len(cur) > 1:
-                    new_vertices.append(cur[-1])
+        if args.num_threads < 1:
+            parser.error("argument -n/--num-threads: invalid thread count: " +
+                    repr(args.num_threads) + " (must be >= 1)")
 
-                # reset the vertex buffer to what it must be for next round
-                cur = [vertex]
+        try:
+            tile_store = tile_store_from_spec(args.tile_store)
+        except ValueError, e:
+            parser.error(str(e))
 
-            if len(cur) == 0 or vertex[0] == cur[0][0]:
-                cur.append(vertex)
+        logger = get_logger(args)
+        tile_type = TILE_TYPES[args.tile_type]
+        zoom_levels = xrange(args.min_zoom, args.max_zoom + 1)
 
-        # append the final vertices
-        if len(cur) > 0:
-            if len(cur) > 2:
-                cur.sort(key=lambda v: v[1])
+        tiles = generate_shape_tiles(parser, args, zoom_levels, logger)
+        problems = verify_tiles(tile_type, tiles, tile_store,
+                num_threads=args.num_threads, logger=logger)
 
-            new_vertices.append(cur[0])
+        # summarize the problems by kind, lumping all damage together
+        kinds = defaultdict(int)
+        for tile, problem in problems:
+            logger.debug(str(tile) + ": " + problem)
+            if problem not in ("missing", "empty"):
+                problem = "corrupt"
+            kinds[problem] += 1
 
-            if len(cur) > 1:
-                new_vertices.append(cur[-1])
+        for kind in ("missing", "empty", "corrupt"):
+            print kind + ": " + str(kinds[kind])
 
-        print "condensed vertices:", new_vertices
-        vertices = new_vertices
+        if args.replay_file is not None:
+            write_tile_list(args.replay_file,
+                    ((tile_type, tile) for tile, problem in problems))
+            print "wrote " + str(len(problems)) + " tiles to " + args.replay_file
 
-        # get all lines, keeping only non-horizontal lines
-        lines = [pair for pair in Polygon.generate_vertex_pairs(vertices, True)]
-        print "lines:", lines
+        return 1 if len(problems) > 0 else 0
 
-        # find the bounds for the whole polygon
-        polygon_bounds = Polygon.get_bounds(*vertices)
+    def manifest_main(argv):
+        """
+        Writes the tiles of shape files to a manifest, for downloading later
+        with --from-manifest.
+        """
 
-        # iterate top to bottom along the y axis, building the SET
-        sorted_edges = defaultdict(list)
-        for y in xrange(polygon_bounds.top[1], polygon_bounds.bottom[1] + 1):
-            for a, b in lines:
-                # get bounding box for this line
-                bounds = Polygon.get_bounds(a, b)
+        parser = argparse.ArgumentParser(prog="mapper.py manifest",
+                description="Write the tiles of shape files to a compact, " +
+                "sorted manifest file.")
 
-                # the largest y, so we know when to stop checking the edge
-                y_max = bounds.bottom[1]
+        add_log_arguments(parser)
 
-                # the slope parts of the edge, to use edge coherence
-                rise = b[1] - a[1]
-                run = b[0] - a[0]
+        parser.add_argument("-m", "--min-zoom", type=int, default=0,
+                help="minimum zoom to include (" + str(MIN_ZOOM) + "-" +
+                str(MAX_ZOOM) + ")")
+        parser.add_argument("-z", "--max-zoom", type=int, default=0,
+                help="maximum zoom to include (" + str(MIN_ZOOM) + "-" +
+                str(MAX_ZOOM) + ")")
 
-                # add to SET if line has its minimum y coord in this scanline.
-                # this handles vertex edge cases as well.
-                x_min = None
-                if a[1] == y and a[1] == bounds.top[1]:
-                    x_min = a[0]
-                elif b[1] == y and b[1] == bounds.top[1]:
-                    x_min = b[0]
+        add_simplify_argument(parser)
+        add_corridor_argument(parser)
+        add_coverage_cache_arguments(parser)
 
-                # only add if we had a minimum vertex at this scanline
-                if x_min is not None:
-                    sorted_edges[y].append(Polygon.Edge(y_max, x_min, rise, run))
+        parser.add_argument("--subtract", type=os.path.abspath,
+                action="append", default=[], metavar="MANIFEST",
+                help="leave out the tiles in this manifest (may be repeated)")
+        parser.add_argument("--intersect", type=os.path.abspath,
+                action="append", default=[], metavar="MANIFEST",
+                help="only include the tiles also in this manifest (may be " +
+                "repeated)")
 
-                    # keep the entries sorted by y_max then x_min
-                    sorted_edges[y].sort(key=lambda e: (e.y_max, e.x_min))
+        parser.add_argument("-o", "--output", type=os.path.abspath,
+                required=True, help="manifest file to write")
 
-        print "sorted edges:", sorted_edges
+        parser.add_argument("shape_files", type=os.path.abspath, nargs="+",
+                metavar="shape_file", help="shape files to list tiles for")
 
-        # list of active edges, those intersecting with the current scanline
-        active_edges = []
+        args = parser.parse_args(argv)
 
-        # starting y value is smallest value in SET with a non-empty bucket,
-        # i.e. the top of our polygon's bounds.
-        y = polygon_bounds.top[1]
+        check_zoom_args(parser, args)
 
-        # continue while sorted edges or active edges have entries
-        while len(sorted_edges.values()) > 0 or len(active_edges) > 0:
-            # move y bucket into active edge list if the edges' y-min (the key
-            # into sorted edges) is the current y.
-            if y in sorted_edges:
-                active_edges.extend(sorted_edges[y])
-                del sorted_edges[y]
+        logger = get_logger(args)
+        zoom_levels = xrange(args.min_zoom, args.max_zoom + 1)
 
-            # sort active edges by x coordinates
-            active_edges.sort(key=lambda e: e.x_min)
+        tiles = generate_shape_tiles(parser, args, zoom_levels, logger)
+        keys = (TileManifest.get_key(tile) for tile in tiles)
 
-            # fill between pairs of intersections (excluding the final new edge
-            # if we added an odd number). keep track of the last yielded point
-            # so we don't duplicate points at 'v'-shaped intersections.
-            last_point = None
-            for a, b in itertools.izip(*[iter(active_edges)] * 2):
-                x_from = int(round(a.x_min))
-                x_to = int(round(b.x_min)) + 1
+        manifests = []
+        try:
+            for path in args.subtract + args.intersect:
+                try:
+                    manifests.append(TileManifest(path))
+                except ValueError, e:
+                    parser.error(str(e))
 
-                # round values to nearest whole number
-                for x in xrange(x_from, x_to):
-                    point = (x, y)
+            for manifest in manifests[:len(args.subtract)]:
+                keys = generate_keys_difference(keys, manifest.generate_keys())
+            for manifest in manifests[len(args.subtract):]:
+                keys = generate_keys_intersection(keys,
+                        manifest.generate_keys())
 
-                    # don't yield duplicate points (happens at some vertices)
-                    if point != last_point:
-                        yield point
+            count = write_manifest_keys(args.output, keys)
+        finally:
+            for manifest in manifests:
+                manifest.close()
 
-                    last_point = point
+        print "wrote " + str(count) + " tiles to " + args.output
 
-            # deactivate edges who's y-max is the current y
-            active_edges = filter(lambda e: e.y_max != y, active_edges)
+    def recrawl_main(argv):
+        """
+        Downloads the stalest tiles in a store again, forever, within a budget
+        of requests per hour.
+        """
 
-            # move to the next scanline
-            y += 1
+        parser = argparse.ArgumentParser(prog="mapper.py recrawl",
+                description="Keep a tile store fresh by continuously " +
+                "downloading its stalest tiles again.")
+
+        add_log_arguments(parser)
+
+        parser.add_argument("-s", "--tile-store", required=True,
+                help="store to refresh, as 'file:DIRECTORY' or " +
+                "'mongo://HOST:PORT/DB/COLLECTION'")
+        parser.add_argument("-d", "--dedup", action="store_true", default=False,
+                help="store identical tiles only once, for stores that were " +
+                "downloaded with --dedup")
+
+        parser.add_argument("-r", "--rate", type=float, required=True,
+                metavar="REQUESTS",
+                help="most tiles to download per hour")
+        parser.add_argument("-i", "--interval", type=float, default=60,
+                help="seconds between rounds of downloads (default 60)")
+        parser.add_argument("--min-age", type=float,
+                default=Recrawler.DEFAULT_MIN_AGE / 3600.0, metavar="HOURS",
+                help="never download tiles stored fewer than this many hours " +
+                "ago (default " + str(Recrawler.DEFAULT_MIN_AGE / 3600) + ")")
+        parser.add_argument("--retry-delay", type=float,
+                default=Recrawler.DEFAULT_RETRY_DELAY / 3600.0,
+                metavar="HOURS",
+                help="pass over tiles that failed to download for this many " +
+                "hours (default " + str(Recrawler.DEFAULT_RETRY_DELAY / 3600) +
+                ")")
+
+        parser.add_argument("--zoom-weight", action="append", default=[],
+                metavar="ZOOM:WEIGHT",
+                help="refresh tiles at this zoom level WEIGHT times as " +
+                "urgently as others (may be repeated, default 1)")
+        parser.add_argument("--access-log", type=os.path.abspath,
+                default=None,
+                help="refresh the tiles most requested in this tile server " +
+                "access log more urgently")
+        parser.add_argument("--access-weight", type=float, default=1.0,
+                help="how much the access log counts for (default 1)")
+
+        parser.add_argument("-n", "--num-threads", type=int, default=4,
+                help="number of download threads to use (default 4)")
+        parser.add_argument("-w", "--num-writers", type=int, default=1,
+                help="number of threads storing downloaded tiles, or 0 to " +
+                "store them from the download threads (default 1)")
+
+        args = parser.parse_args(argv)
+
+        if args.rate <= 0:
+            parser.error("argument -r/--rate: invalid rate: " +
+                    repr(args.rate) + " (must be > 0)")
+        if args.interval <= 0:
+            parser.error("argument -i/--interval: invalid interval: " +
+                    repr(args.interval) + " (must be > 0)")
+        if args.num_threads < 1:
+            parser.error("argument -n/--num-threads: invalid thread count: " +
+                    repr(args.num_threads) + " (must be >= 1)")
+        if args.num_writers < 0:
+            parser.error("argument -w/--num-writers: invalid thread count: " +
+                    repr(args.num_writers) + " (must be >= 0)")
+
+        zoom_weights = {}
+        for zoom_weight in args.zoom_weight:
+            try:
+                zoom, weight = zoom_weight.split(":")
+                zoom_weights[int(zoom)] = float(weight)
+            except ValueError:
+                parser.error("argument --zoom-weight: invalid weight: " +
+                        repr(zoom_weight) + " (must be ZOOM:WEIGHT)")
 
-            # update x for non-vertical edges left in active edges
-            for edge in active_edges:
-                # update edge's x_min for next round if the edge isn't vertical
-                if edge.run != 0:
-                    # TODO: use incremental calculation
-                    edge.x_min = edge.x_min + (1.0 * edge.run / edge.rise)
+        try:
+            tile_store = tile_store_from_spec(args.tile_store, dedup=args.dedup)
+        except ValueError, e:
+            parser.error(str(e))
+
+        if isinstance(tile_store, NullTileStore):
+            parser.error("argument -s/--tile-store: a null store has no " +
+                    "tiles to refresh")
+
+        access_counts = None
+        if args.access_log is not None:
+            access_counts = count_tile_requests(args.access_log)
+
+        recrawler = Recrawler(tile_store, args.rate, zoom_weights=zoom_weights,
+                access_counts=access_counts, access_weight=args.access_weight,
+                min_age=args.min_age * 3600,
+                retry_delay=args.retry_delay * 3600)
+        recrawler.run(interval=args.interval, num_threads=args.num_threads,
+                num_writers=args.num_writers, logger=get_logger(args))
+
+    def jobs_main(argv):
+        """
+        Runs the download jobs described in a jobs file together, sharing one
+        pool of download threads. Exits with a status of 1 if any job failed.
+        """
 
-    @staticmethod
-    def get_area(vertices):
+        parser = argparse.ArgumentParser(prog="mapper.py jobs",
+                description="Run several download jobs at once, sharing " +
+                "download threads and tile stores between them.")
+
+        add_log_arguments(parser)
+
+        parser.add_argument("jobs_file", type=os.path.abspath,
+                help="JSON file holding a list of job specs (see " +
+                "DownloadJob.from_spec() for their format)")
+
+        parser.add_argument("-n", "--num-threads", type=int, default=10,
+                help="number of download threads shared by every job " +
+                "(default 10)")
+        parser.add_argument("-w", "--num-writers", type=int, default=1,
+                help="number of threads storing downloaded tiles, or 0 to " +
+                "store them from the download threads (default 1)")
+        parser.add_argument("-p", "--policy", choices=JobRunner.POLICIES,
+                default="fair",
+                help="share threads between jobs by weight alone, or serve " +
+                "higher priority jobs first (default fair)")
+        parser.add_argument("--progress-interval", type=float, default=10,
+                help="seconds between logging each job's progress " +
+                "(default 10)")
+
+        args = parser.parse_args(argv)
+
+        if args.num_threads < 1:
+            parser.error("argument -n/--num-threads: invalid thread count: " +
+                    repr(args.num_threads) + " (must be >= 1)")
+        if args.num_writers < 0:
+            parser.error("argument -w/--num-writers: invalid thread count: " +
+                    repr(args.num_writers) + " (must be >= 0)")
+        if args.progress_interval <= 0:
+            parser.error("argument --progress-interval: invalid interval: " +
+                    repr(args.progress_interval) + " (must be > 0)")
+
+        logger = get_logger(args)
+
+        # build every job before starting any, so a bad spec fails fast
+        tile_stores = {}
+        try:
+            with open(args.jobs_file, "r") as f:
+                specs = json.load(f)
+            if not isinstance(specs, list):
+                raise ValueError("Jobs file doesn't hold a list of job specs")
+
+            jobs = [DownloadJob.from_spec(spec, tile_stores) for spec in specs]
+        except (IOError, OSError, ValueError, TypeError), e:
+            parser.error(str(e))
+
+        runner = JobRunner(num_threads=args.num_threads,
+                num_writers=args.num_writers, policy=args.policy,
+                report_interval=args.progress_interval, logger=logger)
+        for job in jobs:
+            runner.submit(job)
+        runner.close()
+
+        status = 0
+        for progress in runner.get_progress():
+            print (progress["name"] + ": " + str(progress["downloaded"]) +
+                    " downloaded, " + str(progress["failed"]) + " failed" +
+                    ("" if progress["error"] is None else
+                        ", error: " + progress["error"]))
+            if progress["error"] is not None:
+                status = 1
+
+        return status
+
+    def migrate_main(argv):
         """
-        Same as generate_area(), but returns a list instead of a generator.
+        Copies every tile from one tile store to another.
         """
 
-        return [point for point in Polygon.generate_area(vertices)]
+        parser = argparse.ArgumentParser(prog="mapper.py migrate",
+                description="Copy tiles from one tile store to another.")
+
+        add_log_arguments(parser)
+
+        parser.add_argument("--from", dest="source", required=True,
+                help="store to copy tiles from, as 'file:DIRECTORY' or " +
+                "'mongo://HOST:PORT/DB/COLLECTION'")
+        parser.add_argument("--to", dest="destination", required=True,
+                help="store to copy tiles to, in the same format as --from, " +
+                "or 'null:' to only read the source")
+
+        parser.add_argument("-t", "--tile-type", action="append",
+                choices=TILE_TYPES, default=None,
+                help="only copy tiles of this type (may be repeated, " +
+                "default all)")
+        parser.add_argument("-m", "--min-zoom", type=int, default=MIN_ZOOM,
+                help="minimum zoom to copy (default " + str(MIN_ZOOM) + ")")
+        parser.add_argument("-z", "--max-zoom", type=int, default=MAX_ZOOM,
+                help="maximum zoom to copy (default " + str(MAX_ZOOM) + ")")
+
+        parser.add_argument("-n", "--num-threads", type=int, default=4,
+                help="number of layers, or shards of big layers, copied in " +
+                "parallel (default 4)")
+        parser.add_argument("-b", "--batch-size", type=int,
+                default=StoreWriter.DEFAULT_BATCH_SIZE,
+                help="number of tiles written to the destination at once " +
+                "(default " + str(StoreWriter.DEFAULT_BATCH_SIZE) + ")")
+        parser.add_argument("--shard-size", type=int,
+                default=MIGRATION_SHARD_SIZE,
+                help="split layers with more tiles than this into ranges of " +
+                "rows copied in parallel (default " +
+                str(MIGRATION_SHARD_SIZE) + ")")
+        parser.add_argument("-p", "--progress-file", type=os.path.abspath,
+                default=None,
+                help="file recording progress, so an interrupted migration " +
+                "can be resumed by running the same command again")
+
+        parser.add_argument("-d", "--dedup", action="store_true", default=False,
+                help="store identical tiles only once in the destination")
+
+        args = parser.parse_args(argv)
+
+        if args.num_threads < 1:
+            parser.error("argument -n/--num-threads: invalid thread count: " +
+                    repr(args.num_threads) + " (must be >= 1)")
+
+        if args.batch_size < 1:
+            parser.error("argument -b/--batch-size: invalid batch size: " +
+                    repr(args.batch_size) + " (must be >= 1)")
+
+        if args.shard_size < 1:
+            parser.error("argument --shard-size: invalid shard size: " +
+                    repr(args.shard_size) + " (must be >= 1)")
 
-if __name__ == "__main__":
-    import argparse
-    import sys
-    import logging
+        try:
+            source = tile_store_from_spec(args.source)
+            destination = tile_store_from_spec(args.destination,
+                    dedup=args.dedup)
+        except ValueError, e:
+            parser.error(str(e))
 
-    # constant values for zoom levels
-    MIN_ZOOM = 0
-    MAX_ZOOM = 21
+        tile_types = None
+        if args.tile_type is not None:
+            tile_types = [TILE_TYPES[name] for name in args.tile_type]
 
-    # various tile stores we're allowed to use
-    TILE_STORES = {
-        "null": NullTileStore,
-        "file": FileTileStore,
-        "mongo": MongoTileStore
-    }
+        zoom_levels = xrange(args.min_zoom, args.max_zoom + 1)
 
-    # all the types of tiles available for download
-    TILE_TYPES = {
-        Tile.TYPE_BIKE.name: Tile.TYPE_BIKE,
-        Tile.TYPE_MAP.name: Tile.TYPE_MAP,
-        Tile.TYPE_OVERLAY.name: Tile.TYPE_OVERLAY,
-        Tile.TYPE_SATELLITE.name: Tile.TYPE_SATELLITE,
-        Tile.TYPE_SATELLITE_PLAIN.name: Tile.TYPE_SATELLITE_PLAIN,
-        Tile.TYPE_TERRAIN.name: Tile.TYPE_TERRAIN,
-        Tile.TYPE_TERRAIN_PLAIN.name: Tile.TYPE_TERRAIN_PLAIN,
-    }
+        logger = get_logger(args)
 
-    # the levels of log verbosity we support
-    LOG_LEVELS = {
-        "silent": None,
-        "debug": logging.DEBUG,
-        "info": logging.INFO,
-        "warning": logging.WARNING,
-        "error": logging.ERROR,
-        "critical": logging.CRITICAL,
+        try:
+            migrate_tiles(source, destination, tile_types=tile_types,
+                    zoom_levels=zoom_levels, num_threads=args.num_threads,
+                    batch_size=args.batch_size,
+                    progress_file=args.progress_file, logger=logger,
+                    shard_size=args.shard_size)
+        except Exception, e:
+            logger.error("Migration failed: " + str(e))
+            return 1
+
+    # commands besides downloading are chosen by the first argument
+    COMMANDS = {
+        "jobs": jobs_main,
+        "manifest": manifest_main,
+        "migrate": migrate_main,
+        "recrawl": recrawl_main,
+        "verify": verify_main,
     }
 
-    parser = argparse.ArgumentParser(
-            description="Download an area of map tiles from Google maps.")
-
-    parser.add_argument("-l", "--log-level", choices=LOG_LEVELS, default="info",
-            help="set the log verbosity (default info)")
-    parser.add_argument("-f", "--log-file", type=os.path.abspath, default=None,
-            help="if specified, logs to the given file rather than the screen")
-
-    parser.add_argument("-m", "--min-zoom", type=int, default=0,
-            help="minimum zoom to download (" + str(MIN_ZOOM) + "-" +
-            str(MAX_ZOOM) + ")")
-    parser.add_argument("-z", "--max-zoom", type=int, default=0,
-            help="maximum zoom to download (" + str(MIN_ZOOM) + "-" +
-            str(MAX_ZOOM) + ")")
-
-    parser.add_argument("-t", "--tile-type", default="map",
-            choices=TILE_TYPES, help="type of tile to download (default map)")
-
-    parser.add_argument("-n", "--num-threads", type=int, default=10,
-            help="number of download threads to use (default 10)")
-
-    parser.add_argument("shape_file", type=os.path.abspath,
-            help="shape file to download")
-
-    parser.add_argument("-s", "--tile-store", default="file",
-            choices=["null", "file", "mongo"],
-            help="where tiles are stored (default file)")
-
-    parser.add_argument("-k", "--skip-to-tile", nargs=3, type=int, default=None,
-            help="tile to skip to before downloading tiles (format 'x y zoom'")
-
-    # TODO: add specific options for various tiles stores
-
-    args = parser.parse_args()
-
-    # enforce zoom levels (custom to prevent ultra-verbose default output)
-    if args.min_zoom < MIN_ZOOM or args.min_zoom > MAX_ZOOM:
-        print parser.format_usage().strip()
-        print ("mapper.py: error: argument -m/--min-zoom: invalid zoom: " +
-                repr(args.min_zoom) + " (must be between " + str(MIN_ZOOM) +
-                "-" + str(MAX_ZOOM) + ")")
-        sys.exit(1)
-
-    if args.max_zoom < MIN_ZOOM or args.max_zoom > MAX_ZOOM:
-        print parser.format_usage().strip()
-        print ("mapper.py: error: argument -z/--max-zoom: invalid zoom: " +
-                repr(args.max_zoom) + " (must be between " + str(MIN_ZOOM) +
-                "-" + str(MAX_ZOOM) + ")")
-        sys.exit(2)
-
-    if args.max_zoom < args.min_zoom:
-        print parser.format_usage().strip()
-        print ("mapper.py: error: argument -z/--max-zoom: invalid zoom: " +
-                repr(args.max_zoom) + " (must be larger than the min zoom)")
-        sys.exit(3)
-
-    # enforce thread count
-    if args.num_threads < 1:
-        print parser.format_usage().strip()
-        print ("mapper.py: error: argument -n/--num-threads: invalid thread count: " +
-                repr(args.num_threads) + " (must be >= 1)")
-        sys.exit(4)
-
-    # turn tile type string into a tile type object
-    tile_type = TILE_TYPES[args.tile_type]
-
-    # get the zoom levels we'll download (arg ranges are inclusive)
-    zoom_levels = xrange(args.min_zoom, args.max_zoom + 1)
-
-    # create a tile store based on the specified string
-    tile_store = TILE_STORES[args.tile_store]()
-
-    # set up a logger depending on the specified verbosity and file name
-    logger = __get_null_logger()
-    if LOG_LEVELS[args.log_level] is not None:
-        logging.basicConfig(level=LOG_LEVELS[args.log_level],
-                filename=args.log_file)
-        logger = logging
-
-    # build the skip-to-tile
-    skip_to_tile = None
-    if args.skip_to_tile is not None:
-        skip_to_tile = Tile.from_google(args.skip_to_tile[0],
-                args.skip_to_tile[1], args.skip_to_tile[2])
-
-    # download the area from the shape file
     try:
-        shape_vertices = parse_shape_file(args.shape_file)
-        download_area(tile_type, shape_vertices, tile_store, zoom_levels,
-                num_threads=args.num_threads, logger=logger,
-                skip_to_tile=skip_to_tile)
+        if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+            status = COMMANDS[sys.argv[1]](sys.argv[2:])
+        else:
+            status = download_main(sys.argv[1:])
     except KeyboardInterrupt:
         # exit and signal that we were interrupted
         logging.shutdown()
         sys.exit(10)
 
-    # great success!
+    # great success, unless the command said otherwise
     logging.shutdown()
-    sys.exit(0)
-
+    sys.exit(status or 0)
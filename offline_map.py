@@ -1,40 +1,1044 @@
 #!/usr/bin/env python
 
+from collections import OrderedDict
+from cStringIO import StringIO
+import json
+import Queue as queue
+import struct
+import threading
+import time
+
 import flask
+from werkzeug.serving import BaseWSGIServer
+
+import mapper
+from mapper import Tile
 
-import pymongo
-import bson
+# PIL is only needed to make fallback tiles
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 app = flask.Flask(__name__);
 
-# connect to mongo so we can pull tiles from it
-DB = pymongo.Connection("127.0.0.1", 27017)["mapper"]["tiles"]
+# where we pull tiles from, set by configure()
+STORE = None
+
+# how many bytes of tile data we keep in memory
+CACHE_BYTES = 64 * 1024 * 1024
+
+# how long, in seconds, we remember that a tile wasn't in the store
+NEGATIVE_TTL = 30
+
+# how long, in seconds, browsers may use a tile before checking it's current
+CACHE_MAX_AGE = 60 * 60
+
+# the most tiles a single batch request may ask for
+MAX_BATCH_TILES = 256
+
+# whether missing tiles are made from their nearest stored ancestor, set by
+# configure(). needs PIL.
+FALLBACK = False
+
+# the most zoom levels we'll look up for a missing tile's ancestor. any further
+# and the ancestor's crop would be smaller than a pixel.
+MAX_FALLBACK_LEVELS = 8
+
+# how often, in seconds, we check the store for updated tiles, or None to never
+# check. updated tiles are dropped from the cache so they're served fresh.
+INVALIDATE_INTERVAL = None
+
+class TileCache:
+    """
+    A thread-safe, least-recently-used cache of tile data limited by the total
+    size of the data it holds. Each tile's data is kept along with its ETag.
+    Tiles that weren't found can be cached as well, so repeated requests for
+    them don't reach the store either. These negative entries expire after a
+    while, in case the tile gets downloaded.
+    """
+
+    # the size we count a negative entry as, roughly that of its bookkeeping
+    NEGATIVE_ENTRY_BYTES = 100
+
+    def __init__(self, max_bytes, negative_ttl):
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl
+
+        # maps keys to (tile_data, etag) pairs, or to an expiration time for
+        # negative entries. the least recently used entry is always first.
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_entry_size(value):
+        if isinstance(value, float):
+            return TileCache.NEGATIVE_ENTRY_BYTES
+
+        # stores that can't version their tiles give us no ETag
+        tile_data, etag = value
+        return len(tile_data) + (0 if etag is None else len(etag))
+
+    def get(self, key):
+        """
+        Returns a (found, tile_data, etag) triple for the given key. found is
+        True if the cache knew about the key, in which case tile_data and etag
+        are either the tile's or None if the tile is known not to exist.
+        """
+
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return False, None, None
+
+            # forget expired negative entries
+            if isinstance(value, float) and value <= time.time():
+                self.size -= TileCache.get_entry_size(value)
+                self.misses += 1
+                return False, None, None
+
+            # re-insert the entry to mark it as the most recently used
+            self.entries[key] = value
+
+            if isinstance(value, float):
+                self.negative_hits += 1
+                return True, None, None
+
+            self.hits += 1
+            return True, value[0], value[1]
+
+    def put(self, key, tile_data, etag=None):
+        """
+        Caches the data and ETag for the given key, or a negative entry if
+        tile_data is None. Evicts the least recently used entries to stay
+        within budget. Data too large to ever fit isn't cached.
+        """
+
+        value = (tile_data, etag)
+        if tile_data is None:
+            value = time.time() + self.negative_ttl
+
+        entry_size = TileCache.get_entry_size(value)
+        if entry_size > self.max_bytes:
+            return
+
+        with self.lock:
+            old_value = self.entries.pop(key, None)
+            if old_value is not None:
+                self.size -= TileCache.get_entry_size(old_value)
+
+            self.entries[key] = value
+            self.size += entry_size
+
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= TileCache.get_entry_size(evicted)
+
+    def contains(self, key):
+        """
+        Returns whether the cache has an entry for the key, without counting
+        the check as a use of the entry.
+        """
+
+        with self.lock:
+            return key in self.entries
+
+    def invalidate(self, key):
+        """
+        Drops any entry for the given key.
+        """
+
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.size -= TileCache.get_entry_size(value)
+
+    def get_stats(self):
+        """
+        Returns a dict of the cache's counters and current size.
+        """
+
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+CACHE = TileCache(CACHE_BYTES, NEGATIVE_TTL)
+
+class CoverageIndex:
+    """
+    Knows which tiles the store holds for every layer, as a mapper.Coverage per
+    tile type and zoom level, so requests for tiles that don't exist can be
+    answered without going to the store. The index is built by scanning the
+    store, during which only the layers already scanned are known.
+    """
+
+    def __init__(self):
+        # maps (v, zoom) pairs to coverages of scanned layers
+        self.layers = {}
+        # coverages of tiles added to layers that haven't been scanned yet
+        self.pending = {}
+        self.complete = False
+        self.lock = threading.Lock()
+
+    def build(self, tile_store):
+        """
+        Scans every layer in the store into the index. Meant to be run in a
+        thread, as this takes a while for large stores.
+        """
+
+        for tile_type, zoom in tile_store.get_layers():
+            coverage = mapper.Coverage.from_tiles(zoom,
+                    tile_store.scan_tiles(tile_type, zoom))
+
+            # merge in anything added while we were scanning
+            with self.lock:
+                self.__merge(coverage,
+                        self.pending.pop((tile_type.v, zoom), None))
+                self.layers[(tile_type.v, zoom)] = coverage
+
+            app.logger.info("Indexed " + str(coverage.count()) + " " +
+                    tile_type.name + " tiles at zoom " + str(zoom))
+
+        # layers that only appeared after we listed them hold just what was
+        # added since
+        with self.lock:
+            for key, coverage in self.pending.iteritems():
+                self.layers[key] = coverage
+            self.pending = {}
+            self.complete = True
+
+    @staticmethod
+    def __merge(coverage, other):
+        if other is not None:
+            for y, x_first, x_last in other.generate_spans():
+                coverage.add_span(y, x_first, x_last)
+
+    def add(self, v, x, y, zoom):
+        """
+        Records that the store now holds the given tile.
+        """
+
+        with self.lock:
+            if self.complete or (v, zoom) in self.layers:
+                layers = self.layers
+            else:
+                layers = self.pending
+            if (v, zoom) not in layers:
+                layers[(v, zoom)] = mapper.Coverage(zoom)
+            layers[(v, zoom)].add(x, y)
+
+    def is_complete(self, v, zoom):
+        """
+        Returns whether the given layer's coverage lists every tile held for
+        it, which isn't the case until it has been scanned.
+        """
+
+        with self.lock:
+            return self.complete or (v, zoom) in self.layers
+
+    def is_missing(self, v, x, y, zoom):
+        """
+        Returns True if the store is known not to hold the given tile, and False
+        if it does or we don't know yet.
+        """
+
+        with self.lock:
+            coverage = self.layers.get((v, zoom))
+            if coverage is None:
+                return self.complete
+            return not coverage.contains(x, y)
+
+    def get_spans(self, v, zoom, bbox=None):
+        """
+        Returns a list of the [y, x_first, x_last] spans of tiles held for the
+        given layer, optionally clipped to a bbox.
+        """
+
+        with self.lock:
+            coverage = self.layers.get((v, zoom))
+            if coverage is None:
+                coverage = self.pending.get((v, zoom))
+            if coverage is None:
+                return []
+            return [list(span) for span in coverage.generate_spans(bbox)]
+
+# the index of tiles in the store, or None if we aren't keeping one
+COVERAGE = None
+
+class Prefetcher:
+    """
+    Guesses which tiles will be requested next from the tiles requested now,
+    and loads them into the cache on a pool of background threads. Predicted
+    tiles are those surrounding the requested ones at the same zoom level, plus
+    the same area one zoom level in and out. Predictions are dropped rather
+    than queued when the workers can't keep up, so prefetching never delays
+    real requests.
+    """
+
+    # the most tiles we'll predict from a single request
+    MAX_PREDICTED_TILES = 256
+
+    def __init__(self, num_workers, queue_size=None):
+        self.prefetch_queue = queue.Queue(
+                num_workers * 4 if queue_size is None else queue_size)
+
+        # keys of tiles queued or being loaded, so we don't load them twice
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+        self.prefetched = 0
+        self.dropped = 0
+
+        for i in xrange(num_workers):
+            thread = threading.Thread(target=self.prefetch_tiles)
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def predict(zoom, bbox):
+        """
+        Returns a list of (x, y, zoom) triples for the tiles likely to be
+        requested after those in the given inclusive bbox.
+        """
+
+        x_min, y_min, x_max, y_max = bbox
+        predicted = []
+
+        # the ring of tiles around the area at the same zoom level
+        for y in xrange(y_min - 1, y_max + 2):
+            for x in xrange(x_min - 1, x_max + 2):
+                if not (x_min <= x <= x_max and y_min <= y <= y_max):
+                    predicted.append((x, y, zoom))
+
+        # the area's parents, then its children
+        if zoom > 0:
+            for y in xrange(y_min >> 1, (y_max >> 1) + 1):
+                for x in xrange(x_min >> 1, (x_max >> 1) + 1):
+                    predicted.append((x, y, zoom - 1))
+
+        if zoom < Tile.MAX_ZOOM:
+            for y in xrange(y_min * 2, y_max * 2 + 2):
+                for x in xrange(x_min * 2, x_max * 2 + 2):
+                    predicted.append((x, y, zoom + 1))
+
+        # drop tiles off the edge of the world
+        return [(x, y, z) for x, y, z in predicted
+                if 0 <= x < 2 ** z and 0 <= y < 2 ** z]
+
+    def request(self, tile_type, zoom, bbox):
+        """
+        Queues the tiles predicted from a request for the tiles in the bbox, if
+        they aren't already cached or known to be missing.
+        """
+
+        tiles = []
+        with self.lock:
+            for x, y, z in Prefetcher.predict(zoom, bbox):
+                key = (tile_type.v, x, y, z)
+                if (key in self.in_flight or CACHE.contains(key) or
+                        (COVERAGE is not None and
+                            COVERAGE.is_missing(tile_type.v, x, y, z))):
+                    continue
+
+                tiles.append(Tile.from_google(x, y, z))
+                if len(tiles) >= Prefetcher.MAX_PREDICTED_TILES:
+                    break
+
+            if len(tiles) == 0:
+                return
+
+            try:
+                self.prefetch_queue.put_nowait((tile_type, tiles))
+            except queue.Full:
+                self.dropped += len(tiles)
+                return
+
+            self.in_flight.update((tile_type.v, t.x, t.y, t.zoom)
+                    for t in tiles)
+
+    def prefetch_tiles(self):
+        """
+        Forever loads queued tiles into the cache. Run by each worker thread.
+        """
+
+        while 1:
+            tile_type, tiles = self.prefetch_queue.get()
+
+            # the store wants each lookup to be for a single zoom level
+            by_zoom = {}
+            for tile in tiles:
+                by_zoom.setdefault(tile.zoom, []).append(tile)
+
+            try:
+                for zoom_tiles in by_zoom.itervalues():
+                    fetch_tiles(tile_type, zoom_tiles)
+            except Exception, e:
+                app.logger.error("Failed to prefetch tiles: " + str(e))
+
+            with self.lock:
+                self.prefetched += len(tiles)
+                self.in_flight.difference_update(
+                        (tile_type.v, t.x, t.y, t.zoom) for t in tiles)
+
+    def get_stats(self):
+        """
+        Returns a dict of the prefetcher's counters.
+        """
+
+        with self.lock:
+            return {
+                "prefetched": self.prefetched,
+                "dropped": self.dropped,
+                "queued": self.prefetch_queue.qsize(),
+            }
+
+# loads predicted tiles into the cache, or None if we aren't prefetching
+PREFETCHER = None
+
+def warm_cache(tiles_by_type, max_bytes):
+    """
+    Loads tiles into the cache ahead of time, in batches of MAX_BATCH_TILES per
+    tile type and zoom level. tiles_by_type is an iterable of (tile_type, tile)
+    pairs, in order of importance. Stops once max_bytes of tile data have been
+    loaded, since anything more would only push earlier tiles out of the
+    cache. Returns the number of tiles loaded.
+    """
+
+    loaded = {"tiles": 0, "bytes": 0}
+
+    def load(tile_type, tiles):
+        for tile_data, etag in fetch_tiles(tile_type, tiles):
+            if tile_data is not None:
+                loaded["tiles"] += 1
+                loaded["bytes"] += len(tile_data)
+
+    batches = {}
+    for tile_type, tile in tiles_by_type:
+        batch = batches.setdefault((tile_type, tile.zoom), [])
+        batch.append(tile)
+
+        if len(batch) >= MAX_BATCH_TILES:
+            load(tile_type, batch)
+            del batches[(tile_type, tile.zoom)]
+
+            if loaded["bytes"] >= max_bytes:
+                return loaded["tiles"]
+
+    for (tile_type, zoom), batch in batches.iteritems():
+        if loaded["bytes"] >= max_bytes:
+            break
+        load(tile_type, batch)
+
+    return loaded["tiles"]
+
+def parse_access_log(access_log, top=None):
+    """
+    Returns a list of (tile_type, tile) pairs for the tiles requested in an
+    access log, most requested first, limited to the top most requested if
+    given. Any log with a line per request containing the requested path and
+    query, like those written by --access-log, can be read.
+    """
+
+    counts = mapper.count_tile_requests(access_log)
+
+    keys = sorted(counts, key=counts.get, reverse=True)
+    if top is not None:
+        keys = keys[:top]
+
+    return [(Tile.get_type(v), Tile.from_google(x, y, zoom))
+            for v, x, y, zoom in keys]
+
+def configure(tile_store, cache_bytes=CACHE_BYTES, negative_ttl=NEGATIVE_TTL,
+        cache_max_age=CACHE_MAX_AGE, invalidate_interval=INVALIDATE_INTERVAL,
+        coverage=False, prefetch_workers=0, fallback=False):
+    """
+    Sets up the server to serve tiles from the given tile store. Must be called
+    before serving any requests, including when the app is run by some other
+    WSGI server. If coverage is True, a CoverageIndex of the store is built in
+    the background, and kept current by the same polling that invalidates the
+    cache, so invalidate_interval must be given too. If prefetch_workers is
+    more than 0, a Prefetcher with that many workers loads predicted tiles into
+    the cache. If fallback is True, missing tiles are served as a crop of their
+    nearest stored ancestor. See the module constants for the other parameters.
+    """
+
+    global STORE, CACHE, CACHE_MAX_AGE, COVERAGE, PREFETCHER, FALLBACK
+
+    if fallback and Image is None:
+        raise ValueError("Serving fallback tiles requires PIL")
+    FALLBACK = fallback
+
+    # without polling, tiles stored after the index is built would be 404s
+    if coverage and invalidate_interval is None:
+        raise ValueError("A coverage index requires an invalidate interval")
+
+    PREFETCHER = None
+    if prefetch_workers > 0:
+        PREFETCHER = Prefetcher(prefetch_workers)
+
+    STORE = tile_store
+    CACHE = TileCache(cache_bytes, negative_ttl)
+    CACHE_MAX_AGE = cache_max_age
+
+    COVERAGE = None
+    if coverage:
+        COVERAGE = CoverageIndex()
+        thread = threading.Thread(target=COVERAGE.build, args=(STORE,))
+        thread.daemon = True
+        thread.start()
+
+    if invalidate_interval is not None:
+        thread = threading.Thread(target=invalidate_updated_tiles,
+                args=(STORE, CACHE, invalidate_interval))
+        thread.daemon = True
+        thread.start()
+
+def invalidate_updated_tiles(tile_store, cache, interval):
+    """
+    Forever polls the tile store every interval seconds for tiles updated since
+    the last poll, dropping them from the cache. Meant to be run in a thread.
+
+    Update dates are whole seconds, so each poll includes the second of the
+    latest update already seen. Tiles updated in that second after the last
+    poll are caught at the cost of invalidating some tiles twice.
+    """
+
+    global COVERAGE
+
+    last_update = int(time.time())
+    while 1:
+        time.sleep(interval)
+
+        try:
+            for tile_type, tile, update_date in tile_store.get_updated(
+                    last_update):
+                cache.invalidate((tile_type.v, tile.x, tile.y, tile.zoom))
+                if COVERAGE is not None:
+                    COVERAGE.add(tile_type.v, tile.x, tile.y, tile.zoom)
+                last_update = max(last_update, update_date)
+        except NotImplementedError:
+            app.logger.warning("Tile store can't report updated tiles, " +
+                    "cache won't be invalidated")
+
+            # an index we can't keep current would hide new tiles
+            if COVERAGE is not None:
+                app.logger.warning("Dropping the coverage index")
+                COVERAGE = None
+            return
+        except Exception, e:
+            app.logger.error("Failed to check for updated tiles: " + str(e))
+
+@app.route("/_cache", methods=("GET",))
+def get_cache_stats():
+    stats = CACHE.get_stats()
+    if PREFETCHER is not None:
+        stats["prefetch"] = PREFETCHER.get_stats()
+
+    return flask.Response(response=json.dumps(stats),
+            content_type="application/json")
 
 @app.route("/<v>", methods=("GET",))
 def get_tile(v):
     # the things we need to put together our map
-    x = flask.request.args.get("x")
-    y = flask.request.args.get("y")
-    zoom = flask.request.args.get("zoom")
-
-    # try to find the requested tile
-    tile_query = {
-        "x": int(x),
-        "y": int(y),
-        "zoom": int(zoom),
-        "tile_type.v": v,
-    }
+    x = int(flask.request.args.get("x"))
+    y = int(flask.request.args.get("y"))
+    zoom = int(flask.request.args.get("zoom"))
+
+    # only serve tile types we know about
+    try:
+        tile_type = Tile.get_type(v)
+    except ValueError:
+        flask.abort(404)
+
+    tile = Tile.from_google(x, y, zoom)
+
+    # don't bother looking for tiles we know aren't there
+    if COVERAGE is not None and COVERAGE.is_missing(v, x, y, zoom):
+        return get_tile_response(*get_fallback_tile(tile_type, tile))
+
+    # start loading the tiles likely to be requested next
+    if PREFETCHER is not None:
+        PREFETCHER.request(tile_type, zoom, (x, y, x, y))
+
+    key = (v, x, y, zoom)
+    found, tile_data, etag = CACHE.get(key)
 
-    tile = DB.find_one(tile_query)
+    # if the client says which version it has, check it against the store
+    # without loading the tile's data, and tell it to keep its copy if current.
+    if not found and flask.request.if_none_match:
+        version = STORE.get_version(tile_type, tile)
+        if version is None:
+            CACHE.put(key, None)
+            return get_tile_response(*get_fallback_tile(tile_type, tile))
+
+        if version in flask.request.if_none_match:
+            return get_not_modified_response(version)
+
+    # try to find the requested tile, going to the store only if we must
+    if not found:
+        tile_data, etag = fetch_tiles(tile_type, [tile])[0]
+
+    if tile_data is None:
+        tile_data, etag = get_fallback_tile(tile_type, tile)
+
+    return get_tile_response(tile_data, etag)
+
+def get_tile_response(tile_data, etag):
+    """
+    Returns the response for a single tile request, a 404 if the tile's data is
+    None.
+    """
 
     # return a 404 if we couldn't find the given tile
-    if tile is None:
+    if tile_data is None:
         flask.abort(404)
 
+    if etag in flask.request.if_none_match:
+        return get_not_modified_response(etag)
+
     # give the user back our decoded image data
-    response = tile["image_data"]
+    response = tile_data
     content_type = "image/png"
-    return flask.Response(response=response, content_type=content_type)
+    response = flask.Response(response=response, content_type=content_type)
+    set_cache_headers(response, etag)
+    return response
+
+def is_valid_tile(x, y, zoom):
+    """
+    Returns whether the given coordinates name a tile on the map.
+    """
+
+    if not 0 <= zoom <= Tile.MAX_ZOOM:
+        return False
+
+    num_tiles = 2 ** zoom
+    return 0 <= x < num_tiles and 0 <= y < num_tiles
+
+@app.route("/<v>/batch", methods=("GET",))
+def get_tile_batch(v):
+    """
+    Returns many tiles of one type and zoom level in a single response. Tiles
+    are given either as 'bbox=x_min,y_min,x_max,y_max', an inclusive range, or
+    as 'tiles=x0,y0;x1,y1;...'. The response body is a frame per requested
+    tile, in the order requested, each made of a header packed as three
+    big-endian 32-bit integers (x, y, and the length of the tile's data, or -1
+    if the tile doesn't exist) followed by the tile's data. Coordinates outside
+    the map at the requested zoom level are rejected, as they can't be packed.
+    """
+
+    try:
+        tile_type = Tile.get_type(v)
+    except ValueError:
+        flask.abort(404)
+
+    try:
+        zoom = int(flask.request.args.get("zoom"))
+    except (TypeError, ValueError):
+        flask.abort(400)
+
+    # collect the requested coordinates
+    coords = []
+    try:
+        if "bbox" in flask.request.args:
+            x_min, y_min, x_max, y_max = map(int,
+                    flask.request.args.get("bbox").split(","))
+            if (x_max - x_min + 1) * (y_max - y_min + 1) > MAX_BATCH_TILES:
+                flask.abort(400)
+
+            coords = [(x, y) for y in xrange(y_min, y_max + 1)
+                    for x in xrange(x_min, x_max + 1)]
+        elif "tiles" in flask.request.args:
+            for pair in flask.request.args.get("tiles").split(";"):
+                x, y = pair.split(",")
+                coords.append((int(x), int(y)))
+    except ValueError:
+        flask.abort(400)
+
+    if len(coords) > MAX_BATCH_TILES:
+        flask.abort(400)
+
+    if not all(is_valid_tile(x, y, zoom) for x, y in coords):
+        flask.abort(400)
+
+    # start loading the tiles around this batch
+    if PREFETCHER is not None and len(coords) > 0:
+        xs = [x for x, y in coords]
+        ys = [y for x, y in coords]
+        PREFETCHER.request(tile_type, zoom,
+                (min(xs), min(ys), max(xs), max(ys)))
+
+    # serve what we can from the cache, then get the rest in one lookup
+    found_data = {}
+    uncached = []
+    for x, y in coords:
+        if COVERAGE is not None and COVERAGE.is_missing(v, x, y, zoom):
+            found_data[(x, y)] = None
+            continue
+
+        found, tile_data, etag = CACHE.get((v, x, y, zoom))
+        if found:
+            found_data[(x, y)] = tile_data
+        else:
+            uncached.append(Tile.from_google(x, y, zoom))
+
+    if len(uncached) > 0:
+        for tile, (tile_data, etag) in zip(uncached,
+                fetch_tiles(tile_type, uncached)):
+            found_data[(tile.x, tile.y)] = tile_data
+
+    # fill in whatever's still missing from the tiles' ancestors
+    if FALLBACK:
+        for x, y in coords:
+            if found_data[(x, y)] is None:
+                found_data[(x, y)] = get_fallback_tile(tile_type,
+                        Tile.from_google(x, y, zoom))[0]
+
+    frames = []
+    for x, y in coords:
+        tile_data = found_data[(x, y)]
+        if tile_data is None:
+            frames.append(struct.pack(">IIi", x, y, -1))
+        else:
+            frames.append(struct.pack(">IIi", x, y, len(tile_data)))
+            frames.append(tile_data)
+
+    return flask.Response(response="".join(frames),
+            content_type="application/octet-stream")
+
+@app.route("/<v>/coverage", methods=("GET",))
+def get_coverage(v):
+    """
+    Returns the tiles the store holds for one tile type and zoom level as JSON
+    spans of horizontally adjacent tiles, optionally limited to an inclusive
+    'bbox=x_min,y_min,x_max,y_max'. 'complete' is False while the index is
+    still being built, in which case tiles missing from the spans may exist.
+    """
+
+    # clients use coverage to skip requesting missing tiles, which we fill in
+    # when falling back.
+    if COVERAGE is None or FALLBACK:
+        flask.abort(404)
+
+    zoom = int(flask.request.args.get("zoom"))
+
+    bbox = None
+    if "bbox" in flask.request.args:
+        try:
+            bbox = map(int, flask.request.args.get("bbox").split(","))
+        except ValueError:
+            flask.abort(400)
+        if len(bbox) != 4:
+            flask.abort(400)
+
+    complete = COVERAGE.is_complete(v, zoom)
+    coverage = {
+        "zoom": zoom,
+        "complete": complete,
+        "spans": COVERAGE.get_spans(v, zoom, bbox),
+    }
+
+    return flask.Response(response=json.dumps(coverage),
+            content_type="application/json")
+
+def fetch_tiles(tile_type, tiles):
+    """
+    Looks up tiles in the store with a single batched lookup, caching whatever
+    was found or not found. Returns a list of (tile_data, etag) pairs in the
+    same order as the tiles.
+    """
+
+    results = []
+    for tile, (tile_data, etag) in zip(tiles,
+            STORE.get_many_with_versions(tile_type, tiles)):
+        # fall back to the data's hash if the tile changed between lookups
+        if tile_data is None:
+            etag = None
+        elif etag is None:
+            etag = mapper.hash_tile_data(tile_data)
+
+        CACHE.put((tile_type.v, tile.x, tile.y, tile.zoom), tile_data, etag)
+        results.append((tile_data, etag))
+
+    return results
+
+def get_fallback_tile(tile_type, tile):
+    """
+    Makes a stand-in for a missing tile from the part of its nearest stored
+    ancestor that covers it, scaled up to the ancestor's size. Returns a
+    (tile_data, etag) pair, or (None, None) if we aren't falling back or no
+    ancestor was found. Results are cached, so each is only made once.
+    """
+
+    if not FALLBACK:
+        return None, None
+
+    # kept apart from the tile's own entry, which says it's missing
+    key = (tile_type.v, tile.x, tile.y, tile.zoom, "fallback")
+    found, tile_data, etag = CACHE.get(key)
+    if found:
+        return tile_data, etag
+
+    for levels in xrange(1, min(tile.zoom, MAX_FALLBACK_LEVELS) + 1):
+        x = tile.x >> levels
+        y = tile.y >> levels
+        zoom = tile.zoom - levels
+
+        if (COVERAGE is not None and
+                COVERAGE.is_missing(tile_type.v, x, y, zoom)):
+            continue
+
+        found, ancestor_data, ancestor_etag = CACHE.get(
+                (tile_type.v, x, y, zoom))
+        if not found:
+            ancestor_data, ancestor_etag = fetch_tiles(tile_type,
+                    [Tile.from_google(x, y, zoom)])[0]
+
+        if ancestor_data is None:
+            continue
+
+        # skip ancestors whose data isn't an image we can read
+        try:
+            tile_data = crop_tile_data(ancestor_data, tile.x - (x << levels),
+                    tile.y - (y << levels), levels)
+        except IOError, e:
+            app.logger.warning("Failed to crop tile at zoom " + str(zoom) +
+                    ": " + str(e))
+            continue
+
+        etag = mapper.hash_tile_data(tile_data)
+        CACHE.put(key, tile_data, etag)
+        return tile_data, etag
+
+    CACHE.put(key, None)
+    return None, None
+
+def crop_tile_data(tile_data, x, y, levels):
+    """
+    Returns image data, in the same format as the given tile's, of the part of
+    the tile covering its descendant the given number of zoom levels down, at
+    offset (x, y) in tiles from the tile's top left descendant. The part is
+    scaled up to the tile's size.
+    """
+
+    image = Image.open(StringIO(tile_data))
+    image_format = image.format
+
+    # palette images can only be scaled pixel by pixel
+    if image.mode == "P":
+        image = image.convert("RGBA")
+
+    width, height = image.size
+    box = ((x * width) >> levels, (y * height) >> levels,
+            ((x + 1) * width) >> levels, ((y + 1) * height) >> levels)
+    image = image.crop(box).resize((width, height), Image.BILINEAR)
+
+    data = StringIO()
+    image.save(data, image_format)
+    return data.getvalue()
+
+def get_not_modified_response(etag):
+    """
+    Returns an empty 304 response telling the client its copy of a tile with
+    the given ETag is current.
+    """
+
+    response = flask.Response(status=304)
+    set_cache_headers(response, etag)
+    return response
+
+def set_cache_headers(response, etag):
+    """
+    Sets the headers that let clients cache a tile and check whether their copy
+    is current.
+    """
+
+    if etag is not None:
+        response.set_etag(etag)
+
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    A WSGI server that handles requests on a fixed pool of worker threads. The
+    number of workers bounds how many requests are served at once, and so how
+    many connections to the tile store are needed; connections beyond that wait
+    in a short queue until a worker is free.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, num_workers):
+        BaseWSGIServer.__init__(self, host, port, app)
+
+        self.request_queue = queue.Queue(num_workers * 4)
+
+        for i in xrange(num_workers):
+            thread = threading.Thread(target=self.process_queued_requests)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        """
+        Queues an accepted connection for the next free worker.
+        """
+
+        self.request_queue.put((request, client_address))
+
+    def process_queued_requests(self):
+        """
+        Forever handles queued connections. Run by each worker thread.
+        """
+
+        while 1:
+            request, client_address = self.request_queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
 
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=9000, debug=True)
+    import argparse
+    import logging
+    import os
+    import sys
+
+    parser = argparse.ArgumentParser(
+            description="Serve map tiles from a tile store over HTTP.")
+
+    parser.add_argument("--host", default="127.0.0.1",
+            help="address to listen on (default 127.0.0.1)")
+    parser.add_argument("-p", "--port", type=int, default=9000,
+            help="port to listen on (default 9000)")
+
+    parser.add_argument("-s", "--tile-store",
+            default="mongo://127.0.0.1:27017/mapper/tiles",
+            help="store to serve tiles from, as 'file:DIRECTORY' or " +
+            "'mongo://HOST:PORT/DB/COLLECTION' (default " +
+            "mongo://127.0.0.1:27017/mapper/tiles)")
+
+    parser.add_argument("-w", "--workers", type=int, default=16,
+            help="number of requests served at once, each on its own " +
+            "thread. raise this until the store or CPU is saturated; mongo " +
+            "stores keep up to this many connections open (default 16)")
+
+    parser.add_argument("-c", "--cache-bytes", type=int, default=CACHE_BYTES,
+            help="bytes of tile data cached in memory (default " +
+            str(CACHE_BYTES) + ")")
+    parser.add_argument("--negative-ttl", type=float, default=NEGATIVE_TTL,
+            help="seconds to remember a tile is missing (default " +
+            str(NEGATIVE_TTL) + ")")
+    parser.add_argument("--max-age", type=int, default=CACHE_MAX_AGE,
+            help="seconds browsers may cache tiles for (default " +
+            str(CACHE_MAX_AGE) + ")")
+    parser.add_argument("--invalidate-interval", type=float, default=None,
+            help="if given, check the store for updated tiles this often " +
+            "in seconds and drop them from the cache")
+
+    parser.add_argument("--coverage", action="store_true", default=False,
+            help="index which tiles the store holds at startup, so requests " +
+            "for missing tiles are answered without going to the store " +
+            "(requires --invalidate-interval, to add new tiles to the index)")
+
+    parser.add_argument("--fallback", action="store_true", default=False,
+            help="serve missing tiles as a crop of their nearest stored " +
+            "ancestor, scaled up (requires PIL)")
+
+    parser.add_argument("--prefetch-workers", type=int, default=0,
+            help="number of threads loading the tiles likely to be " +
+            "requested next into the cache, or 0 to not prefetch (default 0)")
+
+    parser.add_argument("--access-log", type=os.path.abspath, default=None,
+            help="append a line for each request to this file, for use " +
+            "with --warm-log")
+    parser.add_argument("--warm-log", type=os.path.abspath, default=None,
+            help="at startup, load the tiles most requested in this access " +
+            "log into the cache")
+    parser.add_argument("--warm-top", type=int, default=None,
+            help="only load this many of the most requested tiles from " +
+            "--warm-log (default as many as fit in the cache)")
+    parser.add_argument("--warm-bbox", nargs=6, default=None,
+            metavar=("V", "ZOOM", "X_MIN", "Y_MIN", "X_MAX", "Y_MAX"),
+            help="at startup, load the tiles of type V in this inclusive " +
+            "range into the cache")
+
+    parser.add_argument("--debug", action="store_true", default=False,
+            help="run Flask's single-threaded development server instead, " +
+            "with debugging enabled")
+
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("argument -w/--workers: invalid worker count: " +
+                repr(args.workers) + " (must be >= 1)")
+
+    # mongo stores get a connection per worker, so workers never wait on one
+    store_args = {}
+    if args.tile_store.startswith("mongo://"):
+        store_args["pool_size"] = args.workers
+
+    try:
+        tile_store = mapper.tile_store_from_spec(args.tile_store, **store_args)
+    except ValueError, e:
+        parser.error(str(e))
+
+    if args.fallback and Image is None:
+        parser.error("argument --fallback: requires PIL, which isn't installed")
+
+    if args.coverage and args.invalidate_interval is None:
+        parser.error("argument --coverage: requires --invalidate-interval, " +
+                "so tiles stored while serving are added to the index")
+
+    configure(tile_store, cache_bytes=args.cache_bytes,
+            negative_ttl=args.negative_ttl, cache_max_age=args.max_age,
+            invalidate_interval=args.invalidate_interval,
+            coverage=args.coverage, prefetch_workers=args.prefetch_workers,
+            fallback=args.fallback)
+
+    if args.access_log is not None:
+        handler = logging.FileHandler(args.access_log)
+        logging.getLogger("werkzeug").addHandler(handler)
+
+    # warm the cache before we start taking requests
+    if args.warm_log is not None:
+        tiles = parse_access_log(args.warm_log, args.warm_top)
+        print ("Warmed cache with " +
+                str(warm_cache(tiles, args.cache_bytes)) + " tiles from " +
+                args.warm_log)
+
+    if args.warm_bbox is not None:
+        try:
+            tile_type = Tile.get_type(args.warm_bbox[0])
+            zoom, x_min, y_min, x_max, y_max = map(int, args.warm_bbox[1:])
+        except ValueError, e:
+            parser.error("argument --warm-bbox: " + str(e))
+
+        tiles = ((tile_type, Tile.from_google(x, y, zoom))
+                for y in xrange(y_min, y_max + 1)
+                for x in xrange(x_min, x_max + 1))
+        print ("Warmed cache with " +
+                str(warm_cache(tiles, args.cache_bytes)) + " tiles from " +
+                "the bbox")
+
+    if args.debug:
+        app.run(host=args.host, port=args.port, debug=True)
+    else:
+        server = PooledWSGIServer(args.host, args.port, app, args.workers)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            sys.exit(10)
@@ -130,31 +130,9 @@ var setupOfflineMapType = function (map) {
     // add the coord map type to the map as an overlay
     map.overlayMapTypes.insertAt(0, new CoordMapType());
 
-    var offlineMapType = new google.maps.ImageMapType({
-        tileSize: new google.maps.Size(256, 256),
-
-        name: "Map (Offline)",
-        alt: "Offline Road Map",
-
-        maxZoom: 21,
-        minZoom: 0,
-
-        // returns a URL to our local server that returns the map from a cache
-        getTileUrl: function (coord, zoom) {
-            var mapType = "m";
-            var x = coord.x;
-            var y = coord.y;
-
-            // build our map request URL
-            var url = "http://127.0.0.1:9000/";
-            url += mapType;
-            url += "?x=" + x;
-            url += "&y=" + y;
-            url += "&zoom=" + zoom;
-
-            return url;
-        },
-    });
+    var offlineMapType = new BatchedTileMapType("http://127.0.0.1:9000/", "m");
+    offlineMapType.name = "Map (Offline)";
+    offlineMapType.alt = "Offline Road Map";
 
     var mapTypeId = "offline_roadmap";
 
@@ -199,3 +177,232 @@ var setupViewPersistence = function (map) {
         storeLastView();
     });
 };
+
+// a map type that loads its tiles from our local server. rather than asking
+// for each tile separately, the tiles the map asks for at once are gathered
+// and fetched with a single batch request, which matters far more than the
+// number of bytes on high-latency links.
+var BatchedTileMapType = function (serverUrl, mapType) {
+    this.serverUrl = serverUrl;
+    this.mapType = mapType;
+
+    // tiles waiting to be requested, grouped by zoom level
+    this.__pending = {};
+    this.__flushScheduled = false;
+
+    // regions of each zoom level whose coverage we've fetched from the server,
+    // and whether the server keeps coverage at all (we find out on first use)
+    this.__coverage = {};
+    this.__coverageAvailable = true;
+};
+
+BatchedTileMapType.prototype.tileSize = new google.maps.Size(256, 256);
+BatchedTileMapType.prototype.maxZoom = 21;
+BatchedTileMapType.prototype.minZoom = 0;
+
+// the most tiles the server accepts in a single batch request
+BatchedTileMapType.prototype.maxBatchTiles = 256;
+
+// return an empty image for the tile, and queue it to be filled in
+BatchedTileMapType.prototype.getTile = function (coord, zoom, ownerDocument) {
+    var img = ownerDocument.createElement("img");
+    img.style.width = "256px";
+    img.style.height = "256px";
+    img.style.visibility = "hidden";
+
+    // the map repeats around the world horizontally, and has nothing above or
+    // below it, so only ask for tiles that really exist
+    var numTiles = Math.pow(2, zoom);
+    if (coord.y < 0 || coord.y >= numTiles) {
+        return img;
+    }
+    var x = ((coord.x % numTiles) + numTiles) % numTiles;
+
+    if (!this.__pending.hasOwnProperty(zoom)) {
+        this.__pending[zoom] = [];
+    }
+    this.__pending[zoom].push({ x: x, y: coord.y, img: img });
+
+    // request every tile asked for during this turn of the event loop at once
+    if (!this.__flushScheduled) {
+        this.__flushScheduled = true;
+
+        var self = this;
+        setTimeout(function () { self.__flush(); }, 0);
+    }
+
+    return img;
+};
+
+// free the image data held by tiles that scrolled out of view
+BatchedTileMapType.prototype.releaseTile = function (img) {
+    if (img.src.indexOf("blob:") === 0) {
+        URL.revokeObjectURL(img.src);
+    }
+};
+
+// how many tiles around the requested ones we ask for coverage of, so panning
+// doesn't need a new coverage request every time
+BatchedTileMapType.prototype.coveragePadding = 16;
+
+// send a batch request for each zoom level's pending tiles
+BatchedTileMapType.prototype.__flush = function () {
+    var pending = this.__pending;
+    this.__pending = {};
+    this.__flushScheduled = false;
+
+    var self = this;
+    $.each(pending, function (zoom, tiles) {
+        self.__withCoverage(zoom, tiles, function (coveredTiles) {
+            for (var i = 0; i < coveredTiles.length; i += self.maxBatchTiles) {
+                self.__requestBatch(zoom,
+                        coveredTiles.slice(i, i + self.maxBatchTiles));
+            }
+        });
+    });
+};
+
+// call back with only those tiles the server has, fetching the coverage of
+// the area around them first if we don't have it. if the server doesn't keep
+// coverage, all the tiles are passed along.
+BatchedTileMapType.prototype.__withCoverage = function (zoom, tiles, callback) {
+    if (!this.__coverageAvailable) {
+        callback(tiles);
+        return;
+    }
+
+    // find the bounds of the tiles
+    var bbox = [tiles[0].x, tiles[0].y, tiles[0].x, tiles[0].y];
+    $.each(tiles, function (i, tile) {
+        bbox = [Math.min(bbox[0], tile.x), Math.min(bbox[1], tile.y),
+                Math.max(bbox[2], tile.x), Math.max(bbox[3], tile.y)];
+    });
+
+    // filters the tiles using a region that contains them all
+    var filter = function (region) {
+        callback($.grep(tiles, function (tile) {
+            var spans = region.rows[tile.y] || [];
+            for (var i = 0; i < spans.length; i++) {
+                if (spans[i][0] <= tile.x && tile.x <= spans[i][1]) {
+                    return true;
+                }
+            }
+            return false;
+        }));
+    };
+
+    // use a region we already have if one contains all the tiles
+    var regions = this.__coverage[zoom] || [];
+    for (var i = 0; i < regions.length; i++) {
+        var b = regions[i].bbox;
+        if (b[0] <= bbox[0] && b[1] <= bbox[1] &&
+                bbox[2] <= b[2] && bbox[3] <= b[3]) {
+            filter(regions[i]);
+            return;
+        }
+    }
+
+    // otherwise, fetch the coverage of a padded area around the tiles
+    var padding = this.coveragePadding;
+    var regionBbox = [Math.max(0, bbox[0] - padding),
+            Math.max(0, bbox[1] - padding),
+            bbox[2] + padding, bbox[3] + padding];
+
+    var url = this.serverUrl + this.mapType + "/coverage";
+    url += "?zoom=" + zoom;
+    url += "&bbox=" + regionBbox.join(",");
+
+    var self = this;
+    $.ajax({
+        url: url,
+        dataType: "json",
+        success: function (coverage) {
+            var region = { bbox: regionBbox, rows: {} };
+            $.each(coverage.spans, function (i, span) {
+                if (!region.rows.hasOwnProperty(span[0])) {
+                    region.rows[span[0]] = [];
+                }
+                region.rows[span[0]].push([span[1], span[2]]);
+            });
+
+            // incomplete coverage can't tell us a tile is missing, so only
+            // remember coverage we can trust
+            if (!coverage.complete) {
+                callback(tiles);
+                return;
+            }
+
+            if (!self.__coverage.hasOwnProperty(zoom)) {
+                self.__coverage[zoom] = [];
+            }
+            self.__coverage[zoom].push(region);
+
+            filter(region);
+        },
+        error: function () {
+            // the server doesn't keep coverage, so stop asking for it
+            self.__coverageAvailable = false;
+            callback(tiles);
+        },
+    });
+};
+
+// fetch a batch of tiles and fill in their images
+BatchedTileMapType.prototype.__requestBatch = function (zoom, tiles) {
+    // find our images by their coordinates. the same tile may be shown more
+    // than once when the world wraps, but it's only requested once.
+    var imgs = {};
+    var coords = [];
+    $.each(tiles, function (i, tile) {
+        var key = tile.x + "," + tile.y;
+        if (!imgs.hasOwnProperty(key)) {
+            imgs[key] = [];
+            coords.push(key);
+        }
+        imgs[key].push(tile.img);
+    });
+
+    var url = this.serverUrl + this.mapType + "/batch";
+    url += "?zoom=" + zoom;
+    url += "&tiles=" + coords.join(";");
+
+    // jQuery can't hand us binary data, so we use the request directly
+    var request = new XMLHttpRequest();
+    request.open("GET", url, true);
+    request.responseType = "arraybuffer";
+    request.onload = function () {
+        if (request.status !== 200) {
+            return;
+        }
+
+        // each frame is an (x, y, length) header followed by the tile's data
+        var data = new DataView(request.response);
+        var offset = 0;
+        while (offset + 12 <= data.byteLength) {
+            var x = data.getUint32(offset);
+            var y = data.getUint32(offset + 4);
+            var length = data.getInt32(offset + 8);
+            offset += 12;
+
+            // leave missing tiles hidden
+            if (length < 0) {
+                continue;
+            }
+
+            var tileImgs = imgs[x + "," + y] || [];
+            if (tileImgs.length > 0) {
+                var blob = new Blob(
+                        [request.response.slice(offset, offset + length)],
+                        { type: "image/png" });
+                $.each(tileImgs, function (i, img) {
+                    img.src = URL.createObjectURL(blob);
+                    img.style.visibility = "visible";
+                });
+            }
+
+            offset += length;
+        }
+    };
+
+    request.send();
+};
@@ -3,6 +3,12 @@
 import mapper
 from mapper import Polygon, Tile, NullTileStore, FileTileStore, MongoTileStore
 from pprint import pprint
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
 
 tile_m = Tile.from_mercator(30.2832, -97.7362, 18)
 tile_g = Tile.from_google(59902, 107915, 18)
@@ -89,6 +95,573 @@ uniform_tiles = [
     Tile.from_google(119822, 215827, 19) # cemetary, university, others?
 ]
 
+# identical tiles should share a single blob when deduplicating
+print "dedup:"
+dedup_dir = tempfile.mkdtemp()
+try:
+    dedup_store = FileTileStore(dedup_dir, dedup=True)
+    water_a, water_b = uniform_tiles[0], Tile.from_google(61, 108, 8)
+    dedup_store.store(Tile.TYPE_MAP, water_a, "water")
+    dedup_store.store(Tile.TYPE_MAP, water_b, "water")
+    dedup_store.store(Tile.TYPE_MAP, water_b, "water")
+
+    blob_path = dedup_store.get_blob_path(mapper.hash_tile_data("water"))
+    assert os.stat(blob_path).st_nlink == 3
+
+    # storing the same data again leaves the existing link alone
+    water_b_path = dedup_store.get_tile_path(Tile.TYPE_MAP, water_b)
+    inode = os.stat(water_b_path).st_ino
+    dedup_store.store(Tile.TYPE_MAP, water_b, "water")
+    assert os.stat(water_b_path).st_ino == inode
+    assert str(os.getpid()) in FileTileStore.get_temp_path(water_b_path)
+    assert not [n for n in os.listdir(dedup_dir) if "." in n]
+
+    # the blob only goes away once its last tile does
+    assert dedup_store.delete(Tile.TYPE_MAP, water_a)
+    assert os.path.exists(blob_path)
+    dedup_store.store(Tile.TYPE_MAP, water_b, "land")
+    assert not os.path.exists(blob_path)
+    assert not dedup_store.delete(Tile.TYPE_MAP, water_a)
+    print "ok"
+finally:
+    shutil.rmtree(dedup_dir)
+print
+
+# a failed batch is retried tile by tile, and close() reports what's left
+print "store writer:"
+class FlakyStore(mapper.TileStore):
+    def __init__(self):
+        self.stored = []
+    def store_many(self, tile_type, tiles_and_data):
+        raise IOError("batch rejected")
+    def store(self, tile_type, tile, tile_data):
+        if tile_data == "bad":
+            raise IOError("tile rejected")
+        self.stored.append(tile)
+flaky_store = FlakyStore()
+writer = mapper.StoreWriter(1, batch_size=10)
+writer_tiles = [Tile.from_google(x, 0, 5) for x in xrange(5)]
+for tile in writer_tiles:
+    writer.put(flaky_store, Tile.TYPE_MAP, tile,
+            "bad" if tile.x == 2 else "png")
+failed = writer.close()
+assert flaky_store.stored == [t for t in writer_tiles if t.x != 2]
+assert failed == [(flaky_store, Tile.TYPE_MAP, writer_tiles[2])]
+assert writer.metrics.get_counter("mapper_store_errors_total") == 1
+print "ok"
+print
+
+# reading tiles back out of a store, singly and by range
+print "read:"
+read_dir = tempfile.mkdtemp()
+try:
+    read_store = FileTileStore(read_dir)
+    for x, y in ut_area:
+        read_store.store(Tile.TYPE_MAP, Tile.from_google(x, y, 18), str((x, y)))
+
+    assert read_store.get(Tile.TYPE_MAP, ut_tiles[0]) == str((59902, 107915))
+    assert read_store.get(Tile.TYPE_SATELLITE, ut_tiles[0]) is None
+    assert read_store.contains_many(Tile.TYPE_MAP,
+            [ut_tiles[0], uniform_tiles[0]]) == [True, False]
+
+    # scans come back ordered by y then x, whether probed or listed
+    bbox = (59903, 107916, 59904, 107917)
+    expected = [Tile.from_google(x, y, 18)
+            for y in xrange(107916, 107918) for x in xrange(59903, 59905)]
+    assert [t for t, d in read_store.scan(Tile.TYPE_MAP, 18, bbox)] == expected
+    max_probed_area = FileTileStore.MAX_PROBED_AREA
+    FileTileStore.MAX_PROBED_AREA = 0
+    assert [t for t, d in read_store.scan(Tile.TYPE_MAP, 18, bbox)] == expected
+
+    # listings bigger than a run are spilled to disk and merged back in order
+    scan_run_size = FileTileStore.SCAN_RUN_SIZE
+    FileTileStore.SCAN_RUN_SIZE = 3
+    assert [t for t, d in read_store.scan(Tile.TYPE_MAP, 18, bbox)] == expected
+    assert list(read_store.scan_tiles(Tile.TYPE_MAP, 18)) == sorted(
+            ut_tiles, key=lambda t: (t.y, t.x))
+    FileTileStore.SCAN_RUN_SIZE = scan_run_size
+    FileTileStore.MAX_PROBED_AREA = max_probed_area
+    assert read_store.get_layers() == [(Tile.TYPE_MAP, 18)]
+
+    # big layers are copied in shards of rows, which resume independently
+    class CopyingStore(mapper.TileStore):
+        def __init__(self):
+            self.stored = []
+        def store_many(self, tile_type, tiles_and_data):
+            self.stored.extend(tile for tile, tile_data in tiles_and_data)
+    assert mapper.get_migration_shards(read_store, Tile.TYPE_MAP, 18, 10) == \
+            [(0, 107915), (107916, 107917), (107918, 2 ** 18 - 1)]
+    assert mapper.get_migration_shards(read_store, Tile.TYPE_MAP, 18, 100) == \
+            [(None, None)]
+    progress_path = os.path.join(read_dir, "progress.json")
+    copy_store = CopyingStore()
+    mapper.migrate_tiles(read_store, copy_store, num_threads=3, batch_size=4,
+            progress_file=progress_path, shard_size=10)
+    assert sorted((t.y, t.x) for t in copy_store.stored) == \
+            sorted((t.y, t.x) for t in ut_tiles)
+    mapper.migrate_tiles(read_store, copy_store, num_threads=3,
+            progress_file=progress_path, shard_size=1)
+    assert len(copy_store.stored) == len(ut_tiles)
+
+    # a failure in a copying thread comes back out of the migration
+    try:
+        mapper.migrate_tiles(read_store, FlakyStore(), num_threads=2)
+        assert False, "migration should have failed"
+    except IOError:
+        pass
+    assert len(list(read_store.scan(Tile.TYPE_MAP, 18,
+            after=(107919, 59904)))) == 2
+    print "ok"
+finally:
+    shutil.rmtree(read_dir)
+print
+
+# damaged tile data should be caught, and tile lists should round-trip
+print "verify:"
+def png_chunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+png = (mapper.PNG_SIGNATURE +
+        png_chunk("IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0)) +
+        png_chunk("IDAT", zlib.compress("\x00\x00")) +
+        png_chunk("IEND", ""))
+assert mapper.get_tile_data_problem(png) is None
+assert mapper.get_tile_data_problem(png[:-20]) == "truncated IDAT"
+assert mapper.get_tile_data_problem("") == "empty"
+assert mapper.get_tile_data_problem("GIF89a") == "bad signature"
+
+list_dir = tempfile.mkdtemp()
+try:
+    list_file = os.path.join(list_dir, "replay.txt")
+    listed = [(Tile.TYPE_MAP, t) for t in reversed(ut_tiles)]
+    mapper.write_tile_list(list_file, listed)
+    assert len(open(list_file).readlines()) == 6
+    assert list(mapper.parse_tile_list(list_file)) == [
+            (Tile.TYPE_MAP, t) for t in ut_tiles]
+    print "ok"
+finally:
+    shutil.rmtree(list_dir)
+print
+
+# coverage should merge spans regardless of the order tiles are added in
+print "coverage:"
+coverage = mapper.Coverage(18)
+for x, y in [(5, 1), (1, 1), (3, 1), (2, 1), (9, 1), (4, 1), (7, 2)]:
+    coverage.add(x, y)
+assert list(coverage.generate_spans()) == [(1, 1, 5), (1, 9, 9), (2, 7, 7)]
+assert coverage.contains(3, 1) and not coverage.contains(6, 1)
+assert not coverage.contains(3, 2)
+assert coverage.count() == 7
+assert list(coverage.generate_spans((4, 0, 8, 1))) == [(1, 4, 5)]
+assert mapper.Coverage.from_tiles(18, coverage.generate_tiles()) == coverage
+print "ok"
+print
+
+# overlapping and bordering polygons are covered once, minus their holes
+print "union:"
+coverage = mapper.Coverage(18)
+coverage.add_span(1, 0, 9)
+coverage.remove_span(1, 3, 5)
+coverage.remove_span(1, 9, 12)
+assert list(coverage.generate_spans()) == [(1, 0, 2), (1, 6, 8)]
+coverage.remove_span(1, 0, 8)
+assert coverage.count() == 0 and coverage.rows == {}
+left = [(0, 0), (6, 0), (6, 6), (0, 6)]
+right = [(4, 2), (10, 2), (10, 8), (4, 8)]
+hole = [(2, 2), (4, 2), (4, 4), (2, 4)]
+spans = list(mapper.generate_union_spans([[left], [right]]))
+tiles = set(Polygon.get_area(left)) | set(Polygon.get_area(right))
+assert [(x, y) for y, x0, x1 in spans for x in xrange(x0, x1 + 1)] == \
+        sorted(tiles, key=lambda (x, y): (y, x))
+spans = list(mapper.generate_union_spans([[left, hole]]))
+assert (3, 3) not in [(x, y) for y, x0, x1 in spans for x in xrange(x0, x1 + 1)]
+assert [span for span in spans if span[0] == 3] == [(3, 0, 2), (3, 4, 6)]
+spans = list(mapper.generate_union_spans([[left, hole], [hole]]))
+assert [span for span in spans if span[0] == 3] == [(3, 0, 6)]
+print "ok"
+print
+
+# revising an area only adds the tiles it didn't already have
+print "difference:"
+coverage = mapper.Coverage(18)
+coverage.add_span(1, 2, 3)
+coverage.add_span(1, 6, 7)
+assert list(coverage.generate_uncovered_spans(
+        [(1, 0, 9), (1, 3, 6), (2, 0, 1), (1, 4, 5)])) == \
+        [(1, 0, 1), (1, 4, 5), (1, 8, 9), (1, 4, 5), (2, 0, 1), (1, 4, 5)]
+small = [[[Tile.from_google(x, y, 10) for x, y in
+        [(100, 100), (110, 100), (110, 110), (100, 110)]]]]
+large = [[[Tile.from_google(x, y, 10) for x, y in
+        [(100, 100), (120, 100), (120, 110), (100, 110)]]]]
+small_tiles = set(mapper.generate_areas_tiles(small, [10, 11]))
+large_tiles = set(mapper.generate_areas_tiles(large, [10, 11]))
+added = list(mapper.generate_areas_difference_tiles(large, small, [10, 11]))
+assert len(added) == len(set(added)) and set(added) == large_tiles - small_tiles
+assert list(mapper.generate_areas_difference_tiles(small, large, [10])) == []
+print "ok"
+print
+
+# cached coverage reads back the same tiles, and evicts the oldest files
+print "coverage cache:"
+cache_dir = tempfile.mkdtemp()
+try:
+    cache = mapper.CoverageCache(cache_dir)
+    tiles = list(mapper.generate_areas_tiles(large, [10, 11]))
+    assert list(mapper.generate_areas_tiles(large, [10, 11],
+            coverage_cache=cache)) == tiles
+    assert len(os.listdir(cache_dir)) == 2
+    assert list(mapper.generate_areas_tiles(large, [10, 11],
+            coverage_cache=cache)) == tiles
+    key = mapper.CoverageCache.get_key(large, 11)
+    assert key != mapper.CoverageCache.get_key(small, 11)
+    assert key != mapper.CoverageCache.get_key(large, 11, 1.0)
+    with open(cache.get_path(key), "wb") as f:
+        f.write("mapper spans\n" + struct.pack("<qqq", 200, 201, 202))
+    assert list(mapper.generate_areas_tiles(large, [11],
+            coverage_cache=cache)) == [Tile.from_google(x, 200, 11)
+                for x in (201, 202)]
+    assert cache.load(mapper.CoverageCache.get_key(small, 11)) is None
+    os.utime(cache.get_path(mapper.CoverageCache.get_key(large, 10)), (0, 0))
+    cache.max_size = os.path.getsize(cache.get_path(key))
+    cache.evict()
+    assert os.listdir(cache_dir) == [os.path.basename(cache.get_path(key))]
+finally:
+    shutil.rmtree(cache_dir)
+print "ok"
+print
+
+# manifests hold a job's tiles in order, and can be searched and compared
+print "manifest:"
+manifest_dir = tempfile.mkdtemp()
+try:
+    manifest_path = os.path.join(manifest_dir, "large.manifest")
+    tiles = list(mapper.generate_areas_tiles(large, [10, 11]))
+    assert mapper.write_manifest(manifest_path, tiles) == len(tiles)
+    manifest = mapper.TileManifest(manifest_path)
+    assert len(manifest) == len(tiles)
+    assert list(manifest.generate_tiles()) == tiles
+    assert list(manifest.generate_tiles(5, 8)) == tiles[5:8]
+    assert manifest.index(tiles[7]) == 7 and manifest.contains(tiles[7])
+    assert not manifest.contains(Tile.from_google(0, 0, 10))
+    parts = [manifest.get_part(i, 3) for i in xrange(3)]
+    assert parts[0][0] == 0 and parts[-1][1] == len(tiles)
+    assert all(a[1] == b[0] for a, b in zip(parts, parts[1:]))
+
+    small_keys = [mapper.TileManifest.get_key(tile)
+            for tile in mapper.generate_areas_tiles(small, [10, 11])]
+    added = list(mapper.generate_areas_difference_tiles(large, small, [10, 11]))
+    assert [mapper.TileManifest.get_tile(key) for key in
+            mapper.generate_keys_difference(manifest.generate_keys(),
+                small_keys)] == added
+    assert list(mapper.generate_keys_intersection(manifest.generate_keys(),
+            small_keys)) == small_keys
+    manifest.close()
+
+    try:
+        mapper.write_manifest(manifest_path, reversed(tiles))
+        assert False, "unsorted tiles were written"
+    except ValueError:
+        pass
+finally:
+    shutil.rmtree(manifest_dir)
+print "ok"
+print
+
+# corridors cover exactly the points within their radius of a route
+print "corridor:"
+assert list(Polygon.generate_capsule_spans((0, 0), (4, 0), 1)) == \
+        [(-1, 0, 4), (0, -1, 5), (1, 0, 4)]
+a, b = (1, 2), (9, 7)
+def distance_to_segment(x, y):
+    t = ((x - a[0]) * (b[0] - a[0]) + (y - a[1]) * (b[1] - a[1])) / 89.0
+    t = max(0, min(1, t))
+    return ((x - a[0] - t * (b[0] - a[0])) ** 2 +
+            (y - a[1] - t * (b[1] - a[1])) ** 2) ** 0.5
+inside = [(x, y) for y in xrange(-5, 15) for x in xrange(-5, 15)
+        if distance_to_segment(x, y) <= 2.5]
+assert [(x, y) for y, x0, x1 in Polygon.generate_capsule_spans(a, b, 2.5)
+        for x in xrange(x0, x1 + 1)] == inside
+spans = list(mapper.generate_corridor_spans([(a, b, 0), ((9, 7), (9, 7), 1)]))
+assert [(x, y) for y, x0, x1 in spans for x in xrange(x0, x1 + 1)] == \
+        sorted(set(Polygon.generate_line(a, b)) |
+            set([(9, 6), (8, 7), (10, 7), (9, 8)]), key=lambda (x, y): (y, x))
+print "ok"
+print
+
+# spans, whole or in bands, and in other processes, cover the same points
+print "spans:"
+star = [(0, 5), (4, 4), (5, 0), (6, 4), (10, 5), (6, 6), (5, 10), (4, 6)]
+spans = list(Polygon.generate_spans(star))
+assert [(x, y) for y, x0, x1 in spans for x in xrange(x0, x1 + 1)] == \
+        Polygon.get_area(star)
+assert list(Polygon.generate_spans(star, 3, 4)) == \
+        [span for span in spans if 3 <= span[0] <= 4]
+assert list(mapper.generate_area_spans(star, 2)) == spans
+assert sorted(mapper.generate_area_spans(star, 2, ordered=False)) == spans
+
+# bands of a long, shallow polygon pick up each edge at the x it'd have had
+sliver = [(0, 0), (997, 301), (1000, 310), (3, 9)]
+sliver_spans = list(Polygon.generate_spans(sliver))
+assert [span for y in xrange(0, 311, 13)
+        for span in Polygon.generate_spans(sliver, y, y + 12)] == sliver_spans
+print "ok"
+print
+
+# simplifying drops vertices along straight edges, but never crosses edges
+print "simplify:"
+square = [(0, 0), (5, 0), (10, 0), (11, 5), (10, 10), (0, 10), (0, 10)]
+assert Polygon.simplify(square, 2) == [(0, 0), (10, 0), (10, 10), (0, 10)]
+assert Polygon.simplify(square, 0.5) == \
+        [(0, 0), (10, 0), (11, 5), (10, 10), (0, 10)]
+assert not Polygon.has_crossing_edges(star)
+assert Polygon.has_crossing_edges([(0, 0), (10, 10), (10, 0), (0, 10)])
+assert not Polygon.has_crossing_edges(Polygon.simplify(star, 3))
+print "ok"
+print
+
+# shape files are read the same from GeoJSON as from the area selector
+print "shape files:"
+temp_dir = tempfile.mkdtemp()
+try:
+    shape_path = os.path.join(temp_dir, "shape.txt")
+    with open(shape_path, "w") as f:
+        f.write("(30.29, -97.74)\n(30.29, -97.73)\n(30.28, -97.73)\n\n")
+    geojson_path = os.path.join(temp_dir, "shape.geojson")
+    with open(geojson_path, "w") as f:
+        f.write('{"type": "FeatureCollection", "features": [{"type": ' +
+                '"Feature", "geometry": {"type": "Polygon", "coordinates": ' +
+                '[[[-97.74, 30.29], [-97.73, 30.29], [-97.73, 30.28], ' +
+                '[-97.74, 30.29]]]}}]}')
+    assert list(mapper.generate_shape_coords(shape_path)) == \
+            [(30.29, -97.74), (30.29, -97.73), (30.28, -97.73)]
+    assert mapper.parse_shape_file(geojson_path) == \
+            mapper.parse_shape_file(shape_path)
+    assert mapper.parse_shape_polygons(geojson_path) == \
+            mapper.parse_shape_polygons(shape_path)
+    with open(geojson_path, "w") as f:
+        f.write('{"type": "LineString", "coordinates": [[-97.74, 30.29], ' +
+                '[-97.73, 30.29], [-97.73, 30.28]]}')
+    assert mapper.parse_shape_lines(geojson_path) == \
+            mapper.parse_shape_lines(shape_path)
+finally:
+    shutil.rmtree(temp_dir)
+print "ok"
+print
+
+# recrawling prefers old, heavily weighted, and popular tiles
+print "recrawl:"
+class UpdateDateStore(NullTileStore):
+    def __init__(self, update_dates):
+        self.update_dates = update_dates
+    def get_oldest(self, limit, before=None):
+        return [(Tile.TYPE_MAP, tile, date) for date, tile in
+                sorted((date, tile) for tile, date in self.update_dates)
+                if before is None or date < before][:limit]
+stale = [(Tile.from_google(1, 1, 5), 100), (Tile.from_google(2, 2, 10), 200),
+        (Tile.from_google(3, 3, 10), 300), (Tile.from_google(4, 4, 10), 950)]
+recrawler = mapper.Recrawler(UpdateDateStore(stale), 60, min_age=100)
+assert recrawler.choose(2, 1000) == [(Tile.TYPE_MAP, t) for t, d in stale[:2]]
+recrawler.zoom_weights = {10: 2.0}
+assert recrawler.choose(1, 1000) == [(Tile.TYPE_MAP, stale[1][0])]
+recrawler.access_counts = {(Tile.TYPE_MAP.v, 3, 3, 10): 10}
+assert recrawler.choose(1, 1000) == [(Tile.TYPE_MAP, stale[2][0])]
+assert len(recrawler.choose(10, 1000)) == 3
+
+# tiles still stale after they were downloaded again are passed over for a while
+recrawler.mark_attempted(recrawler.choose(1, 1000), 1000)
+assert recrawler.choose(1, 1000) == [(Tile.TYPE_MAP, stale[1][0])]
+assert len(recrawler.choose(10, 1000)) == 2
+retry_date = 1000 + recrawler.retry_delay
+assert recrawler.choose(1, retry_date) == [(Tile.TYPE_MAP, stale[2][0])]
+assert recrawler.attempts == {}
+log_dir = tempfile.mkdtemp()
+try:
+    log_path = os.path.join(log_dir, "access.log")
+    with open(log_path, "w") as f:
+        f.write('"GET /m?x=3&y=3&zoom=10 HTTP/1.1" 200\n' * 2 +
+                '"GET /m?x=1&y=1&zoom=5 HTTP/1.1" 200\n' +
+                '"GET /m?x=bad HTTP/1.1" 404\n')
+    assert mapper.count_tile_requests(log_path) == \
+            {("m", 3, 3, 10): 2, ("m", 1, 1, 5): 1}
+finally:
+    shutil.rmtree(log_dir)
+
+# re-storing a tile in mongo freshens it, so it's not recrawled again
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+    def get(self, doc, path):
+        for key in path.split("."):
+            doc = doc.get(key, {})
+        return doc
+    def matches(self, doc, query):
+        for path, value in query.iteritems():
+            if isinstance(value, dict) and "$lt" in value:
+                if not self.get(doc, path) < value["$lt"]:
+                    return False
+            elif self.get(doc, path) != value:
+                return False
+        return True
+    def update(self, query, update, upsert=False):
+        found = [d for d in self.docs if self.matches(d, query)]
+        if len(found) == 0 and upsert:
+            doc = {}
+            for path, value in query.iteritems():
+                keys = path.split(".")
+                target = doc
+                for key in keys[:-1]:
+                    target = target.setdefault(key, {})
+                target[keys[-1]] = value
+            self.docs.append(doc)
+            found = [doc]
+        for doc in found[:1]:
+            doc.update(update["$set"])
+    def find(self, query, fields=None):
+        docs = [dict(d) for d in self.docs if self.matches(d, query)]
+        class Cursor(list):
+            def sort(self, key, direction):
+                list.sort(self, key=lambda d: d[key], reverse=direction < 0)
+            def limit(self, count):
+                del self[count:]
+        return Cursor(docs)
+class FakeMongoStore(MongoTileStore):
+    def __init__(self):
+        self.dedup = False
+        self.collection = FakeCollection()
+mongo_store = FakeMongoStore()
+fresh_tile, old_tile = Tile.from_google(1, 2, 3), Tile.from_google(4, 5, 6)
+mongo_store.store(Tile.TYPE_MAP, fresh_tile, "old data")
+mongo_store.store(Tile.TYPE_MAP, old_tile, "old data")
+for doc in mongo_store.collection.docs:
+    doc["update_date"] = 100
+now = int(time.time())
+assert len(list(mongo_store.get_oldest(10, now))) == 2
+mongo_store.store(Tile.TYPE_MAP, fresh_tile, "new data")
+assert len(mongo_store.collection.docs) == 2
+assert mongo_store.collection.docs[0]["update_date"] >= now
+assert str(mongo_store.collection.docs[0]["image_data"]) == "new data"
+assert [t for tile_type, t, d in mongo_store.get_oldest(10, now)] == [old_tile]
+
+# file stores date their tiles by modification time
+oldest_dir = tempfile.mkdtemp()
+try:
+    oldest_store = FileTileStore(oldest_dir)
+    for tile, date in stale:
+        oldest_store.store(Tile.TYPE_MAP, tile, "png")
+        os.utime(oldest_store.get_tile_path(Tile.TYPE_MAP, tile), (date, date))
+    assert [(t, d) for tile_type, t, d in oldest_store.get_oldest(2)] == \
+            stale[:2]
+    assert len(list(oldest_store.get_oldest(10, 250))) == 2
+    assert [(t, d) for tile_type, t, d in oldest_store.get_updated(250)] == \
+            sorted(stale, key=lambda (tile, date): date)[2:]
+    recrawler = mapper.Recrawler(oldest_store, 60, min_age=100)
+    assert recrawler.choose(1, 1000) == [(Tile.TYPE_MAP, stale[0][0])]
+finally:
+    shutil.rmtree(oldest_dir)
+
+# dedup tiles are dated when they're stored, even when their data is unchanged
+# or already held for another tile
+oldest_dir = tempfile.mkdtemp()
+try:
+    oldest_store = FileTileStore(oldest_dir, dedup=True)
+    old_tile, new_tile = stale[0][0], stale[1][0]
+    oldest_store.store(Tile.TYPE_MAP, old_tile, "png")
+    os.utime(oldest_store.get_tile_path(Tile.TYPE_MAP, old_tile), (100, 100))
+    assert len(list(oldest_store.get_oldest(10, 1000))) == 1
+    oldest_store.store(Tile.TYPE_MAP, old_tile, "png")
+    assert list(oldest_store.get_oldest(10, 1000)) == []
+    os.utime(oldest_store.get_tile_path(Tile.TYPE_MAP, old_tile), (100, 100))
+    oldest_store.store(Tile.TYPE_MAP, new_tile, "png")
+    assert list(oldest_store.get_oldest(10, 1000)) == []
+finally:
+    shutil.rmtree(oldest_dir)
+print "ok"
+print
+
+# jobs share one pool of threads, and each finishes with its own progress
+print "jobs:"
+class RecordingStore(mapper.TileStore):
+    def __init__(self):
+        self.stored = []
+    def store(self, tile_type, tile, tile_data):
+        self.stored.append((tile_type, tile, tile_data))
+def generate_fake_tiles(zoom, count, fail=False):
+    for x in xrange(count):
+        tile = Tile.from_google(x, 0, zoom)
+        tile.download = lambda *args: "png"
+        yield tile
+    if fail:
+        raise ValueError("bad shape")
+job_store = RecordingStore()
+runner = mapper.JobRunner(num_threads=3, num_writers=1, policy="priority")
+jobs = [mapper.DownloadJob("a", Tile.TYPE_MAP, generate_fake_tiles(5, 20),
+            job_store),
+        mapper.DownloadJob("b", Tile.TYPE_SATELLITE,
+            generate_fake_tiles(6, 10, True), job_store, weight=3, priority=1),
+        mapper.DownloadJob("c", Tile.TYPE_MAP, [], job_store)]
+for job in jobs:
+    runner.submit(job)
+runner.close()
+assert sorted((t.v, tile.zoom, tile.x) for t, tile, data in job_store.stored) \
+        == sorted([(Tile.TYPE_MAP.v, 5, x) for x in xrange(20)] +
+            [(Tile.TYPE_SATELLITE.v, 6, x) for x in xrange(10)])
+progress = dict((p["name"], p) for p in runner.get_progress())
+assert progress["a"]["downloaded"] == 20 and progress["a"]["error"] is None
+assert progress["b"]["downloaded"] == 10 and progress["b"]["error"] is not None
+assert progress["c"]["done"] and progress["c"]["downloaded"] == 0
+try:
+    runner.submit(mapper.DownloadJob("d", Tile.TYPE_MAP, [], job_store))
+    assert False, "a job was submitted to a closed runner"
+except ValueError:
+    pass
+
+# jobs download every tile of their area unless asked to simplify it, which
+# would cut the teeth off this sawtooth edge
+jagged = [(30.3, -97.8), (30.3, -97.6), (30.1, -97.6)] + \
+        [(30.1 - 0.01 * (i % 2), -97.6 - 0.01 * i) for i in xrange(1, 21)]
+job = mapper.DownloadJob.from_spec({"name": "e", "tile_store": "null",
+        "vertices": jagged, "min_zoom": 12, "max_zoom": 15})
+full_tiles = set((tile.x, tile.y, tile.zoom)
+        for tile in mapper.generate_area_tiles(
+            [Tile.from_mercator(lat, lng, 0) for lat, lng in jagged],
+            xrange(12, 16)))
+assert set((tile.x, tile.y, tile.zoom) for tile in job.tiles) >= full_tiles
+
+# bad specs and missing files are caught before any job starts
+for spec, error in [(["name"], ValueError),
+        ({"name": "f", "tile_store": "null"}, ValueError),
+        ({"name": "g", "tile_store": "null", "manifest": "/missing"}, IOError),
+        ({"name": "h", "tile_store": "null", "shape_files": ["/missing"]},
+            IOError)]:
+    try:
+        mapper.DownloadJob.from_spec(spec)
+        assert False, "an invalid job spec was accepted: " + repr(spec)
+    except error:
+        pass
+print "ok"
+print
+
+print "metrics:"
+metrics = mapper.Metrics()
+metrics.increment("tiles_total")
+metrics.increment("tiles_total", 2)
+metrics.increment("errors_total", mirror="mt1")
+metrics.track_gauge("queue_depth", lambda: 7, stage="download")
+for seconds in (0.02, 0.3, 0.3, 20):
+    metrics.observe("download_seconds", seconds, mirror="mt0")
+assert metrics.get_counter("tiles_total") == 3
+assert metrics.get_counter("errors_total", mirror="mt1") == 1
+assert metrics.get_counter("errors_total", mirror="mt2") == 0
+histogram = metrics.snapshot()["histograms"][0]
+assert histogram["count"] == 4 and histogram["buckets"]["0.025"] == 1
+assert histogram["buckets"]["0.5"] == 3 and histogram["buckets"]["+Inf"] == 4
+text = metrics.format_prometheus()
+assert 'download_seconds_bucket{le="0.5",mirror="mt0"} 3' in text
+assert 'queue_depth{stage="download"} 7' in text
+print "ok"
+print
+
 print "area lines:"
 horizontal = [
     (0, 0),